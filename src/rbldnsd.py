@@ -6,17 +6,25 @@ from optparse import OptionParser
 import sys
 import os
 from rbldnspy.daemon import DaemonStuff
-from rbldnspy.dataset import DATASETMAP
+from rbldnspy.dataset import DATASETMAP, UDPSocketSet
 from rbldnspy.zone import Zone
 from rbldnspy.ruleyconsole import ConsoleConstants, RuleyConsole,make_escaped_string
 from rbldnspy.tools import secs2human
+from rbldnspy.cache import ResponseCache, question_end
+from rbldnspy import wire
+from rbldnspy.workers import WorkerPool, SO_REUSEPORT
+from rbldnspy.eventloop import EventLoop, ThreadExecutor
+from rbldnspy.watcher import FileWatcher
+from rbldnspy import mmsg
+from rbldnspy.gccontrol import collector as gccollector
 import string
 import select
 import datetime
 import random
 
 import resource
-from socket import socket
+from socket import socket, SOL_SOCKET, SO_REUSEADDR, SOCK_STREAM
+import errno
 import thread
 from dnslib import DNSRecord, RR, DNSHeader, A, QTYPE, TXT
 from IN import AF_INET, SOCK_DGRAM
@@ -49,6 +57,15 @@ class RBLDNSD_options(object):
         self.servewhilereloading = False
         self.dumpzonefile = False
         self.versioninfo = False
+        self.cachesize = 10000
+        self.workers = 0
+        self.eventloop = False
+        self.batchsize = 0
+        self.batchtimeout = 0
+        self.snapshots = False
+        self.incremental = False
+        self.parseprocesses = 0
+        self.reloadsubprocess = False
         self.zones = {} #key: zonename, value: list of tuples: dataset type, filename
     
     def parse(self, args):
@@ -70,13 +87,25 @@ class RBLDNSD_options(object):
         optionparser.add_option("-f", dest="servewhilereloading", action="store_true", default=False)
         optionparser.add_option("-d", dest="dumpzonefile", action="store_true", default=False)
         optionparser.add_option("-v", dest="versioninfo", action="store_true", default=False)
+        optionparser.add_option("--cache-size", dest="cachesize", type="int", default=10000)
+        optionparser.add_option("--workers", dest="workers", type="int", default=0)
+        optionparser.add_option("--eventloop", dest="eventloop", action="store_true", default=False)
+        optionparser.add_option("--batch-size", dest="batchsize", type="int", default=0)
+        optionparser.add_option("--batch-timeout", dest="batchtimeout", type="int", default=0)
+        optionparser.add_option("--snapshots", dest="snapshots", action="store_true", default=False)
+        optionparser.add_option("--incremental", dest="incremental", action="store_true", default=False)
+        optionparser.add_option("--parse-processes", dest="parseprocesses", type="int", default=0)
+        optionparser.add_option("--reload-subprocess", dest="reloadsubprocess", action="store_true", default=False)
         
         (options, pargs) = optionparser.parse_args(args)
 
         for attr in ['user', 'rootdir', 'workdir', 'ipv4only', 'ipv6only', 'ttl', 'check', 'cidrprefixcheck', 'quiet',
-                           'pidfile', 'logfile', 'statsfile', 'nodaemon', 'servewhilereloading', 'dumpzonefile', 'versioninfo' ]:
+                           'pidfile', 'logfile', 'statsfile', 'nodaemon', 'servewhilereloading', 'dumpzonefile', 'versioninfo', 'cachesize', 'workers', 'eventloop', 'batchsize', 'batchtimeout', 'snapshots', 'incremental', 'parseprocesses', 'reloadsubprocess' ]:
             setattr(self, attr, getattr(options, attr))
         
+        if options.incremental and options.reloadsubprocess:
+            print "warning: --reload-subprocess is ignored for datasets with --incremental reloads (dnset, ip4tset)"
+        
         if options.bind==None:
             print "warning: No -b argument - will *not* listen for dns queries"
             options.bind=[]
@@ -109,7 +138,9 @@ class StatusMonitor(object):
     def __init__(self, master):
         self.rbldnsd = master
         self.startup = time.time()
-        template = """running: ${runningsince} - ${qps} q/s
+        template = """running: ${runningsince} - ${qps} q/s ${workers}
+cache: ${cachestats} ${batchstats}
+gc: ${gcstats}${replication}
 $zonedatasetlist        
 """
         
@@ -119,6 +150,11 @@ $zonedatasetlist
               #'datasetlist':self._tmpl_datasetlist,
               'zonedatasetlist':self._tmpl_zonedatasetlist,
               'qps':self._tmpl_qps,
+              'cachestats':self._tmpl_cachestats,
+              'workers':self._tmpl_workers,
+              'batchstats':self._tmpl_batchstats,
+              'gcstats':self._tmpl_gcstats,
+              'replication':self._tmpl_replication,
         }
         
         self.netconsole = RuleyConsole(template, variables)
@@ -126,6 +162,12 @@ $zonedatasetlist
         self.querybuffer = {}
         self.buffertime = 5 
         self.serversocket=None
+        
+        #set in worker processes: shared per worker query counters and our slot
+        self.workercounters = None
+        self.workerindex = None
+        #parent process: last (time, total queries) sample of the worker counters
+        self._workersample = (None, 0)
     
     def _tmpl_runninsince(self):
         return make_escaped_string(secs2human(int(time.time() - self.startup)), fg=ConsoleConstants.COLOR_CYAN)
@@ -140,10 +182,91 @@ $zonedatasetlist
             if k > then:
                 counter += 1
         qps = float(counter) / float(slottime)
+        if self.rbldnsd.workerpool != None:
+            qps += self._worker_qps()
         return make_escaped_string("%.2f" % qps, fg=ConsoleConstants.COLOR_BLUE, bg=ConsoleConstants.COLOR_WHITE)
     
+    def _tmpl_cachestats(self):
+        cache = self.rbldnsd.responsecache
+        total = cache.hits + cache.misses
+        if total > 0:
+            ratio = 100.0 * cache.hits / total
+        else:
+            ratio = 0.0
+        hitrate = make_escaped_string("%.1f%%" % ratio, fg=ConsoleConstants.COLOR_CYAN)
+        return "%s hits, %s misses (%s), %s/%s entries" % (cache.hits, cache.misses, hitrate, len(cache), cache.maxsize)
+    
+    def _worker_qps(self):
+        now = time.time()
+        total = sum(self.rbldnsd.workerpool.query_counts())
+        lasttime, lasttotal = self._workersample
+        self._workersample = (now, total)
+        if lasttime == None or now <= lasttime:
+            return 0.0
+        return (total - lasttotal) / (now - lasttime)
+    
+    def _tmpl_workers(self):
+        pool = self.rbldnsd.workerpool
+        if pool == None:
+            return ''
+        counts = pool.query_counts()
+        percount = ",".join([str(c) for c in counts])
+        return "(%s/%s workers, %s queries: %s)" % (pool.alive_count(), pool.count, sum(counts), percount)
+    
+    def _tmpl_batchstats(self):
+        batches = 0
+        packets = 0
+        batchsize = 0
+        for dnsf in self.rbldnsd.dnsfrontends:
+            if dnsf.batchio != None:
+                batches += dnsf.batchio.batches
+                packets += dnsf.batchio.packets
+                batchsize = dnsf.batchio.batchsize
+        if batches == 0:
+            return ''
+        fill = make_escaped_string("%.1f" % (float(packets) / batches), fg=ConsoleConstants.COLOR_CYAN)
+        return "- batch fill: %s/%s (%s batches)" % (fill, batchsize, batches)
+    
+    def _tmpl_gcstats(self):
+        collections, pausetime, maxpause = gccollector.stats()
+        total = make_escaped_string("%.2fs" % sum(pausetime), fg=ConsoleConstants.COLOR_CYAN)
+        percount = "/".join([str(c) for c in collections])
+        return "%s collections (gen0/1/2: %s), %s paused, longest pause %.1fms" % (sum(collections), percount, total, maxpause * 1000)
+    
+    def _tmpl_replication(self):
+        """one line per replicated fastlist zone, lag in changes per peer"""
+        tmpl = ""
+        for dataset in self.rbldnsd.datasets.values():
+            replication = getattr(dataset, 'replication', None)
+            if replication == None:
+                continue
+            peers = []
+            for peer, lag, age in replication.stats():
+                if peer == None:
+                    peers.append("waiting for the primary")
+                    continue
+                if lag > 0:
+                    lagdisplay = make_escaped_string("lag %s" % lag, fg=ConsoleConstants.COLOR_YELLOW)
+                else:
+                    lagdisplay = make_escaped_string("lag 0", fg=ConsoleConstants.COLOR_GREEN)
+                info = "%s:%s %s" % (peer[0], peer[1], lagdisplay)
+                if replication.role == 'primary':
+                    if age == None:
+                        info += " (never acknowledged)"
+                    else:
+                        info += " (acknowledged %ss ago)" % int(age)
+                peers.append(info)
+            tmpl += "\nreplication %s %s seq %s: %s" % (dataset.filename, replication.role, replication.seq, ", ".join(peers))
+        return tmpl
+    
+    def set_worker_slot(self, counters, index):
+        self.workercounters = counters
+        self.workerindex = index
+    
     def add_query(self, query):
         self.querybuffer[time.time()] = query
+        if self.workercounters != None:
+            self.workercounters[self.workerindex] += 1
     
     def _tmpl_zonelist(self):
         tmpl = ""
@@ -176,12 +299,16 @@ $zonedatasetlist
             if reloadinfo == None:
                 info = ''
             else:
-                (loadtime, newcount, diff) = reloadinfo
+                (loadtime, newcount, diff, incremental, gctime) = reloadinfo
                 loadtime = "%.2fs" % loadtime
                 if diff >= 0:
                     diff = "+%s" % diff
                 newcount = make_escaped_string(newcount, ConsoleConstants.COLOR_MAGENTA)
                 info = "loadtime: %s , %s records(%s)" % (loadtime, newcount, diff)
+                if incremental:
+                    info += " , %s lines applied incrementally" % incremental
+                if gctime:
+                    info += " , gc %.1fms" % (gctime * 1000)
                 
                          
             tmpl += "%s age: %s %s\n" % (filename, activetime, info)
@@ -219,12 +346,16 @@ $zonedatasetlist
                 if reloadinfo == None:
                     info = ''
                 else:
-                    (loadtime, newcount, diff) = reloadinfo
+                    (loadtime, newcount, diff, incremental, gctime) = reloadinfo
                     loadtime = "%.2fs" % loadtime
                     if diff >= 0:
                         diff = "+%s" % diff
                     newcount = make_escaped_string(newcount, ConsoleConstants.COLOR_MAGENTA)
                     info = "loadtime: %s , %s records(%s)" % (loadtime, newcount, diff)
+                    if incremental:
+                        info += " , %s lines applied incrementally" % incremental
+                    if gctime:
+                        info += " , gc %.1fms" % (gctime * 1000)
                     
                              
                 tmpl += " %s age: %s %s\n" % (filename, activetime, info)
@@ -241,6 +372,52 @@ $zonedatasetlist
             logging.getLogger().error("Exception in run_remote_console: %s"%traceback.format_exc())
         
 
+    def attach(self, loop, port=5353):
+        """serve the monitor from an event loop instead of the console threads"""
+        logging.info("""**** monitor running on port %s *****""" % port)
+        serversocket = socket(AF_INET, SOCK_STREAM)
+        serversocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        serversocket.bind(("127.0.0.1", port))
+        serversocket.listen(5)
+        self.serversocket = serversocket
+        self.eventloop = loop
+        loop.add_reader(serversocket, self._accept)
+    
+    def _accept(self):
+        try:
+            clientsocket, address = self.serversocket.accept()
+        except IOError:
+            return
+        timer = self.eventloop.call_every(0.5, self._refresh_client, clientsocket)
+        self.eventloop.add_reader(clientsocket, self._client_readable, clientsocket, timer)
+        self._refresh_client(clientsocket)
+    
+    def _close_client(self, clientsocket, timer):
+        timer.cancel()
+        self.eventloop.remove_reader(clientsocket)
+        try:
+            clientsocket.close()
+        except:
+            pass
+    
+    def _client_readable(self, clientsocket, timer):
+        try:
+            content = clientsocket.recv(4096)
+        except IOError:
+            content = ''
+        ctrl_c = "\xff\xf4\xff\xfd\x06"
+        if content == '' or ctrl_c in content:
+            self._close_client(clientsocket, timer)
+    
+    def _refresh_client(self, clientsocket):
+        try:
+            clientsocket.send(self.netconsole.render())
+        except IOError, e:
+            #slow reader, skip this frame. dead clients are removed by _client_readable
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.eventloop.remove_reader(clientsocket)
+                raise
+
     def debug_console(self):
         self.netconsole.loop()
         
@@ -263,115 +440,258 @@ class DNSFrontend(object):
     RCODE_NOTIMPLEMENTED = 4
     RCODE_REFUSED = 5
     
-    def __init__(self, master, ip="127.0.0.1", port=53):
+    def __init__(self, master, ip="127.0.0.1", port=53, reuseport=False, batchsize=0, batchtimeout=0):
         self.rbldnsd = master
         self.socket = None
         self.ip = ip
         self.port = port
+        self.reuseport = reuseport
         self.stayAlive = True
         
+        #recvmmsg/sendmmsg batching, batchtimeout in milliseconds
+        self.batchsize = batchsize
+        self.batchtimeout = batchtimeout
+        self.batchio = None
+        #replies we could not send because the socket buffer was full (event loop mode)
+        self.dropped = 0
+        
     
-    def send_nxdomain(self,d,addr):
+    def nxdomain_response(self,d):
         response = DNSRecord(DNSHeader(id=d.header.id, gr=1, aa=1, ra=1, qr=1, rcode=DNSFrontend.RCODE_NXDOMAIN),
                         q=d.get_q()
                         )
-        self.socket.sendto(response.pack(), addr)
+        return response.pack()
         
-    def send_servfail(self,d,addr):
+    def servfail_response(self,d):
         response = DNSRecord(DNSHeader(id=d.header.id, gr=1, aa=1, ra=1, qr=1, rcode=DNSFrontend.RCODE_SERVFAIL),
                         q=d.get_q()
                         )
-        self.socket.sendto(response.pack(), addr)
+        return response.pack()
+    
+    def send_nxdomain(self,d,addr):
+        self.socket.sendto(self.nxdomain_response(d), addr)
+        
+    def send_servfail(self,d,addr):
+        self.socket.sendto(self.servfail_response(d), addr)
+    
+    def zone_generation(self, qname):
+        zone, search = self.rbldnsd.find_zone(qname)
+        if zone != None:
+            return zone.get_generation()
+        return 0
+    
+    def handle_query(self,data,addr):
+        """answer a raw query packet. returns the packed response or None if the query should not be answered
+        plain A/TXT queries are decoded and answered by rbldnspy.wire, everything else goes through dnslib"""
+        query = wire.parse_query(data)
+        if query == None:
+            return self.handle_dnslib_query(data, addr)
+        
+        qname = query.qname
+        cache = self.rbldnsd.responsecache
+        cachekey = (qname.lower(), query.qtype, query.qclass)
+        generation = self.zone_generation(qname)
+        
+        cached = cache.get(cachekey, generation)
+        if cached != None:
+            self.rbldnsd.statusmonitor.add_query(qname.rstrip('.'))
+            return cache.patch(cached, data, query.qend)
+        
+        try:
+            ansdict = self.rbldnsd.lookup(qname)
+            answers = self.collect_answers(ansdict, query.qtype)
+            if len(answers) > 0:
+                logging.getLogger().debug("client=%s q=%s %s -> NOERROR"%(addr[0],qname,query.qtype))
+                response = wire.answer_response(data, query, answers)
+            else:
+                logging.getLogger().debug("client=%s q=%s %s -> NXDOMAIN"%(addr[0],qname,query.qtype))
+                response = wire.error_response(data, query, DNSFrontend.RCODE_NXDOMAIN)
+        except:
+            fmt = traceback.format_exc()
+            logging.getLogger().error(fmt)
+            return wire.error_response(data, query, DNSFrontend.RCODE_SERVFAIL)
+        
+        cache.put(cachekey, generation, response)
+        return response
+    
+    def collect_answers(self, ansdict, qtype):
+        """returns a list of tuples (value, ttl) for all results in ansdict that have a qtype value"""
+        answers = []
+        for answer in ansdict.get('results', []):
+            if answer==None:
+                continue
+            if qtype not in answer:
+                continue
+            ttl = None
+            if 'TTL' in answer:
+                ttl = answer['TTL']
+            answers.append((answer[qtype], ttl))
+        return answers
+    
+    def handle_dnslib_query(self,data,addr):
+        """slow path of handle_query for everything rbldnspy.wire does not decode"""
+        d = DNSRecord.parse(data)
+        
+        #print "Question from  ",addr
+        #print d
+        question = d.get_q()
+        qname = str(question.qname)
+        qtype = str(QTYPE[question.qtype]).upper()
+        
+        cache = self.rbldnsd.responsecache
+        cachekey = (qname.lower(), qtype, question.qclass)
+        generation = self.zone_generation(qname)
+        
+        cached = cache.get(cachekey, generation)
+        if cached != None:
+            qend = question_end(data)
+            if qend != None:
+                self.rbldnsd.statusmonitor.add_query(qname.rstrip('.'))
+                return cache.patch(cached, data, qend)
+        
+        try:
+            response = self.build_response(d, qname, qtype, addr)
+        except:
+            fmt = traceback.format_exc()
+            logging.getLogger().error(fmt)
+            return self.servfail_response(d)
+        
+        if response != None:
+            cache.put(cachekey, generation, response)
+        return response
+    
+    def build_response(self,d,qname,qtype,addr):
+        """look up the answer for a parsed query and return the packed response"""
+        question = d.get_q()
+        ansdict = self.rbldnsd.lookup(qname)
+        
+        #logging.getLogger().debug("ansdict: %s"%ansdict)
+        if qtype=='SOA':
+            if ansdict['SOA']!=None:
+                response = DNSRecord(DNSHeader(id=d.header.id, gr=1, aa=1, ra=1, qr=1, q=d.get_q()))
+                soa=ansdict['SOA']
+                packet=SOA()
+                packet.set_mname(soa[0])
+                packet.set_rname(soa[1])
+                packet.times=soa[2:]
+                if 'SOATTL' in ansdict:
+                    packet.ttl=ansdict['SOATTL']
+                response.rr.append(packet)
+                return response.pack()
+            else:
+                return self.nxdomain_response(d)
+        elif qtype=='NS':
+            if ansdict['NS']!=None:
+                #TODO
+                pass
+            else:
+                return self.nxdomain_response(d)
+        elif qtype=='A' or qtype=='TXT':
+            if 'results' not in ansdict:
+                logging.getLogger().debug("client=%s q=%s %s -> NXDOMAIN"%(addr[0],qname,qtype))
+                return self.nxdomain_response(d)
+            anspacklist=[]
+            for value, ttl in self.collect_answers(ansdict, qtype):
+                packet=RR(question.qname,question.qtype,rdata=RDMAP[QTYPE[question.qtype]](value))
+                if ttl!=None:
+                    packet.ttl=ttl
+                anspacklist.append(packet)
+                
+            if len(anspacklist)>0:
+                response = DNSRecord(DNSHeader(id=d.header.id,bitmap=d.header.bitmap, aa=1, ra=0, qr=1,q=1))
+                response.add_question(question)
+                response.rr.extend(anspacklist)
+                response.set_header_qa()
+                #logging.getLogger().debug(response)
+                #make sure answer bit is set
+                #response.header.qr=1
+                
+                logging.getLogger().debug("client=%s q=%s %s -> NOERROR"%(addr[0],qname,qtype))
+                return response.pack()
+            else:
+                logging.getLogger().debug("client=%s q=%s %s -> NXDOMAIN"%(addr[0],qname,qtype))
+                return self.nxdomain_response(d)
+        else:
+            logging.getLogger().warning("unsupported qtype %s"%qtype)
+        return None
+     
+    def bind(self):
+        udpsocket = socket(AF_INET, SOCK_DGRAM)
+        if self.reuseport:
+            udpsocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        udpsocket.bind((self.ip, self.port))
+        self.socket = udpsocket        
+        logging.getLogger().debug('now serving on %s/%s' % (self.ip, self.port))
+        
+        if self.batchsize > 1:
+            if mmsg.available:
+                self.batchio = mmsg.BatchIO(udpsocket, self.batchsize, self.batchtimeout / 1000.0)
+            else:
+                logging.getLogger().warning("recvmmsg/sendmmsg not available - batching disabled on %s/%s" % (self.ip, self.port))
+    
+    def handle_batch(self, block=True):
+        """answer one batch of queries received with recvmmsg, returns the number of queries received"""
+        batch = self.batchio.recv(block)
+        replies = []
+        for slot, data, addr in batch:
+            try:
+                response = self.handle_query(data, addr)
+                if response != None:
+                    replies.append((slot, response))
+            except Exception:
+                fmt = traceback.format_exc()
+                logging.getLogger().error(fmt)
+        sent = self.batchio.send(replies)
+        self.dropped += len(replies) - sent
+        return len(batch)
+    
+    def handle_readable(self, budget=64):
+        """event loop callback: answer up to budget queries waiting on our non-blocking socket"""
+        if self.batchio != None:
+            received = 0
+            while received < budget:
+                count = self.handle_batch(block=False)
+                if count == 0:
+                    return
+                received += count
+            return
+        
+        for i in xrange(budget):
+            try:
+                data, addr = self.socket.recvfrom(512)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            try:
+                response = self.handle_query(data, addr)
+                if response != None:
+                    self.socket.sendto(response, addr)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                self.dropped += 1
+            except Exception:
+                fmt = traceback.format_exc()
+                logging.getLogger().error(fmt)
      
     def serve(self):
         try:
-            udpsocket = socket(AF_INET, SOCK_DGRAM)
-            udpsocket.bind((self.ip, self.port))
-            self.socket = udpsocket        
-            logging.getLogger().debug('now serving on %s/%s' % (self.ip, self.port))
+            self.bind()
+            
+            while self.stayAlive and self.batchio != None:
+                try:
+                    self.handle_batch()
+                except Exception:
+                    fmt = traceback.format_exc()
+                    logging.getLogger().error(fmt)
             
             while self.stayAlive:
                 try:
                     data, addr = self.socket.recvfrom(512)
-                    d = DNSRecord.parse(data)
-                    
-                    #print "Question from  ",addr
-                    #print d
-                    question = d.get_q()
-                    qname = str(question.qname)
-                    qtype = str(QTYPE[question.qtype]).upper()
-                    
-                    try:
-                        ansdict = self.rbldnsd.lookup(qname)
-                        
-                        #logging.getLogger().debug("ansdict: %s"%ansdict)
-                        if qtype=='SOA':
-                            if ansdict['SOA']!=None:
-                                response = DNSRecord(DNSHeader(id=d.header.id, gr=1, aa=1, ra=1, qr=1, q=d.get_q()))
-                                soa=ansdict['SOA']
-                                packet=SOA()
-                                packet.set_mname(soa[0])
-                                packet.set_rname(soa[1])
-                                packet.times=soa[2:]
-                                if 'SOATTL' in ansdict:
-                                    packet.ttl=ansdict['SOATTL']
-                                response.rr.append(packet)
-                                self.socket.sendto(response.pack(), addr)
-                                continue
-                            else:
-                                self.send_nxdomain(d, addr)
-                                continue
-                        elif qtype=='NS':
-                            if ansdict['NS']!=None:
-                                #TODO
-                                pass
-                            else:
-                                self.send_nxdomain(d, addr)
-                                continue
-                        elif qtype=='A' or qtype=='TXT':
-                            if 'results' not in ansdict:
-                                self.send_nxdomain(d, addr)
-                                logging.getLogger().debug("client=%s q=%s %s -> NXDOMAIN"%(addr[0],qname,qtype))
-                                continue
-                            anslist=ansdict['results']
-                            anspacklist=[]
-                            for answer in anslist:
-                                if answer==None:
-                                    continue
-                                if qtype not in answer:
-                                    continue
-                                packet=RR(question.qname,question.qtype,rdata=RDMAP[QTYPE[question.qtype]](answer[qtype]))
-                                if 'TTL' in answer and answer['TTL']!=None:
-                                    packet.ttl=answer['TTL']
-                                anspacklist.append(packet)
-                                
-                            if len(anspacklist)>0:
-                                response = DNSRecord(DNSHeader(id=d.header.id,bitmap=d.header.bitmap, aa=1, ra=0, qr=1,q=1))
-                                response.add_question(question)
-                                response.rr.extend(anspacklist)
-                                response.set_header_qa()
-                                #logging.getLogger().debug(response)
-                                #make sure answer bit is set
-                                #response.header.qr=1
-                                
-                                self.socket.sendto(response.pack(), addr)
-                                logging.getLogger().debug("client=%s q=%s %s -> NOERROR"%(addr[0],qname,qtype))
-                            else:
-                                self.send_nxdomain(d, addr)
-                                logging.getLogger().debug("client=%s q=%s %s -> NXDOMAIN"%(addr[0],qname,qtype))
-                            
-                            continue
-                        else:
-                            logging.getLogger().warning("unsupported qtype %s"%qtype)
-                            
-                        
-                    except:
-                        fmt = traceback.format_exc()
-                        logging.getLogger().error(fmt)
-                        self.send_servfail(d, addr)
-                        continue
-                    
-                   
+                    response = self.handle_query(data, addr)
+                    if response != None:
+                        self.socket.sendto(response, addr)
                 except Exception:
                     fmt = traceback.format_exc()
                     logging.getLogger().error(fmt)
@@ -395,10 +715,22 @@ class RBLDNSD(object):
     def __init__(self, options):
         self.options = options
         self.zones = {}
+        #key: lowercased zone name, value: zone
+        self.zoneindex = {}
         self.datasets = {}
         self.statusmonitor = StatusMonitor(self)
+        self.responsecache = ResponseCache(options.cachesize)
         self.stay_alive=True
         self.dnsfrontends=[]
+        self.workerpool=None
+        #index of this worker process, None in the parent / single process mode
+        self.workerindex=None
+        self.eventloop=None
+        #dataset reloads
+        self.executor=None
+        #fastlist expiry and persistence, never queued behind a long reload
+        self.maintenance=None
+        self.watcher=None
     
         self.configfile='/etc/rbldnspy/rbldnspy.conf'
         self.dconfdir='/etc/rbldnspy/conf.d'
@@ -469,33 +801,179 @@ class RBLDNSD(object):
         #now we are either in child process or no-daemon mode, so we can safely instantiate logging
         init_logging()
 
-        try:
-            self.load_zones(autoreloader=True)
-        except:
-            logging.getLogger().error("Exception while loading zones: %s"%traceback.format_exc())
-            
-        try:
-            self.statusmonitor.start()
-        except:
-            logging.getLogger().error("Exception starting statusmonitor: %s"%traceback.format_exc())
+        if self.options.workers > 0:
+            self.start_workers()
+        else:
+            try:
+                #in event loop mode the loop drives the file watcher
+                self.load_zones(autoreloader=not self.options.eventloop)
+            except:
+                logging.getLogger().error("Exception while loading zones: %s"%traceback.format_exc())
         
+        if self.options.eventloop and self.options.workers == 0:
+            self.setup_eventloop()
+        else:
+            self.start_gc_control()
+            try:
+                self.statusmonitor.start()
+            except:
+                logging.getLogger().error("Exception starting statusmonitor: %s"%traceback.format_exc())
+            
+            if self.options.workers == 0:
+                self.start_frontends()
         
-        #init frontend
+        difftime = time.time() - starttime
+        logging.getLogger().info("startup complete after %.2f seconds" % difftime)
+      
+    def start_frontends(self, reuseport=False):
         for sock in self.options.listensockets:
             try:
                 ip, port = sock
-                dnsf = DNSFrontend(self, ip, int(port))
+                dnsf = DNSFrontend(self, ip, int(port), reuseport, self.options.batchsize, self.options.batchtimeout)
                 thread.start_new(dnsf.serve, ())
                 self.dnsfrontends.append(dnsf)
             except:
                 logging.getLogger().error("Exception starting dns frontent on %s/%s: %s"%(ip,port,traceback.format_exc()))
+    
+    def setup_eventloop(self, reuseport=False, monitor=True):
+        """multiplex all dns sockets, fastlist sockets and the monitor port in one event loop.
+        reloads and fastlist persistence run in background executors of their own"""
+        loop = EventLoop()
+        maintenance = ThreadExecutor()
+        self.eventloop = loop
+        self.executor = ThreadExecutor()
+        self.maintenance = maintenance
         
-        difftime = time.time() - starttime
-        logging.getLogger().info("startup complete after %.2f seconds" % difftime)
-      
+        for sock in self.options.listensockets:
+            try:
+                ip, port = sock
+                dnsf = DNSFrontend(self, ip, int(port), reuseport, self.options.batchsize, self.options.batchtimeout)
+                dnsf.bind()
+                loop.add_reader(dnsf.socket, dnsf.handle_readable, loop.budget)
+                self.dnsfrontends.append(dnsf)
+            except:
+                logging.getLogger().error("Exception starting dns frontent on %s/%s: %s"%(ip,port,traceback.format_exc()))
+        
+        for dataset in self.datasets.values():
+            if isinstance(dataset, UDPSocketSet):
+                if dataset.udpsocket == None:
+                    continue
+                loop.add_reader(dataset.udpsocket, dataset.receive_pending, loop.budget)
+                loop.call_every(1, self._expire_due, dataset)
+                if dataset.persistent:
+                    loop.call_every(1, maintenance.submit, (dataset, 'sync'), dataset.sync_journal)
+                    loop.call_every(dataset.compactinterval, maintenance.submit, (dataset, 'save'), dataset.save_zone)
+        
+        self.create_watcher().attach(loop)
+        self.start_gc_control()
+        
+        if monitor:
+            try:
+                self.statusmonitor.attach(loop)
+            except:
+                logging.getLogger().error("Exception starting statusmonitor: %s"%traceback.format_exc())
+    
+    def _expire_due(self, dataset):
+        #cheap check in the loop, expiry itself takes the dataset lock
+        due = dataset.next_expiry()
+        if due != None and due < time.time():
+            self.maintenance.submit((dataset, 'expire'), dataset.expire_once)
+    
+    def start_gc_control(self):
+        """run all cyclic gc collections ourselves, between queries in event loop mode, timed for the monitor"""
+        gccollector.take_over()
+        if self.eventloop != None:
+            self.eventloop.call_every(0.1, gccollector.tick)
+        else:
+            gccollector.start()
+    
+    def create_watcher(self):
+        """one watcher for the source files of all datasets, changed datasets are reloaded in the background executor"""
+        if self.executor == None:
+            self.executor = ThreadExecutor()
+        self.watcher = FileWatcher(interval=self.options.check or 60)
+        for dataset in self.datasets.values():
+            if isinstance(dataset, UDPSocketSet):
+                continue
+            self.watcher.add(dataset.filename, lambda path, dataset=dataset: self._source_changed(dataset))
+        return self.watcher
+    
+    def start_watcher(self):
+        self.create_watcher().start()
+    
+    def _source_changed(self, dataset):
+        #check_reload skips the reload if only the mtime changed
+        dataset.queue_reload()
+        self.executor.submit((dataset, 'reload'), dataset.check_reload)
+    
+    def start_workers(self):
+        """load all datasets in this process, then fork the dns serving worker processes"""
+        try:
+            self.load_zones(autoreloader=False)
+        except:
+            logging.getLogger().error("Exception while loading zones: %s"%traceback.format_exc())
+        
+        fastlists = [ds for ds in self.datasets.values() if isinstance(ds, UDPSocketSet)]
+        self.workerpool = WorkerPool(self.options.workers, self.run_worker, fastlists)
+        self.workerpool.start()
+        
+        #keep our own copy up to date as well, restarted workers are forked from it
+        self.start_watcher()
+    
+    def run_worker(self, index, fastlistsockets):
+        """main function of a forked worker process"""
+        self.workerindex = index
+        signal.signal(signal.SIGTERM, self.sighandler)
+        #the parent's watcher and executor threads did not survive the fork
+        if self.watcher != None:
+            self.watcher.close()
+        self.watcher = None
+        self.executor = None
+        self.maintenance = None
+        gccollector.after_fork()
+        self.statusmonitor.set_worker_slot(self.workerpool.querycounters, index)
+        
+        for dataset in self.datasets.values():
+            dataset.after_fork()
+            if self.options.eventloop and isinstance(dataset, UDPSocketSet):
+                dataset.threaded = False
+        for dataset, sock in fastlistsockets:
+            dataset.follow(sock)
+        
+        if self.options.eventloop:
+            self.setup_eventloop(reuseport=True, monitor=False)
+            logging.getLogger().info("worker %s ready" % index)
+            self.run_eventloop()
+            return
+        
+        #every worker reloads changed datasets itself
+        self.start_watcher()
+        self.start_gc_control()
+        
+        self.start_frontends(reuseport=True)
+        logging.getLogger().info("worker %s ready" % index)
+        while self.stay_alive:
+            try:
+                time.sleep(1)
+            except KeyboardInterrupt:
+                self.shutdown()
+    
     def shutdown(self):
         self.stay_alive=False
         
+        if self.workerpool != None and self.workerindex == None:
+            logging.getLogger().error("stopping workers...")
+            self.workerpool.shutdown()
+        
+        if self.eventloop != None:
+            self.eventloop.stop()
+        if self.watcher != None:
+            self.watcher.close()
+        if self.executor != None:
+            self.executor.shutdown()
+        if self.maintenance != None:
+            self.maintenance.shutdown()
+        
         logging.getLogger().error("stopping dns frontends...")
         for dnsf in self.dnsfrontends:
             dnsf.shutdown()
@@ -521,6 +999,9 @@ class RBLDNSD(object):
             
             if zonename not in zones:
                 zones[zonename] = Zone(zonename)
+                #-f: the zone switches to reloaded data only when all its datasets are done
+                zones[zonename].batchpublish = self.options.servewhilereloading
+                zones[zonename].apply_config(self.config)
             
             for dsettype, dsetfile in datasetlist:
                 logging.getLogger().info("now handling zone argument %s : %s"%(dsettype,dsetfile))
@@ -536,13 +1017,19 @@ class RBLDNSD(object):
                         continue
                     dataset = datasetclass(dsetfile)
                     dataset.apply_config(self.config)
+                    if self.options.eventloop and self.options.workers == 0 and isinstance(dataset, UDPSocketSet):
+                        dataset.threaded = False
                     if self.options.check:
                         dataset.reload_check_interval=self.options.check
+                    dataset.snapshots = self.options.snapshots
+                    dataset.incremental = self.options.incremental
+                    dataset.parseprocesses = self.options.parseprocesses
+                    dataset.reload_subprocess = self.options.reloadsubprocess
                     #logging.getLogger().debug("Starting initial load for %s/%s"%(dsetfile,dsettype))
                     #dataset.reload()
-                    if autoreloader:
-                        logging.getLogger().debug("Starting auto-reloader for %s: %s , check every %s seconds"%(dsettype,dsetfile,dataset.reload_check_interval))
-                        dataset.start_autoreloader()
+                    if autoreloader and not isinstance(dataset, UDPSocketSet):
+                        logging.getLogger().debug("Loading %s: %s in the background"%(dsettype,dsetfile))
+                        thread.start_new_thread(dataset.reload, ())
                     else:
                         dataset.reload()
                     datasets[dsetfile] = dataset
@@ -550,17 +1037,38 @@ class RBLDNSD(object):
                 zones[zonename].add_dataset(datasets[dsetfile])        
             self.zones = zones
             self.datasets = datasets
+        self.build_zone_index()
+        if autoreloader:
+            self.start_watcher()
+    
+    def build_zone_index(self):
+        zoneindex = {}
+        for zonename, zone in self.zones.iteritems():
+            zoneindex[zonename.rstrip('.').lower()] = zone
+        self.zoneindex = zoneindex
         
     def sighandler(self,signum,frame):
         logging.getLogger().info("Shutting down...")
         self.shutdown()
     
+    def run_eventloop(self):
+        while self.stay_alive:
+            try:
+                self.eventloop.run()
+            except KeyboardInterrupt:
+                self.shutdown()
+    
     def serve_forever(self):
         signal.signal(signal.SIGTERM, self.sighandler)
+        if self.eventloop != None:
+            self.run_eventloop()
+            return
         #main thread
         while self.stay_alive:
             try:
                 time.sleep(1)
+                if self.workerpool != None:
+                    self.workerpool.check()
             except KeyboardInterrupt:
                 self.shutdown()
 
@@ -577,20 +1085,35 @@ class RBLDNSD(object):
         query = query.rstrip('.')
         self.statusmonitor.add_query(query)
         logging.getLogger().debug("query: %s" % query)
-        for k in sorted(self.zones, key=len, reverse=True):
-            if query==k or query.endswith('.%s' % k):
-                if query==k:
-                    search=''
-                else:
-                    search = query[:-len(k) - 1]
-                zone = self.zones[k]
-                if not zone.is_available():
-                    raise Exception("Zone %s unavailable" % zone)
-                logging.getLogger().debug("query trace: zone=%s" % k)
-                result = zone.lookup(search)
-                logging.getLogger().debug('result: %s' % result)
-                return result
-        return {}
+        zone, search = self.find_zone(query)
+        if zone == None:
+            return {}
+        if not zone.is_available():
+            raise Exception("Zone %s unavailable" % zone)
+        logging.getLogger().debug("query trace: zone=%s" % zone)
+        result = zone.lookup(search)
+        logging.getLogger().debug('result: %s' % result)
+        return result
+    
+    def find_zone(self, query):
+        """Returns a tuple (zone, search) for the longest zone matching query.
+        search is the part of the query in front of the zone name. 
+        Returns (None, None) if we are not authoritative for the query
+        """
+        query = query.rstrip('.').lower()
+        zoneindex = self.zoneindex
+        zone = zoneindex.get(query)
+        if zone != None:
+            return zone, ''
+        
+        #try the suffixes from longest to shortest, the first hit is the most specific zone
+        pos = query.find('.')
+        while pos >= 0:
+            zone = zoneindex.get(query[pos + 1:])
+            if zone != None:
+                return zone, query[:pos]
+            pos = query.find('.', pos + 1)
+        return None, None
         
     
 def init_logging():
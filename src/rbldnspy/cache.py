@@ -0,0 +1,80 @@
+from threading import Lock
+from collections import OrderedDict
+
+
+def question_end(packet):
+    """returns the offset of the first byte after the (single) question section in a raw dns packet
+    returns None if the qname can not be walked without following compression pointers"""
+    i=12
+    plen=len(packet)
+    while i<plen:
+        labellen=ord(packet[i])
+        if labellen==0:
+            end=i+5
+            if end>plen:
+                return None
+            return end
+        if labellen & 0xC0:
+            return None
+        i+=labellen+1
+    return None
+
+
+class ResponseCache(object):
+    """Bounded LRU cache of packed dns responses, keyed by (lowercased qname, qtype, qclass)
+
+    Every entry remembers the generation of the zone data it was built from. A lookup with a different
+    generation is a miss, so changed zones never serve stale answers.
+    """
+
+    def __init__(self,maxsize=10000):
+        self.maxsize=maxsize
+        self.hits=0
+        self.misses=0
+        self._entries=OrderedDict()
+        self._lock=Lock()
+
+    def get(self,key,generation):
+        """return the cached packet for key or None"""
+        if self.maxsize<=0:
+            return None
+        self._lock.acquire()
+        try:
+            entry=self._entries.pop(key,None)
+            if entry==None or entry[0]!=generation:
+                self.misses+=1
+                return None
+            #re-insert as most recently used
+            self._entries[key]=entry
+            self.hits+=1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def put(self,key,generation,packet):
+        if self.maxsize<=0:
+            return
+        self._lock.acquire()
+        try:
+            self._entries.pop(key,None)
+            self._entries[key]=(generation,packet)
+            while len(self._entries)>self.maxsize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def patch(self,cached,query,qend):
+        """turn a cached response into the response for query: copy the transaction id and the RD flag, echo the question"""
+        #RD is the lowest bit of the first flags byte. dnslib packs responses into a bytearray
+        flags=chr((bytearray(cached[2:3])[0]&0xfe)|(ord(query[2])&0x01))
+        return query[:2]+flags+cached[3:12]+query[12:qend]+cached[qend:]
@@ -1,7 +1,7 @@
 import time
 import logging
 import thread
-from threading import Lock
+from threading import Lock, Event
 from tools import *
 RADIX_AVAILABLE=False
 try:
@@ -10,15 +10,29 @@ try:
 except:
     pass
 import string
+import sys
 import os
 import Queue
 import string
 import socket
 import traceback
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import errno
+import hashlib
+import copy
+import zlib
+import operator
+from itertools import imap, izip, islice
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop, heapify
+from snapshot import read_snapshot, write_snapshot, stat_source, hash_source, register_state_class
+from parallel import parse_parallel
+from flatdict import FlatDict, build_flat_table
+from workers import reset_logging_locks
+import gccontrol
+from journal import Journal, journal_filename, encode, encode_add, encode_delete, decode_records, read_zone, write_zone
+from replication import Replication, parse_address, pack_frames
+from overlay import OverlayView, DELETED
 
 class ReloadDefaults(object):
     def __init__(self):
@@ -71,8 +85,301 @@ class ReloadDefaults(object):
         
     
         
+class Record(object):
+    """answer record of a data line
+    
+    Records are immutable and shared by all lines with the same values. For compatibility with the 
+    fastlist records they can be read like a dict: record['A'], 'TXT' in record
+    """
+    __slots__=('A','TXT','TTL','excluded')
+    
+    def __init__(self,a,txt,ttl,excluded=False):
+        object.__setattr__(self,'A',a)
+        object.__setattr__(self,'TXT',txt)
+        object.__setattr__(self,'TTL',ttl)
+        object.__setattr__(self,'excluded',excluded)
+    
+    def __setattr__(self,name,value):
+        raise AttributeError("records are immutable")
+    
+    def __getitem__(self,key):
+        if key not in Record.__slots__:
+            raise KeyError(key)
+        return getattr(self,key)
+    
+    def __contains__(self,key):
+        return key in Record.__slots__
+    
+    def get(self,key,default=None):
+        if key not in Record.__slots__:
+            return default
+        return getattr(self,key)
+    
+    def keys(self):
+        return list(Record.__slots__)
+    
+    def with_txt(self,txt):
+        """copy of this record with a query time TXT value"""
+        if txt==self.TXT:
+            return self
+        return Record(self.A,txt,self.TTL,self.excluded)
+    
+    def __repr__(self):
+        return "Record(A=%r, TXT=%r, TTL=%r, excluded=%r)"%(self.A,self.TXT,self.TTL,self.excluded)
+    
+    def __reduce__(self):
+        return (Record,(self.A,self.TXT,self.TTL,self.excluded))
+
+
+def _defaults_fromstate(state):
+    defaults=ReloadDefaults()
+    defaults.__dict__.update(state)
+    return defaults
+
+#records and reload defaults are stored in snapshots
+register_state_class(Record,lambda record: record.__reduce__()[1],lambda state: Record(*state))
+register_state_class(ReloadDefaults,lambda defaults: defaults.__dict__,_defaults_fromstate)
+
+
+class TxtTemplates(object):
+    """txt templates compiled for one set of reload defaults
+    
+    A compiled template is a tuple of literal parts, the queried value goes between them. $0-$9, $$ and 
+    the base template are resolved at compile time. Compiled templates are interned by their text.
+    """
+    
+    #fastlist records can bring arbitrary templates, don't let the table grow forever
+    MAXTEMPLATES=10000
+    
+    def __init__(self,defaults):
+        self.defaults=defaults
+        self.compiled={}
+    
+    def compile(self,template):
+        if template in self.compiled:
+            return self.compiled[template]
+        parts=compile_txt_template(template,self.defaults)
+        if len(self.compiled)<self.MAXTEMPLATES:
+            self.compiled[template]=parts
+        return parts
+    
+    def render(self,template,question):
+        parts=self.compiled.get(template)
+        if parts==None:
+            parts=self.compile(template)
+            if parts==None:
+                return None
+        return question.join(parts)
+    
+    def render_ip4(self,template,ip):
+        """render for an ipv4 query given as integer, the dotted address is only built if the template uses it"""
+        parts=self.compiled.get(template)
+        if parts==None:
+            parts=self.compile(template)
+            if parts==None:
+                return None
+        if len(parts)==1:
+            return parts[0]
+        return long2ip(ip).join(parts)
+
+
+def compile_txt_template(template,defaults):
+    """split template into literal parts, the query goes between them. returns None if there is no txt"""
+    origtemplate=template
+    if defaults.basetxttemplate!=None:
+        if template!=None and len(template)>0 and template[0]=='=':
+            #special case.. disable basetemplate in the record with leading =
+            template=template[1:]
+        else:
+            template=defaults.basetxttemplate
+        
+    if template==None:
+        return None
+    templen=len(template)
+    parts=[]
+    outbuf=[]
+    i=0
+    while i < templen:
+        c=template[i]
+        n=None
+        if i<templen-1:
+            n=template[i+1]
+        if c=='$':
+            if n=='$':
+                outbuf.append('$')
+                i+=2
+                continue
+            elif n!=None and n in string.digits:
+                varindex=int(n)
+                if defaults.variables[varindex]!=None:
+                    outbuf.append(defaults.variables[varindex])
+                i+=2
+                continue
+            elif n=='=' and defaults.basetxttemplate!=None:
+                #base template
+                if origtemplate!=None:
+                    outbuf.append(origtemplate)
+                    i+=2
+                    continue
+                #no record template, the query is substituted
+                i+=2
+            else:
+                i+=1
+            parts.append(''.join(outbuf))
+            outbuf=[]
+            continue
+                
+        outbuf.append(c)
+        i+=1
+    parts.append(''.join(outbuf))
+    return tuple(parts)
+
+
+def _read_lines(filename,sha):
+    """yields the lines of filename and feeds them to sha"""
+    handle=open(filename,'r')
+    try:
+        rest=''
+        while True:
+            block=handle.read(1024*1024)
+            if not block:
+                break
+            sha.update(block)
+            lines=(rest+block).split('\n')
+            rest=lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+    finally:
+        handle.close()
+
+
+class SourceState(object):
+    """what an incremental reload needs to know about the previously parsed source
+    
+    directives: list of (kind, line) of all special and default lines, in file order
+    contexts: copies of the reload defaults in effect after each directive, index 0 is the initial state
+    ctxstarts: number of data lines before each directive
+    order: hash((context index, line)) of all data lines in file order
+    fingerprints: the same, sorted and deduplicated
+    content: zlib compressed data lines, to find the text of removed lines
+    
+    fingerprints don't capture the order of lines within a context. moving a line above another line for the 
+    same key without changing either of them is not noticed until the next full reload
+    """
+    
+    def __init__(self,defaults):
+        self.directives=[]
+        self.contexts=None
+        if defaults!=None:
+            self.contexts=[copy.copy(defaults)]
+        self.ctxstarts=[]
+        self.order=array('l')
+        self.fingerprints=None
+        self.linecount=0
+        #identical data lines, their order can not be tracked with fingerprints
+        self.duplicates=False
+        #every key is defined by exactly one line
+        self.uniquekeys=False
+        self.content=None
+        self._compressor=zlib.compressobj(1)
+        self._chunks=[]
+        self._pending=[]
+    
+    def add_directive(self,kind,line,defaults=None):
+        self.directives.append((kind,line))
+        self.ctxstarts.append(self.linecount)
+        if defaults!=None:
+            self.contexts.append(copy.copy(defaults))
+    
+    def add_line(self,line):
+        fingerprint=hash((len(self.directives),line))
+        self.order.append(fingerprint)
+        self.linecount+=1
+        pending=self._pending
+        pending.append(line)
+        if len(pending)>=4096:
+            self._flush()
+        return fingerprint
+    
+    def _flush(self):
+        if self._pending:
+            self._pending.append('')
+            self._chunks.append(self._compressor.compress('\n'.join(self._pending)))
+            self._pending=[]
+    
+    def finish(self,fingerprints=None):
+        """compress the stored lines. fingerprints: the sorted fingerprints if they are already known"""
+        self._flush()
+        self.content=''.join(self._chunks)+self._compressor.flush()
+        self._chunks=None
+        self._compressor=None
+        if fingerprints==None:
+            fingerprints=array('l',sorted(self.order))
+            self.duplicates=any(imap(operator.eq,fingerprints,islice(fingerprints,1,None)))
+        self.fingerprints=fingerprints
+    
+    def _blocks(self):
+        """yields blocks of complete stored lines, without the trailing newline"""
+        decompressor=zlib.decompressobj()
+        rest=''
+        for pos in xrange(0,len(self.content),65536):
+            data=rest+decompressor.decompress(self.content[pos:pos+65536])
+            end=data.rfind('\n')
+            if end<0:
+                rest=data
+                continue
+            rest=data[end+1:]
+            yield data[:end]
+        data=rest+decompressor.flush()
+        if data:
+            yield data[:-1]
+    
+    def lines_at(self,indices):
+        """dict index -> stored data line for the given line indices"""
+        wanted=sorted(set(indices))
+        result={}
+        w=0
+        base=0
+        for block in self._blocks():
+            if w>=len(wanted):
+                break
+            count=block.count('\n')+1
+            if wanted[w]<base+count:
+                lines=block.split('\n')
+                while w<len(wanted) and wanted[w]<base+count:
+                    result[wanted[w]]=lines[wanted[w]-base]
+                    w+=1
+            base+=count
+        return result
+    
+    def iter_lines(self):
+        """yields (context index, line) for the stored data lines"""
+        ctxstarts=self.ctxstarts
+        index=0
+        for block in self._blocks():
+            for line in block.split('\n'):
+                yield bisect_right(ctxstarts,index),line
+                index+=1
+    
+    def updated_fingerprints(self,removed,added):
+        """sorted fingerprint array without removed and with added"""
+        fingerprints=array('l',self.fingerprints)
+        for fingerprint in removed:
+            pos=bisect_left(fingerprints,fingerprint)
+            del fingerprints[pos]
+        for fingerprint in added:
+            pos=bisect_left(fingerprints,fingerprint)
+            fingerprints.insert(pos,fingerprint)
+        return fingerprints
+
+
 class AbstractDataset(object):
     
+    #the query key type (tools.QUERY_*) this dataset can match, zones only ask matching datasets. None: all types
+    keytype=QUERY_NAME
+    
     def __init__(self,filename):
         self.filename=filename
         #reload start time
@@ -89,15 +396,46 @@ class AbstractDataset(object):
         
         #reload info stats
         self.reloading=False
+        #tuple (loadtime, record count, record count difference, lines applied incrementally, gc pause after the reload)
         self.lastreloadinfo=None
         self.reload_check_interval=60 #how often do we check for reloads - set by the -c option
         
+        #incremented whenever the served data changes, used to invalidate cached answers
+        self.generation=0
+        
         #first time
         self.available=False
         self.defaults=None
+        self.txttemplates=TxtTemplates(None)
+        #interned records of the running reload
+        self.recordtable=None
+        
+        #write a snapshot of the index after parsing the source, see snapshot.py
+        self.snapshots=False
+        self.loadedsnapshot=False
+        
+        #incremental reloads: keep fingerprints of the parsed lines and apply only the changed ones
+        self.incremental=False
+        #fall back to a full reload if more than this fraction of the lines changed
+        self.incremental_limit=0.05
+        self.sourcestate=None
+        #sha1 of the source the loaded data was built from
+        self.sourcedigest=None
+        
+        #full reloads parse in a forked child which hands the index over as a snapshot
+        self.reload_subprocess=False
+        
+        #parse files of at least parallel_minsize bytes in this many processes, see parallel.py
+        self.parseprocesses=0
+        self.parallel_minsize=16*1024*1024
 
         self._tempsoa=None
         self._tempns=[]
+        
+        #called with the dataset after every reload, zones publish their next generation from it
+        self.reload_listeners=[]
+        #a reload was requested and has not run yet
+        self.reloadqueued=False
 
   
     @property
@@ -112,69 +450,57 @@ class AbstractDataset(object):
     def nsttl(self):
         return self.defaults.nsttl
         
-    def start_autoreloader(self):
-        thread.start_new_thread(self._autoreload, ())
-    
-    
     def shutdown(self):
         self.stay_alive=False
     
-    def _autoreload(self):
-        while self.stay_alive:
-            if self.has_changed():
-                logging.getLogger().info("%s has changed - reloading"%self.filename)
-                self.reload()
-            time.sleep(self.reload_check_interval)
+    def add_reload_listener(self,callback):
+        self.reload_listeners.append(callback)
+    
+    def queue_reload(self):
+        """mark a reload that was handed to a background thread, see Zone.dataset_reloaded"""
+        self.reloadqueued=True
+    
+    def _reloaded(self):
+        self.reloadqueued=False
+        for callback in self.reload_listeners:
+            try:
+                callback(self)
+            except Exception:
+                logging.getLogger().error("reload listener of %s failed: %s"%(self.filename,traceback.format_exc()))
+    
+    def frozen_view(self):
+        """a copy answering queries from the data loaded right now. reloads replace the index and defaults
+        attributes instead of changing them in place, so the copy is not affected by later reloads"""
+        return copy.copy(self)
+    
+    def after_fork(self):
+        """called in a forked worker process before it starts its own threads"""
+        #the lock might have been held by a parent thread at fork time
+        self._reload_lock=Lock()
+        if self.reloading:
+            #the parent was in the middle of a reload, make sure we load the new data ourselves
+            self.reloading=False
+            self.last_reload=0
     
     def apply_txt_template(self,template,question,result,defaults):
         """query time txt template"""
-        origtemplate=template
-        if defaults.basetxttemplate!=None:
-            if template!=None and len(template)>0 and template[0]=='=':
-                #special case.. disable basetemplate in the record with leading =
-                template=template[1:]
-            else:
-                template=defaults.basetxttemplate
-            
-        if template==None:
-            return None
-        templen=len(template)
-        outbuf=""
-        i=0
-        while i < templen:
-            c=template[i]
-            n=None
-            if i<templen-1:
-                n=template[i+1]
-            if c=='$':
-                if n=='$':
-                    outbuf+='$'
-                    i+=2
-                    continue
-                elif n!=None and n in string.digits:
-                    varindex=int(n)
-                    if defaults.variables[varindex]!=None:
-                        outbuf+=defaults.variables[varindex]
-                    i+=2
-                    continue
-                elif n=='=' and defaults.basetxttemplate!=None:
-                    #base template
-                    #assert False,"%s %s %s %s %s"%(template,c,n,outbuf,origtemplate)
-                    if origtemplate!=None:
-                        outbuf+=origtemplate
-                    else:
-                        #assert False,question
-                        outbuf+=question
-                    i+=2
-                    continue
-                else:
-                    outbuf+=question    
-                    i+=1
-                    continue
-                    
-            outbuf+=c        
-            i+=1
-        return outbuf
+        templates=self.txttemplates
+        if templates.defaults is not defaults:
+            #only happens for the few queries that run while a reload swaps the defaults
+            templates=TxtTemplates(defaults)
+        return templates.render(template,question)
+    
+    def apply_txt_template_ip4(self,template,ip,result,defaults):
+        """query time txt template of an ipv4 query given as integer"""
+        templates=self.txttemplates
+        if templates.defaults is not defaults:
+            templates=TxtTemplates(defaults)
+        return templates.render_ip4(template,ip)
+    
+    def get_txt_templates(self):
+        """txt templates used by the loaded records, compiled right after a reload.
+        templates not returned here are compiled on their first use"""
+        return []
             
     
     def reload(self):
@@ -182,62 +508,78 @@ class AbstractDataset(object):
         if not gotlock:
             logging.getLogger().warning("%s is already being reloaded - skipping"%self.filename)
             return
-        
+        try:
+            self.reloadqueued=False
+            self._reload()
+        finally:
+            #a failed reload must not block all later ones
+            self.reloading=False
+            self._reload_lock.release()
+            self._reloaded()
+    
+    def _reload(self):
         oldcount=self.get_record_count()
         starttime=time.time()
         self.reloading=True
         
+        #no collections while the new index is built, see gccontrol.py
+        gccontrol.collector.build_started()
+        try:
+            self.last_reload=time.time()
+            incremental=0
+            defaults=None
+            if self.sourcestate!=None:
+                incremental=self.reload_incremental()
+                if incremental!=None:
+                    defaults=self.defaults
+                else:
+                    incremental=0
+            if defaults==None and self.snapshots:
+                defaults=self.load_snapshot()
+                if defaults!=None:
+                    #the fingerprints of the last parse don't describe this index, the next reload parses again
+                    self.sourcestate=None
+            #the fingerprints an incremental reload needs would stay in the child, parse those datasets here
+            if defaults==None and self.reload_subprocess and self.supports_snapshot() and not (self.incremental and self.supports_incremental()):
+                defaults=self.reload_in_subprocess()
+                if defaults!=None:
+                    self.sourcestate=None
+            if defaults==None:
+                self.loadedsnapshot=False
+                defaults=ReloadDefaults()
+                source=stat_source(self.filename)
+                self.recordtable={}
+                self.reload_start(defaults)
+                source.digest=self.parse_source(defaults)
+                self.sourcedigest=source.digest
+                self.reload_end(defaults)
+                self.recordtable=None
+                if self.sourcestate!=None:
+                    self.sourcestate.uniquekeys=self.key_count()==self.sourcestate.linecount
+                if self.snapshots:
+                    self.write_snapshot(source,defaults)
         
-        defaults=ReloadDefaults()
-        self.reload_start(defaults)
-        self.last_reload=time.time()
-        for line in open(self.filename,'r'):
-            line=line.strip()
-            if line=='':
-                continue
-            
-            if line.startswith('$'):
-                self.parse_special(line[1:],defaults)
-                continue
-            
-            if line.startswith('#$') or line.startswith(';#') or line.startswith(':$'):
-                self.parse_special(line[2:],defaults)
-                continue
-            
-            if line.startswith(':'):
-                self.parse_defaultval(line[1:],defaults)
-                continue
-            
-            if line.startswith('#'):
-                continue
-            
-            #remove comments
-            if '#' in line:
-                line=line[:line.find('#')]
-                
-            if ';' in line:
-                line=line[:line.find(';')]
-            
-            try:
-                self.reload_line(line,defaults)
-            except Exception:
-                import traceback
-                logging.getLogger().error("Error parsing line '%s'"%line)
-                logging.getLogger().error(traceback.format_exc())
-
-        self.reload_end(defaults)
-        self.defaults=defaults
-        self.reloading=False
-        self.available=True
+            templates=TxtTemplates(defaults)
+            templates.compile(defaults.txttemplate)
+            for template in self.get_txt_templates():
+                templates.compile(template)
+            self.defaults=defaults
+            self.txttemplates=templates
+            self.generation+=1
+            self.reloading=False
+            self.available=True
+        except:
+            gccontrol.collector.build_finished()
+            raise
+        gctime=gccontrol.collector.build_finished()
         self.activesince=time.time()
         newcount=self.get_record_count()
         loadtime=time.time()-starttime
         diff=newcount-oldcount
         
-        recspersec=newcount/loadtime
-        self.lastreloadinfo=(loadtime,newcount,diff)
-        logging.getLogger().debug("Dataset(%s) reloaded in %.2fs, %s records (%s), %.2f records/sec"%(self.filename,loadtime,newcount,diff,recspersec))
-        self._reload_lock.release()
+        recspersec=newcount/max(loadtime,0.001)
+        self.lastreloadinfo=(loadtime,newcount,diff,incremental,gctime)
+        logging.getLogger().debug("Dataset(%s) reloaded in %.2fs, %s records (%s, %s lines applied incrementally), %.2f records/sec, %.1fms gc"%(self.filename,loadtime,newcount,diff,incremental,recspersec,gctime*1000))
 
 
     def parse_special(self,line,defaults):
@@ -346,16 +688,21 @@ class AbstractDataset(object):
     
     def create_default_datarecord(self,line,defaults):
         value,a,txt=self.split_line(line, defaults.atemplate, defaults.txttemplate)
-        data={
-              'A':a,
-              'TXT':txt,
-              'excluded':False,
-              'TTL':defaults.ttl,
-        }
+        excluded=False
         if value.startswith('!'):
             value=value[1:]
             value=value.lower()
-            data['excluded']=True
+            excluded=True
+        
+        #flyweight: all lines with the same values share one record
+        key=(a,txt,defaults.ttl,excluded)
+        table=self.recordtable
+        if table==None:
+            return value,Record(a,txt,defaults.ttl,excluded)
+        data=table.get(key)
+        if data==None:
+            data=Record(a,txt,defaults.ttl,excluded)
+            table[key]=data
         return value,data
     
         
@@ -377,6 +724,323 @@ class AbstractDataset(object):
             defaults.txttemplate=txtpart
         
     
+    def read_source(self,lines):
+        """classify source lines. yields tuples (kind, line), kind is one of 'special', 'default' or 'data'
+        comments and empty lines are skipped, the directive prefix is removed from special and default lines"""
+        for line in lines:
+            line=line.strip()
+            if line=='':
+                continue
+            
+            first=line[0]
+            if first in '$#;:':
+                if first=='$':
+                    yield 'special',line[1:]
+                    continue
+                
+                if line.startswith('#$') or line.startswith(';#') or line.startswith(':$'):
+                    yield 'special',line[2:]
+                    continue
+                
+                if first==':':
+                    yield 'default',line[1:]
+                    continue
+                
+                if first=='#':
+                    continue
+            
+            #remove comments
+            if '#' in line:
+                line=line[:line.find('#')]
+                
+            if ';' in line:
+                line=line[:line.find(';')]
+            
+            yield 'data',line
+    
+    def parse_source(self,defaults):
+        """run the text parser over the source file, returns the sha1 digest of the parsed data"""
+        sha=hashlib.sha1()
+        state=None
+        if self.incremental and self.supports_incremental():
+            state=SourceState(defaults)
+        elif self.parseprocesses>1 and self.supports_parallel() and os.path.getsize(self.filename)>=max(1,self.parallel_minsize):
+            self.sourcestate=None
+            digest=parse_parallel(self,defaults,self.parseprocesses)
+            if digest!=None:
+                return digest
+            #start over in this process
+            self.reload_start(defaults)
+        
+        for kind,line in self.read_source(_read_lines(self.filename,sha)):
+            if kind=='data':
+                if state!=None:
+                    state.add_line(line)
+                try:
+                    self.reload_line(line,defaults)
+                except Exception:
+                    import traceback
+                    logging.getLogger().error("Error parsing line '%s'"%line)
+                    logging.getLogger().error(traceback.format_exc())
+                continue
+            
+            if kind=='special':
+                self.parse_special(line,defaults)
+            else:
+                self.parse_defaultval(line,defaults)
+            if state!=None:
+                state.add_directive(kind,line,defaults)
+        
+        if state!=None:
+            state.finish()
+        self.sourcestate=state
+        return sha.digest()
+    
+    def reload_incremental(self):
+        """apply the lines that changed since the last reload to the live index
+        returns the number of changed lines or None if a full reload is required"""
+        oldstate=self.sourcestate
+        if oldstate==None or oldstate.duplicates or not self.supports_incremental():
+            return None
+        
+        source=stat_source(self.filename)
+        sha=hashlib.sha1()
+        state=SourceState(None)
+        oldprints=oldstate.fingerprints
+        oldcount=len(oldprints)
+        seen=bytearray(oldcount)
+        added={}
+        for kind,line in self.read_source(_read_lines(self.filename,sha)):
+            if kind!='data':
+                state.add_directive(kind,line)
+                index=len(state.directives)-1
+                if index>=len(oldstate.directives) or oldstate.directives[index]!=(kind,line):
+                    logging.getLogger().debug("%s: defaults changed - full reload"%self.filename)
+                    return None
+                continue
+            
+            fingerprint=state.add_line(line)
+            pos=bisect_left(oldprints,fingerprint)
+            if pos<oldcount and oldprints[pos]==fingerprint:
+                if seen[pos]:
+                    state.duplicates=True
+                seen[pos]=1
+            else:
+                if fingerprint in added:
+                    state.duplicates=True
+                added[fingerprint]=(len(state.directives),line)
+        if len(state.directives)!=len(oldstate.directives):
+            logging.getLogger().debug("%s: defaults changed - full reload"%self.filename)
+            return None
+        if state.duplicates:
+            logging.getLogger().debug("%s: duplicate lines - full reload"%self.filename)
+            return None
+        removed=set()
+        pos=seen.find('\0')
+        while pos>=0:
+            removed.add(oldprints[pos])
+            pos=seen.find('\0',pos+1)
+        
+        changecount=len(added)+len(removed)
+        if changecount>max(100,self.incremental_limit*state.linecount):
+            logging.getLogger().debug("%s: %s changed lines - full reload"%(self.filename,changecount))
+            return None
+        
+        state.finish(oldstate.updated_fingerprints(removed,added.keys()))
+        
+        #the removed lines come from our compressed copy of the previous source
+        removedkeys=set()
+        if removed:
+            oldlines=oldstate.lines_at([oldstate.order.index(fingerprint) for fingerprint in removed])
+            for line in oldlines.itervalues():
+                removedkeys.add(self.incremental_key(line))
+        
+        addedkeys={}
+        rescan=not oldstate.uniquekeys
+        for ctx,line in added.values():
+            key=self.incremental_key(line)
+            if key in addedkeys:
+                rescan=True
+            addedkeys[key]=(ctx,line)
+        for key in addedkeys:
+            if key not in removedkeys and self.has_key(key):
+                #now listed twice, the order of the two lines decides
+                rescan=True
+        addedkeys.pop(None,None)
+        removedkeys.discard(None)
+        
+        changes=dict.fromkeys(removedkeys)
+        if rescan:
+            #the last line of the new source with an affected key wins, like in a full reload
+            changes.update(dict.fromkeys(addedkeys))
+            for ctx,line in state.iter_lines():
+                key=self.incremental_key(line)
+                if key in changes:
+                    changes[key]=(ctx,line)
+        else:
+            changes.update(addedkeys)
+        
+        self.recordtable={}
+        self.apply_changes(changes,oldstate.contexts,state.linecount)
+        self.recordtable=None
+        state.uniquekeys=self.key_count()==state.linecount
+        
+        state.contexts=oldstate.contexts
+        self.sourcestate=state
+        source.digest=sha.digest()
+        self.sourcedigest=source.digest
+        
+        if self.snapshots:
+            self.write_snapshot(source,self.defaults)
+        return changecount
+    
+    def supports_incremental(self):
+        """true if this dataset implements incremental_key, has_key, key_count and apply_changes"""
+        return False
+    
+    def supports_parallel(self):
+        """true if this dataset implements chunk_result and merge_chunk"""
+        return False
+    
+    def parse_chunk(self,source,segments,contexts):
+        """parse byte ranges of the source in a parallel parser process, returns chunk_result()
+        source: the mapped source file
+        segments: list of (start,end,context index), the ranges contain no special or default lines
+        contexts: dict context index -> reload defaults"""
+        self.recordtable={}
+        self.reload_start(contexts[segments[0][2]])
+        for start,end,index in segments:
+            defaults=contexts[index]
+            for kind,line in self.read_source(source[start:end].split('\n')):
+                try:
+                    self.reload_line(line,defaults)
+                except Exception:
+                    logging.getLogger().error("Error parsing line '%s'"%line)
+                    logging.getLogger().error(traceback.format_exc())
+        self.recordtable=None
+        return self.chunk_result()
+    
+    def chunk_result(self):
+        """the temp storage filled by reload_line in a compact picklable form"""
+        return None
+    
+    def merge_chunk(self,result):
+        """add a chunk_result to the temp storage of the running reload, chunks are merged in file order"""
+        pass
+    
+    def intern_record(self,data):
+        """the record of the running reload with the same values as data"""
+        key=(data.A,data.TXT,data.TTL,data.excluded)
+        return self.recordtable.setdefault(key,data)
+    
+    def has_key(self,key):
+        """true if a line for key is loaded"""
+        return False
+    
+    def key_count(self):
+        """number of distinct keys loaded"""
+        return 0
+    
+    def incremental_key(self,line):
+        """the key a data line defines, lines with the same key replace each other"""
+        return None
+    
+    def apply_changes(self,changes,contexts,linecount):
+        """apply an incremental reload to the live index
+        changes: dict key -> (context index, line) of the line now defining the key or None if the key is gone
+        contexts: reload defaults for each context index
+        linecount: number of data lines in the source"""
+        pass
+    
+    def load_snapshot(self):
+        """restore the index from a valid snapshot file. returns the reload defaults or None if the source must be parsed"""
+        try:
+            snapshot=read_snapshot(self.filename,self.__class__.__name__)
+        except Exception:
+            logging.getLogger().warning("could not read snapshot of %s: %s"%(self.filename,traceback.format_exc()))
+            return None
+        if snapshot==None:
+            return None
+        arrays,state,defaults,digest=snapshot
+        self.restore_snapshot(arrays,state)
+        self.sourcedigest=digest
+        self.loadedsnapshot=True
+        logging.getLogger().info("loaded %s from snapshot"%self.filename)
+        return defaults
+    
+    def reload_in_subprocess(self):
+        """parse the source in a forked child which writes a snapshot, then map that snapshot.
+        building the index does not hold our GIL or allocate in this process.
+        returns the reload defaults or None if the source must be parsed here"""
+        for attempt in range(3):
+            pid=os.fork()
+            if pid==0:
+                exitcode=1
+                try:
+                    reset_logging_locks()
+                    defaults=ReloadDefaults()
+                    source=stat_source(self.filename)
+                    self.recordtable={}
+                    self.reload_start(defaults)
+                    source.digest=self.parse_source(defaults)
+                    self.reload_end(defaults)
+                    arrays,state=self.snapshot_data()
+                    write_snapshot(self.filename,source,self.__class__.__name__,arrays,state,defaults)
+                    exitcode=0
+                except:
+                    logging.getLogger().error("reload process for %s failed: %s"%(self.filename,traceback.format_exc()))
+                os._exit(exitcode)
+            
+            while True:
+                try:
+                    status=os.waitpid(pid,0)[1]
+                    break
+                except OSError,e:
+                    if e.errno!=errno.EINTR:
+                        raise
+            if status!=0:
+                logging.getLogger().warning("reload process for %s exited with status %s - parsing in process"%(self.filename,status))
+                return None
+            defaults=self.load_snapshot()
+            if defaults!=None:
+                return defaults
+            #the source changed again while the child was parsing
+        return None
+    
+    def supports_snapshot(self):
+        """true if snapshot_data returns the index"""
+        return False
+    
+    def write_snapshot(self,source,defaults):
+        data=self.snapshot_data()
+        if data==None:
+            return
+        arrays,state=data
+        try:
+            path=write_snapshot(self.filename,source,self.__class__.__name__,arrays,state,defaults)
+            logging.getLogger().debug("wrote snapshot %s"%path)
+        except Exception:
+            logging.getLogger().warning("could not write snapshot of %s: %s"%(self.filename,traceback.format_exc()))
+    
+    def check_reload(self):
+        """reload if the content of the source file changed. returns True if a reload was done
+        a file that was only touched or rewritten with the same data is not parsed again"""
+        if self.available and self.sourcedigest!=None:
+            try:
+                digest=hash_source(self.filename)
+            except (IOError,OSError),e:
+                logging.getLogger().warning("could not read %s: %s"%(self.filename,e))
+                self._reloaded()
+                return False
+            if digest==self.sourcedigest:
+                logging.getLogger().debug("%s was modified but its content is unchanged - not reloading"%self.filename)
+                self.last_reload=time.time()
+                self._reloaded()
+                return False
+        logging.getLogger().info("%s has changed - reloading"%self.filename)
+        self.reload()
+        return True
+    
     def has_changed(self):
         lastreload=self.last_reload
         statinfo=os.stat(self.filename)
@@ -398,6 +1062,16 @@ class AbstractDataset(object):
         """move the temp storage to the real deal and clean up"""
         pass
     
+    def snapshot_data(self):
+        """return a tuple (arrays, state) with the loaded index for a snapshot or None if snapshots are not supported
+        arrays: list of array('I') or array('i'), restored as ctypes arrays which support len, indexing and bisect
+        state: anything picklable"""
+        return None
+    
+    def restore_snapshot(self,arrays,state):
+        """install the index saved by snapshot_data"""
+        pass
+    
     def get_record_count(self):
         return 0
     
@@ -408,6 +1082,10 @@ class AbstractDataset(object):
     def get(self,query):
         return None
     
+    def get_ip4(self,ip,query):
+        """lookup of a classified ipv4 query, ip is the address as integer and query the reversed labels"""
+        return self.get(query)
+    
     def apply_config(self,config):
         """additional config options from file"""
         pass
@@ -419,35 +1097,53 @@ class TrivialSet(AbstractDataset):
     where each entry uses the same default A+TXT template. 
     This dataset uses only half a memory for the same list of IP addresses compared to ip4set. """
     
+    keytype=QUERY_IP4
     
     def __init__(self,filename):
         AbstractDataset.__init__(self,filename)
-        self.backend=[]
+        #sorted, deduplicated ip addresses as 32 bit integers
+        self.backend=array('I')
         self.nodecount=0
         
         #reload
-        self.tmpbackend=[]
+        self.tmpbackend=None
         self.tmpcount=0
         
-        #fixed values
+        #fixed values, set once per reload
         self.atemplate='127.0.0.2'
         self.txttemplate=None
+        #tuple (record,txtdynamic), txtdynamic is true if the TXT answer depends on the query
+        self.answer=(Record(self.atemplate,None,None),False)
         
     def reload_start(self,defaults):
-        self.tmpbackend=[]
+        self.tmpbackend=array('I')
         self.tmpcount=0
         
     
     def reload_line(self,line,defaults):
         lineparts=line.split()
         value=lineparts[0]
-        self.tmpbackend.append(value)
+        #raises on anything that is not an ip address, reload() logs the line
+        self.tmpbackend.append(ip2long(value))
         self.tmpcount+=1
-        #todo: check if linepart is an ip...
     
     def reload_end(self,defaults):
         self.atemplate=defaults.atemplate
-        self.backend=self.tmpbackend
+        self.txttemplate=defaults.txttemplate
+        
+        txtdynamic=False
+        for template in (self.txttemplate,defaults.basetxttemplate):
+            if template!=None and '$' in template:
+                txtdynamic=True
+        txt=None
+        if not txtdynamic:
+            #no substitutions, the answer is the same for every listed address
+            txt=self.apply_txt_template(self.txttemplate, '', self.atemplate, defaults)
+        record=Record(self.atemplate,txt,defaults.ttl)
+        
+        backend=array('I',sorted(set(self.tmpbackend)))
+        self.backend=backend
+        self.answer=(record,txtdynamic)
         self.nodecount=self.tmpcount
         self.tmpbackend=None
         self.tmpcount=0    
@@ -455,16 +1151,79 @@ class TrivialSet(AbstractDataset):
     def get_record_count(self):
         return self.nodecount
     
+    def get_txt_templates(self):
+        return [self.txttemplate]
+    
+    def supports_snapshot(self):
+        return True
+    
+    def snapshot_data(self):
+        return [self.backend],(self.atemplate,self.txttemplate,self.answer,self.nodecount)
+    
+    def supports_parallel(self):
+        return True
+    
+    def chunk_result(self):
+        return self.tmpbackend.tostring(),self.tmpcount
+    
+    def merge_chunk(self,result):
+        data,count=result
+        self.tmpbackend.fromstring(data)
+        self.tmpcount+=count
+    
+    def supports_incremental(self):
+        return True
+    
+    def incremental_key(self,line):
+        try:
+            return ip2long(line.split()[0])
+        except Exception:
+            return None
+    
+    def has_key(self,key):
+        backend=self.backend
+        pos=bisect_left(backend,key)
+        return pos<len(backend) and backend[pos]==key
+    
+    def key_count(self):
+        return len(self.backend)
+    
+    def apply_changes(self,changes,contexts,linecount):
+        #copy, the current array might be a mapped snapshot and readers must never see a half updated array
+        backend=array('I',self.backend)
+        for key,change in changes.iteritems():
+            pos=bisect_left(backend,key)
+            listed=pos<len(backend) and backend[pos]==key
+            if change==None and listed:
+                del backend[pos]
+            elif change!=None and not listed:
+                backend.insert(pos,key)
+        self.backend=backend
+        self.nodecount=linecount
+    
+    def restore_snapshot(self,arrays,state):
+        self.atemplate,self.txttemplate,self.answer,self.nodecount=state
+        self.backend=arrays[0]
+    
     def get(self,query):
-        query=ipreverse(query)
-        if query in self.backend:
-            rec={
-                 'A':self.atemplate,
-                 'TXT':self.apply_txt_template(self.txttemplate, query, self.atemplate, self.defaults),
-            }
-            return rec
+        q=parse_ip4_query(query)
+        if q==None:
+            return None
+        return self.get_ip4(q,query)
+    
+    def get_ip4(self,q,query):
+        backend=self.backend
+        pos=bisect_left(backend,q)
+        if pos==len(backend) or backend[pos]!=q:
+            return None
+        record,txtdynamic=self.answer
+        if not txtdynamic:
+            return record
+        return record.with_txt(self.apply_txt_template_ip4(self.txttemplate, q, self.atemplate, self.defaults))
 
 class RadixTrieSet(AbstractDataset):
+    keytype=QUERY_IP4
+    
     def __init__(self,filename):
         if not RADIX_AVAILABLE:
             raise Exception("radix library not available - TrieSet is not available")
@@ -503,23 +1262,27 @@ class RadixTrieSet(AbstractDataset):
         return self.nodecount
     
     def get(self,query):
-        query=ipreverse(query)
-        res=self.rtree.search_best(query)
+        q=parse_ip4_query(query)
+        if q==None:
+            return None
+        return self.get_ip4(q,query)
+    
+    def get_ip4(self,q,query):
+        res=self.rtree.search_best(packed=long2packed(q))
         if res==None:
             return None
         data=res.data['content']
-        if data['excluded']:
+        if data.excluded:
             return None
-            
-        if 'TXT' in data:
-            data['TXT']=self.apply_txt_template(data['TXT'], query, data['A'], self.defaults)
-        return data
+        return data.with_txt(self.apply_txt_template_ip4(data.TXT, q, data.A, self.defaults))
 
 from intervaltree import IntervalTree,Interval
 
 
 
 class IntervalTreeSet(AbstractDataset):
+    keytype=QUERY_IP4
+    
     def __init__(self,filename):
         AbstractDataset.__init__(self,filename)
         self.backend=IntervalTree([])
@@ -564,24 +1327,202 @@ class IntervalTreeSet(AbstractDataset):
         return self.nodecount
 
     def get(self,query):
-        query=ipreverse(query)
-        q=ip2long(query)
+        q=parse_ip4_query(query)
+        if q==None:
+            return None
+        return self.get_ip4(q,query)
+    
+    def get_ip4(self,q,query):
         res=self.backend.search(q)
         for r in res:
-            try:
-                if r.data['excluded']:
-                    return None
-            except KeyError:
-                continue
+            if r.data.excluded:
+                return None
         
         #no exclusions, return first match
         if len(res)>0:
             data=res[0].data
-            if 'TXT' in data:
-                data['TXT']=self.apply_txt_template(data['TXT'], query, data['A'], self.defaults)
-            return data
+            return data.with_txt(self.apply_txt_template_ip4(data.TXT, q, data.A, self.defaults))
+        
+class SortedArraySet(AbstractDataset):
+    """ip4set stored as flat sorted segments
+    
+    At reload_end all ranges are flattened into non overlapping segments. starts holds the first address of each 
+    segment, values the index of the record listed for it (-1: not listed or excluded). 
+    A lookup is a single bisect. Exclusions win over listings, otherwise the first matching line of the file is returned.
+    """
+    
+    keytype=QUERY_IP4
+    
+    def __init__(self,filename):
+        AbstractDataset.__init__(self,filename)
+        #tuple (starts,values,records), swapped as a whole on reload
+        self.index=(array('I'),array('i'),[])
+        self.nodecount=0
+    
+        #reload
+        self.tmpranges=None
+        self.tmprecords=None
+        self.tmprecordindex=None
+        self.tmpcount=0
+    
+    def reload_start(self,defaults):
+        self.tmpranges=[]
+        self.tmprecords=[]
+        self.tmprecordindex={}
+        self.tmpcount=0
+    
+    def reload_line(self,line,defaults):
+        value,data=self.create_default_datarecord(line, defaults)
+        lower,upper=ip4range(value)
+        lowerlong=ip2long(lower)
+        upperlong=ip2long(upper)
+        
+        if defaults.maxrange4!=None and upperlong-lowerlong>defaults.maxrange4:
+            logging.warn("MAXRANGE4 prohobits adding %s in %s"%(value,self.filename))
+            return
         
+        if data.excluded:
+            recordnum=-1
+        else:
+            #records are interned, the record itself is the key
+            recordnum=self.tmprecordindex.get(data)
+            if recordnum==None:
+                recordnum=len(self.tmprecords)
+                self.tmprecords.append(data)
+                self.tmprecordindex[data]=recordnum
+        self.tmpranges.append((lowerlong,upperlong,recordnum))
+        self.tmpcount+=1
+    
+    def reload_end(self,defaults):
+        starts,values=build_segments(self.tmpranges)
+        self.index=(starts,values,self.tmprecords)
+        self.nodecount=self.tmpcount
+        self.tmpranges=None
+        self.tmprecords=None
+        self.tmprecordindex=None
+        self.tmpcount=0
+    
+    def get_record_count(self):
+        return self.nodecount
+    
+    def get_txt_templates(self):
+        starts,values,records=self.index
+        return [data.TXT for data in records]
+    
+    def supports_snapshot(self):
+        return True
+    
+    def snapshot_data(self):
+        starts,values,records=self.index
+        return [starts,values],(records,self.nodecount)
+    
+    def supports_parallel(self):
+        return True
+    
+    def chunk_result(self):
+        lowers=array('I',imap(operator.itemgetter(0),self.tmpranges))
+        uppers=array('I',imap(operator.itemgetter(1),self.tmpranges))
+        recordnums=array('i',imap(operator.itemgetter(2),self.tmpranges))
+        return lowers.tostring(),uppers.tostring(),recordnums.tostring(),self.tmprecords,self.tmpcount
+    
+    def merge_chunk(self,result):
+        lowers,uppers,recordnums,records,count=result
+        #chunk record number -> record number of the merged index
+        mapping={-1:-1}
+        for localnum,data in enumerate(records):
+            data=self.intern_record(data)
+            recordnum=self.tmprecordindex.get(data)
+            if recordnum==None:
+                recordnum=len(self.tmprecords)
+                self.tmprecords.append(data)
+                self.tmprecordindex[data]=recordnum
+            mapping[localnum]=recordnum
+        recordnums=imap(mapping.__getitem__,array('i',recordnums))
+        self.tmpranges.extend(izip(array('I',lowers),array('I',uppers),recordnums))
+        self.tmpcount+=count
+    
+    def restore_snapshot(self,arrays,state):
+        records,nodecount=state
+        self.index=(arrays[0],arrays[1],records)
+        self.nodecount=nodecount
+    
+    def get(self,query):
+        q=parse_ip4_query(query)
+        if q==None:
+            return None
+        return self.get_ip4(q,query)
+    
+    def get_ip4(self,q,query):
+        starts,values,records=self.index
+        pos=bisect_right(starts,q)-1
+        if pos<0:
+            return None
+        recordnum=values[pos]
+        if recordnum<0:
+            return None
+        data=records[recordnum]
+        return data.with_txt(self.apply_txt_template_ip4(data.TXT, q, data.A, self.defaults))
+
+
+def build_segments(ranges):
+    """flatten ranges into non overlapping segments
+    ranges: list of tuples (lower,upper,recordnum) in file order, recordnum -1 marks an exclusion
+    returns (starts,values): values[i] applies from starts[i] up to starts[i+1]-1, -1 means nothing is listed
+    """
+    boundaries=set()
+    for lower,upper,recordnum in ranges:
+        boundaries.add(lower)
+        if upper<0xFFFFFFFF:
+            boundaries.add(upper+1)
+    
+    #ranges sorted by lower bound, keeping the file order as tie breaker
+    order=sorted(xrange(len(ranges)),key=lambda i:ranges[i][0])
+    
+    starts=array('I')
+    values=array('i')
+    active=[] #heap of (file order, upper, recordnum) of listings covering the current boundary
+    excludedupto=-1 #highest upper bound of all exclusions started so far
+    nextrange=0
+    rangecount=len(order)
+    last=None
+    for boundary in sorted(boundaries):
+        while nextrange<rangecount and ranges[order[nextrange]][0]<=boundary:
+            lineno=order[nextrange]
+            lower,upper,recordnum=ranges[lineno]
+            if recordnum<0:
+                if upper>excludedupto:
+                    excludedupto=upper
+            else:
+                heappush(active,(lineno,upper,recordnum))
+            nextrange+=1
+        
+        if excludedupto>=boundary:
+            value=-1
+        else:
+            while active and active[0][1]<boundary:
+                heappop(active)
+            if active:
+                value=active[0][2]
+            else:
+                value=-1
+        
+        if value!=last:
+            starts.append(boundary)
+            values.append(value)
+            last=value
+    return starts,values
+
+def wildcard_labels(key):
+    """number of labels of the domain covered by a wildcard key, None for a plain name
+    '*.example.com' covers the subdomains of example.com, '.example.com' example.com and its subdomains"""
+    if key[:1]=='.' or key[:2]=='*.':
+        return key.count('.')
+    return None
+
 class DNSet(AbstractDataset):
+    #label counts of the domains with wildcard entries, longest first
+    wildcards=()
+    
     def __init__(self,filename):
         AbstractDataset.__init__(self,filename)
         self.backend={}
@@ -590,46 +1531,217 @@ class DNSet(AbstractDataset):
         #reload
         self.tmpbackend={}
         self.tmpcount=0
+        self.tmpwildcards=set()
         
     def reload_start(self,defaults):
         self.tmpbackend={}
         self.tmpcount=0
+        self.tmpwildcards=set()
         
     
     def reload_line(self,line,defaults):
         value,data=self.create_default_datarecord(line, defaults)
         value=value.lower()
-        #TODO: wildcard... 
+        #wildcards are stored under their own key, get() looks them up by suffix
+        labels=wildcard_labels(value)
+        if labels!=None:
+            self.tmpwildcards.add(labels)
         self.tmpbackend[value]=data
         self.tmpcount+=1
     
     def reload_end(self,defaults):
         self.backend=self.tmpbackend
         self.nodecount=self.tmpcount
+        self.wildcards=tuple(sorted(self.tmpwildcards,reverse=True))
         self.tmpbackend=None
         self.tmpcount=0    
+        self.tmpwildcards=set()
 
     def get_record_count(self):
         return self.nodecount
     
+    def supports_snapshot(self):
+        return True
+    
+    def snapshot_data(self):
+        records=[]
+        recordindex={}
+        items=[]
+        for key,data in self.backend.iteritems():
+            recordnum=recordindex.get(data)
+            if recordnum==None:
+                recordnum=len(records)
+                records.append(data)
+                recordindex[data]=recordnum
+            items.append((key,recordnum))
+        return list(build_flat_table(items)),(records,self.nodecount,self.wildcards)
+    
+    def supports_parallel(self):
+        return True
+    
+    def chunk_result(self):
+        records=[]
+        recordindex={}
+        recordnums=array('i')
+        for data in self.tmpbackend.itervalues():
+            recordnum=recordindex.get(data)
+            if recordnum==None:
+                recordnum=len(records)
+                records.append(data)
+                recordindex[data]=recordnum
+            recordnums.append(recordnum)
+        return '\n'.join(self.tmpbackend.iterkeys()),recordnums.tostring(),records,self.tmpcount,self.tmpwildcards
+    
+    def merge_chunk(self,result):
+        keys,recordnums,records,count,wildcards=result
+        if keys:
+            records=[self.intern_record(data) for data in records]
+            self.tmpbackend.update(izip(keys.split('\n'),imap(records.__getitem__,array('i',recordnums))))
+        self.tmpcount+=count
+        self.tmpwildcards.update(wildcards)
+    
+    def supports_incremental(self):
+        return True
+    
+    def incremental_key(self,line):
+        value=line.split(None,1)[0]
+        if value.startswith('!'):
+            value=value[1:]
+        return value.lower()
+    
+    def has_key(self,key):
+        return key in self.backend
+    
+    def key_count(self):
+        return len(self.backend)
+    
+    def apply_changes(self,changes,contexts,linecount):
+        #changes go to a new overlay on top of the current dict (or mapped snapshot), published zone
+        #generations keep using the view they have
+        backend=self.backend
+        if not isinstance(backend,OverlayView):
+            backend=OverlayView(backend)
+        overlay={}
+        count=len(backend)
+        #a removed wildcard only leaves an unneeded lookup behind, the next full reload drops it
+        wildcards=set(self.wildcards)
+        for key,change in changes.iteritems():
+            if change==None:
+                if key in backend:
+                    overlay[key]=DELETED
+                    count-=1
+                continue
+            ctx,line=change
+            try:
+                value,data=self.create_default_datarecord(line,contexts[ctx])
+            except Exception:
+                logging.getLogger().error("Error parsing line '%s'"%line)
+                continue
+            if key not in backend:
+                count+=1
+            overlay[key]=data
+            labels=wildcard_labels(key)
+            if labels!=None:
+                wildcards.add(labels)
+        self.backend=backend.updated(overlay,count)
+        self.wildcards=tuple(sorted(wildcards,reverse=True))
+        self.nodecount=linecount
+    
+    def restore_snapshot(self,arrays,state):
+        records,self.nodecount,self.wildcards=state
+        keys,offsets,values,slots=arrays
+        self.backend=FlatDict(keys,offsets,values,slots,records)
+    
     def get(self,question):
         question=question.lower()
-        #TODO: check wildcard
-        
-        try:
-            data=self.backend[question]
-            if 'excluded' in data and data['excluded']:
-                return None
+        data=self.backend.get(question)
+        if data==None and self.wildcards:
+            data=self.get_wildcard(question)
+        if data==None or ('excluded' in data and data['excluded']):
+            return None
+        return data
+    
+    def get_wildcard(self,question):
+        """the most specific wildcard entry covering question, excluded or not
+        only the label counts which have wildcards are tried, each with one or two lookups"""
+        backend=self.backend
+        labels=question.split('.')
+        count=len(labels)
+        for depth in self.wildcards:
+            if depth>count:
+                continue
+            if depth==count:
+                data=backend.get('.'+question)
             else:
+                suffix='.'.join(labels[count-depth:])
+                data=backend.get('*.'+suffix)
+                if data==None:
+                    data=backend.get('.'+suffix)
+            if data!=None:
                 return data
-        except:
-            return None
+        return None
+
+#first line of a fastlist datagram with several commands, see doc/fastlist-protocol.txt
+BATCHHEADER='#fastlist 2'
+#first line of a datagram with journal encoded records, forwarded to worker processes by replicas
+RECORDSHEADER='#fastlist records\n'
+#largest batch datagram we forward to worker processes
+MAXDATAGRAM=60000
+#largest fastlist ttl, rfc 2181
+MAXTTL=2147483647
 
 class UDPSocketSet(DNSet):
+    #fastlisted names are often reversed ips, the zone asks us for every query
+    keytype=None
+    
     def __init__(self,filename):
         DNSet.__init__(self,filename)
         del self.tmpbackend
         self.udpsocket=None
+        
+        #readers only see immutable snapshots, all changes are applied by one writer thread, see overlay.py
+        self.backend=OverlayView()
+        #changes of the running writer batch, name -> record or DELETED, and the number of names with them
+        self._staged={}
+        self._count=0
+        self._change=0
+        #maximum number of queued writes applied before the next snapshot is published
+        self.writebatch=1000
+        self._writequeue=Queue.Queue()
+        self._writer=None
+        self._writerlock=Lock()
+        
+        #optional bulk load listener on the same port
+        self.tcp=False
+        self.tcpsocket=None
+        #commands applied per lock acquisition during a bulk load
+        self.bulkbatch=1000
+        #seconds a bulk load connection may stay silent
+        self.bulktimeout=60
+        
+        #sockets of worker processes which get a copy of every fastlist packet
+        self.subscribers=[]
+        #False in worker processes, the parent process saves the zone
+        self.persistent=True
+        #False if an event loop reads our socket and runs expiry/persistence
+        self.threaded=True
+        
+        #expiry index: heap of (expires, sequence, name, record). entries of delisted or relisted names are 
+        #left in place and skipped when they come up
+        self.expiryheap=[]
+        self._expiryseq=0
+        #maximum number of records expired per lock acquisition
+        self.expirybatch=500
+        
+        #changes since the last saved zone, see journal.py
+        self.journal=None
+        #journal size which triggers a compaction before the regular one
+        self.compactsize=4*1024*1024
+        #seconds between compactions
+        self.compactinterval=60
+        
+        #replication to/from other nodes, see replication.py
+        self.replication=None
         logging.getLogger().info("initializing fastlist zone %s"%filename)
         
         self.listdefaults={
@@ -639,6 +1751,17 @@ class UDPSocketSet(DNSet):
             'expiration':12*3600,
         }
 
+    def supports_snapshot(self):
+        return False
+    
+    def frozen_view(self):
+        #every read already sees an immutable snapshot, zones use the live fastlist
+        return self
+    
+    def snapshot_data(self):
+        #fastlist data is persisted by save_zone
+        return None
+    
     def apply_config(self,config):
         bind,port=self.filename.split('/')
         port="%s"%port
@@ -654,6 +1777,18 @@ class UDPSocketSet(DNSet):
         if config.has_option(port,'expiration'):
             self.listdefaults['expiration']=config.getint(port,'expiration')
         
+        if config.has_option(port,'tcp'):
+            self.tcp=config.getboolean(port,'tcp')
+        
+        if config.has_option(port,'replication'):
+            peers=[]
+            if config.has_option(port,'replicationpeers'):
+                peers=[parse_address(peer) for peer in config.get(port,'replicationpeers').split(',') if peer.strip()]
+            primary=None
+            if config.has_option(port,'replicationprimary'):
+                primary=parse_address(config.get(port,'replicationprimary'))
+            self.replication=Replication(self,config.get(port,'replication'),parse_address(config.get(port,'replicationaddress')),peers,primary)
+        
         
         
 
@@ -682,82 +1817,295 @@ class UDPSocketSet(DNSet):
             self.load_zone()
             self.fastlist('test',dict(A=self.listdefaults['a_content'],excluded=False,ttl=3600))
 
-            self.lastreloadinfo=(0,len(self.backend),0)
-            self.start_threads()
+            self.lastreloadinfo=(0,len(self.backend),0,0,0)
+            if self.threaded:
+                self.start_threads()
+            if self.tcp:
+                self.start_bulkload_listener()
+            if self.replication!=None:
+                self.replication.start()
             self.available=True
             
             logging.getLogger().info("Fastlist UDP socket ready on %s/%s"%(bind,port))
     
-    def start_autoreloader(self):
-        """no op, just make sure the socket is initialized"""
-        self.reload()
-    
-    
     def start_threads(self):
         thread.start_new_thread(self.listen, ())
         thread.start_new_thread(self.expire, ())
-        thread.start_new_thread(self.save, ())
+        if self.persistent:
+            thread.start_new_thread(self.save, ())
+    
+    def add_subscriber(self,sock):
+        self.subscribers=self.subscribers+[sock]
+    
+    def remove_subscriber(self,sock):
+        self.subscribers=[s for s in self.subscribers if s!=sock]
+    
+    def forward(self,content):
+        """send a fastlist packet to all subscribers"""
+        for sock in self.subscribers:
+            try:
+                sock.send(content)
+            except socket.error,e:
+                logging.getLogger().warn("%s: could not forward fastlist packet: %s"%(self.filename,str(e)))
+    
+    def forward_commands(self,lines):
+        """send command lines to all subscribers, packed into batch datagrams"""
+        if not self.subscribers:
+            return
+        packet=[BATCHHEADER]
+        size=len(BATCHHEADER)
+        for line in lines:
+            if size+len(line)+1>MAXDATAGRAM and len(packet)>1:
+                self.forward('\n'.join(packet))
+                packet=[BATCHHEADER]
+                size=len(BATCHHEADER)
+            packet.append(line)
+            size+=len(line)+1
+        if len(packet)>1:
+            self.forward('\n'.join(packet))
+    
+    def forward_records(self,frames):
+        """send journal frames to all subscribers"""
+        if not self.subscribers:
+            return
+        for data in pack_frames(frames,MAXDATAGRAM-len(RECORDSHEADER)):
+            self.forward(RECORDSHEADER+data)
+    
+    def follow(self,sock):
+        """in a worker process: receive fastlist packets forwarded by the parent on sock instead of our own udp socket"""
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers=[]
+        if self.udpsocket!=None:
+            self.udpsocket.close()
+        if self.tcpsocket!=None:
+            #bulk loads are applied in the parent and forwarded as batch datagrams
+            self.tcpsocket.close()
+            self.tcpsocket=None
+        if self.replication!=None:
+            #so are replicated changes
+            self.replication.close()
+            self.replication=None
+        #the writer thread of the parent does not exist in this process, its lock and a batch it was
+        #applying at fork time are left behind. the parent forwards that batch once it is published
+        self._writequeue=Queue.Queue()
+        self._writer=None
+        self._writerlock=Lock()
+        self._staged={}
+        self._count=len(self.backend)
+        self.udpsocket=sock
+        self.persistent=False
+        if self.journal!=None:
+            #the parent writes the journal
+            self.journal.abandon()
+            self.journal=None
+        if self.threaded:
+            self.start_threads()
         
     def save(self):
+        lastsave=time.time()
         while self.stay_alive:
-            time.sleep(60)
-            self.save_zone()
+            time.sleep(1)
+            self.sync_journal()
+            if time.time()-lastsave>=self.compactinterval:
+                lastsave=time.time()
+                self.save_zone()
         
     def expire(self):
         try:
             while self.stay_alive:
-                time.sleep(20)
-                now=time.time()
-                self._reload_lock.acquire()
-                delcount=0
-                for key in self.backend.keys():
-                    data=self.backend[key]
-                    if 'expires' in data and now>data['expires']:
-                        logging.getLogger().info("expiring %s"%key)
-                        del self.backend[key]
-                        delcount+=1
-                self._reload_lock.release()
-                
-                if delcount>0:
-                    self.touch(-delcount)
+                time.sleep(1)
+                self.expire_once()
         except:
             logging.getLogger().error("fasthash expiration thread crashing: %s"%traceback.format_exc())
+    
+    def next_expiry(self):
+        """time the first entry of the expiry index is due, None if the index is empty"""
+        try:
+            return self.expiryheap[0][0]
+        except IndexError:
+            return None
+    
+    def start_writer(self):
+        self._writerlock.acquire()
+        try:
+            if self._writer==None:
+                self._writer=-1
+                thread.start_new_thread(self._write_loop, ())
+        finally:
+            self._writerlock.release()
+    
+    def stop_writer(self):
+        if self._writer!=None:
+            self.write(None)
+    
+    def write(self,func,*args):
+        """run func in the writer thread and wait for the snapshot with its changes, returns the result of func"""
+        if self._writer==thread.get_ident():
+            return func(*args)
+        if self._writer==None:
+            self.start_writer()
+        task=[func,args,Event(),None,None]
+        self._writequeue.put(task)
+        task[2].wait()
+        if task[4]!=None:
+            raise task[4][0],task[4][1],task[4][2]
+        return task[3]
+    
+    def _write_loop(self):
+        self._writer=thread.get_ident()
+        queue=self._writequeue
+        while True:
+            tasks=[queue.get()]
+            try:
+                while len(tasks)<self.writebatch:
+                    tasks.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
             
+            stop=False
+            for task in tasks:
+                func,args=task[0],task[1]
+                if func==None:
+                    stop=True
+                    continue
+                try:
+                    task[3]=func(*args)
+                except Exception:
+                    task[4]=sys.exc_info()
+            try:
+                self._publish()
+            except Exception:
+                logging.getLogger().error("%s: publishing changes failed: %s"%(self.filename,traceback.format_exc()))
+            for task in tasks:
+                task[2].set()
+            if stop:
+                self._writer=None
+                return
+    
+    def _current(self,name):
+        """record of name including the changes of the running batch, writer only"""
+        rec=self._staged.get(name)
+        if rec is DELETED:
+            return None
+        if rec!=None:
+            return rec
+        return self.backend.get(name)
     
+    def _stage(self,name,rec):
+        """set (rec=None: delete) name in the next snapshot, returns False if nothing changed. writer only"""
+        existed=self._current(name)!=None
+        if rec==None:
+            if not existed:
+                return False
+            self._staged[name]=DELETED
+            self._count-=1
+            self._change-=1
+            return True
+        self._staged[name]=rec
+        if not existed:
+            self._count+=1
+            self._change+=1
+        return True
+    
+    def _publish(self):
+        """make the changes of the running batch visible with one reference swap"""
+        if not self._staged:
+            return
+        staged=self._staged
+        change=self._change
+        self._staged={}
+        self._change=0
+        self.backend=self.backend.updated(staged,self._count)
+        self.touch(change)
+    
+    def _replace(self,backend):
+        """start from a new record dict, writer only"""
+        self._staged={}
+        self._change=0
+        self._count=len(backend)
+        self.backend=OverlayView(backend)
+        self.rebuild_expiry_index()
+    
+    def expire_once(self):
+        """remove all expired records, returns the number of removed records"""
+        delcount=0
+        now=time.time()
+        while True:
+            #nothing due: no queueing, no scan
+            due=self.next_expiry()
+            if due==None or due>=now:
+                break
+            delcount+=self.write(self._expire,now)
+        return delcount
+    
+    def _expire(self,now):
+        delcount=0
+        heap=self.expiryheap
+        for i in range(self.expirybatch):
+            if not heap or heap[0][0]>=now:
+                break
+            expires,seq,key,data=heappop(heap)
+            if self._current(key) is not data:
+                #delisted or relisted since
+                continue
+            logging.getLogger().info("expiring %s"%key)
+            self._stage(key,None)
+            if self.journal!=None:
+                self.journal.append(encode_delete(key))
+            delcount+=1
+        return delcount
+    
+    def _index_expiry(self,name,rec):
+        """add rec to the expiry index, writer only"""
+        expires=rec.get('expires')
+        if expires==None:
+            return
+        self._expiryseq+=1
+        heappush(self.expiryheap,(expires,self._expiryseq,name,rec))
+        if len(self.expiryheap)>2*self._count+1000:
+            #mostly stale entries of relisted names
+            self.rebuild_expiry_index()
+    
+    def rebuild_expiry_index(self):
+        """index all records, writer only"""
+        self._publish()
+        heap=[]
+        for seq,(name,rec) in enumerate(self.backend.iteritems()):
+            expires=rec.get('expires')
+            if expires!=None:
+                heap.append((expires,seq,name,rec))
+        heapify(heap)
+        self._expiryseq=len(heap)
+        self.expiryheap=heap
         
     def touch(self,change=1):
-        self.lastreloadinfo=(0,len(self.backend),change)
+        self.generation+=1
+        self.lastreloadinfo=(0,len(self.backend),change,0,0)
         self.last_reload=time.time()
         self.activesince=time.time()
     
     def fastlist(self,name,rec):
         try:
-            self._reload_lock.acquire()
-            self.backend[name]=rec
-            self._reload_lock.release()
-            self.touch()
+            self.write(self._apply,[('a',name,rec)])
             return rec
         except Exception,e:
-            logging.getLogger().warn("Fastlisting failed, possible deadlock: %s"%str(e))
+            logging.getLogger().warn("Fastlisting failed: %s"%str(e))
             return None   
         
     def delist(self,value): 
-        if value in self.backend:
-            try:
-                self._reload_lock.acquire()
-                del self.backend[value]
-                self._reload_lock.release()
+        try:
+            if self.write(self._apply,[('d',value,None)])[1]:
                 logging.getLogger().info("%s: de-listed %s"%(self.filename,value))
-                self.touch(-1)
-            except Exception,e:
-                logging.getLogger().warn("Fast-delisting of %s failed: %s"%(value,str(e))) 
-        else:
-            logging.getLogger().warn("Fast-delisting of %s failed: not found"%(value)) 
+            else:
+                logging.getLogger().warn("Fast-delisting of %s failed: not found"%(value)) 
+        except Exception,e:
+            logging.getLogger().warn("Fast-delisting of %s failed: %s"%(value,str(e))) 
             
                  
-    def handlepacket(self,content,ip):
+    def parse_command(self,content):
+        """one command line -> (action,name,record), record is None for deletes"""
         #<name> <a-content> <txt-content> <action> <ttl> <expiration>
-        logging.getLogger().debug("dbg packethandler(received) from %s: %s"%(ip,content))
         num_fields=6
         fields=content.strip().split('\t')
         
@@ -785,6 +2133,8 @@ class UDPSocketSet(DNSet):
                 ttl=int(ttl)
             except:
                 raise Exception('invalid ttl: %s'%ttl)
+            if ttl<0 or ttl>MAXTTL:
+                raise Exception('invalid ttl: %s'%ttl)
         
         if expiration=='':
             expiration=self.listdefaults['expiration']
@@ -793,25 +2143,101 @@ class UDPSocketSet(DNSet):
                 expiration=int(expiration)
             except:
                 raise Exception('invalid expiration: %s'%expiration)
-        logging.getLogger().debug("dbg  packethandler(final values): name=%s a=%s txt=%s action=%s ttl=%s expiration=%s"%(name,a_content,txt_content,action,ttl,expiration)) 
+            if expiration<0:
+                raise Exception('invalid expiration: %s'%expiration)
+        #formatted lazily, this runs for every line of a batch
+        logging.getLogger().debug("dbg  packethandler(final values): name=%s a=%s txt=%s action=%s ttl=%s expiration=%s",name,a_content,txt_content,action,ttl,expiration)
+        
+        if action=='d':
+            return action,name,None
+        rec={
+              'A':a_content,
+              'excluded':False,
+              'TTL':ttl,
+        }
+        if expiration!=None and expiration!=0:
+            rec['expires']=time.time()+expiration
+        if txt_content:
+            rec['TXT']=txt_content
+        return action,name,rec
+    
+    def handlepacket(self,content,ip):
+        logging.getLogger().debug("dbg packethandler(received) from %s: %s"%(ip,content))
+        if content.startswith(RECORDSHEADER):
+            #unvalidated records, only the parent process forwards them to its workers
+            if ip!='parent':
+                raise Exception("forwarded records from %s"%ip)
+            records,pos=decode_records(content,len(RECORDSHEADER))
+            self.apply_records(records,forward=False)
+            return
+        if content.startswith(BATCHHEADER):
+            lines=content.split('\n')[1:]
+            applied,rejected=self.apply_commands(lines,ip)
+            logging.getLogger().info("Listener %s : applied %s commands from %s, rejected %s"%(self.filename,applied,ip,rejected))
+            return
         
         #TODO: ACL based on addr
+        action,name,rec=self.parse_command(content)
         if action=='a':
-            rec={
-                  'A':a_content,
-                  'excluded':False,
-                  'TTL':ttl,
-            }
-            if expiration!=None and expiration!=0:
-                rec['expires']=time.time()+expiration
-            if txt_content:
-                rec['TXT']=txt_content
             self.fastlist(name, rec)
             logging.getLogger().info("Listener %s : fastlisted %s from %s"%(self.filename,name,ip))
             
         elif action=='d':
             self.delist(name)
-            
+    
+    def apply_commands(self,lines,ip):
+        """apply command lines with one lock acquisition, returns (applied,rejected)"""
+        commands=[]
+        rejected=0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                commands.append(self.parse_command(line))
+            except Exception,e:
+                rejected+=1
+                logging.getLogger().error("Listener %s : rejecting command from %s : %s"%(self.filename,ip,str(e)))
+        
+        self.apply_records(commands,forward=False)
+        return len(commands),rejected
+    
+    def apply_records(self,records,forward=True):
+        """apply (action,name,record) changes in one writer task
+        forward: send them to the worker processes, the receive path forwards the packet itself"""
+        if not records:
+            return
+        frames,applied=self.write(self._apply,records)
+        if forward:
+            self.forward_records(frames)
+    
+    def _apply(self,records):
+        """writer only, returns (journal frames of the changes, number of changes)"""
+        frames=[]
+        for action,name,rec in records:
+            #encoded before anything changes, a record the journal can not store is not applied at all
+            try:
+                frame=encode(action,name,rec)
+            except Exception,e:
+                logging.getLogger().error("%s: not applying change of %s: %s"%(self.filename,name,str(e)))
+                continue
+            if action=='a':
+                self._stage(name,rec)
+                self._index_expiry(name,rec)
+                frames.append(frame)
+            elif self._stage(name,None):
+                frames.append(frame)
+        self._log_changes(frames)
+        return frames,len(frames)
+    
+    def _log_changes(self,frames):
+        """journal applied changes and send them to the replicas, writer only"""
+        if not frames:
+            return
+        if self.journal!=None:
+            self.journal.append(''.join(frames))
+        if self.replication!=None and self.replication.role=='primary':
+            self.replication.publish(frames)
+    
     def listen(self):
         try:
             while self.stay_alive:
@@ -821,13 +2247,7 @@ class UDPSocketSet(DNSet):
                     continue
                 
                 #logging.getLogger().debug("waiting for fastlist packet...")
-                packetcontent, addr = self.udpsocket.recvfrom(1024)
-                ip=addr[0]
-                
-                try:
-                    self.handlepacket(packetcontent, ip)
-                except Exception,e:
-                    logging.getLogger().error("Listener %s : throwing packet away from %s : %s"%(self.filename,ip,str(e)))
+                self.receive_packet()
                 
         except:
             logging.getLogger().error("fasthash listener thread crashing: %s"%traceback.format_exc())
@@ -838,46 +2258,170 @@ class UDPSocketSet(DNSet):
         except:
             pass
         
+    def receive_packet(self):
+        """read and apply one fastlist packet from our socket"""
+        packetcontent, addr = self.udpsocket.recvfrom(65535)
+        if addr:
+            ip=addr[0]
+        else:
+            #forwarded by the parent process
+            ip='parent'
+        
+        try:
+            self.handlepacket(packetcontent, ip)
+            self.forward(packetcontent)
+        except Exception,e:
+            logging.getLogger().error("Listener %s : throwing packet away from %s : %s"%(self.filename,ip,str(e)))
+    
+    def receive_pending(self,budget=64):
+        """read up to budget packets from our non-blocking socket"""
+        for i in range(budget):
+            try:
+                self.receive_packet()
+            except socket.error,e:
+                if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return
+                raise
+        
+    def start_bulkload_listener(self):
+        bind,port=self.filename.split('/')
+        sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.bind((bind,int(port)))
+        sock.listen(16)
+        self.tcpsocket=sock
+        thread.start_new_thread(self.accept_bulkloads, ())
+        logging.getLogger().info("Fastlist bulk load listener ready on %s/%s"%(bind,port))
+    
+    def accept_bulkloads(self):
+        while self.stay_alive:
+            sock=self.tcpsocket
+            if sock==None:
+                return
+            try:
+                conn,addr=sock.accept()
+            except socket.error,e:
+                if not self.stay_alive or self.tcpsocket==None:
+                    return
+                logging.getLogger().error("%s: bulk load accept failed: %s"%(self.filename,str(e)))
+                time.sleep(1)
+                continue
+            thread.start_new_thread(self.bulkload, (conn,addr[0]))
+    
+    def bulkload(self,conn,ip):
+        """read command lines until the client shuts down its side, then answer 'OK <applied> <rejected>'"""
+        applied=0
+        rejected=0
+        try:
+            try:
+                conn.settimeout(self.bulktimeout)
+                handle=conn.makefile('rb')
+                batch=[]
+                for line in handle:
+                    batch.append(line.rstrip('\r\n'))
+                    if len(batch)>=self.bulkbatch:
+                        ok,bad=self.apply_commands(batch,ip)
+                        applied+=ok
+                        rejected+=bad
+                        self.forward_commands(batch)
+                        batch=[]
+                if batch:
+                    ok,bad=self.apply_commands(batch,ip)
+                    applied+=ok
+                    rejected+=bad
+                    self.forward_commands(batch)
+                handle.close()
+                logging.getLogger().info("Listener %s : bulk load from %s applied %s commands, rejected %s"%(self.filename,ip,applied,rejected))
+                conn.sendall("OK %s %s\n"%(applied,rejected))
+            except Exception,e:
+                logging.getLogger().error("Listener %s : bulk load from %s failed after %s commands: %s"%(self.filename,ip,applied,str(e)))
+                try:
+                    conn.sendall("ERR %s %s\n"%(applied,rejected))
+                except socket.error:
+                    pass
+        finally:
+            conn.close()
+    
     def shutdown(self):
         self.stay_alive=False
+        if self.replication!=None:
+            self.replication.close()
+        if self.tcpsocket!=None:
+            self.tcpsocket.close()
+            self.tcpsocket=None
         self.save_zone()
+        self.stop_writer()
+        if self.journal!=None:
+            self.journal.close()
+    
+    def zone_filename(self):
+        return '/tmp/fastlist-%s.p'%self.filename.split('/')[1]
+    
+    def sync_journal(self):
+        """write the buffered journal records, compact if the journal got too large"""
+        journal=self.journal
+        if journal==None:
+            return
+        try:
+            journal.sync()
+        except:
+            logging.getLogger().error("journal sync failed: %s"%traceback.format_exc())
+            return
+        if journal.size>self.compactsize:
+            self.save_zone()
         
+    def snapshot(self):
+        """the published snapshot with all changes applied so far, writer only"""
+        self._publish()
+        return self.backend
+    
+    def _rotate(self):
+        view=self.snapshot()
+        if self.journal!=None:
+            self.journal.rotate()
+        return view
+    
     def save_zone(self):
-        """simple persistence"""
+        """compaction: write the current zone and start a new journal
+        the lock is only held to copy the record dict, not while writing"""
+        if not self.persistent:
+            return
         try:
-            filename='/tmp/fastlist-%s.p'%self.filename.split('/')[1]
-            self._reload_lock.acquire()
-            pickle.dump(self.backend, open(filename,'wb'))
+            filename=self.zone_filename()
+            #the snapshot is immutable, only the rotation has to happen between two writes
+            view=self.write(self._rotate)
+            write_zone(filename,view.todict())
+            if self.journal!=None:
+                self.journal.drop_rotated()
             logging.getLogger().info("fastlist zone %s saved to %s "%(self.filename,filename))
-            self._reload_lock.release()
         except:
             logging.getLogger().error("save_zone failed: %s"%traceback.format_exc())
             
     def load_zone(self):
-        """try to load pickle"""
+        """load the saved zone and replay its journal"""
         
-        filename='/tmp/fastlist-%s.p'%self.filename.split('/')[1]
+        filename=self.zone_filename()
         
-        if not os.path.exists(filename):
+        if not os.path.exists(filename) and not os.path.exists(journal_filename(filename)):
             logging.getLogger().info("no save file found for %s"%(self.filename))
-            return
-        logging.getLogger().info("found save file for %s"%(self.filename))
-        
-        
+        else:
+            logging.getLogger().info("found save file for %s"%(self.filename))
+            try:
+                self.write(self._replace,read_zone(filename))
+                logging.getLogger().info("successfuly reloaded %s from %s"%(self.filename,filename))
+            except:
+                logging.getLogger().error("load failed: %s"%traceback.format_exc())
         
-        try:
-            self._reload_lock.acquire()
-            newback=pickle.load(open(filename,'rb'))
-            self.backend=newback
-            self._reload_lock.release()
-            logging.getLogger().info("successfuly reloaded %s from %s"%(self.filename,filename))
-        except:
-            logging.getLogger().error("load failed: %s"%traceback.format_exc())
+        if self.persistent:
+            try:
+                self.journal=Journal(journal_filename(filename))
+            except:
+                logging.getLogger().error("could not open the fastlist journal, changes are only saved every %s seconds: %s"%(self.compactinterval,traceback.format_exc()))
             
 
 DATASETMAP={
    'dnset':DNSet,
-   'ip4set':IntervalTreeSet,
+   'ip4set':SortedArraySet,
    'ip4tset':TrivialSet,
    'ip4trie':RadixTrieSet, 
    'fastlist':UDPSocketSet, 
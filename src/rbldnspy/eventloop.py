@@ -0,0 +1,192 @@
+"""single threaded event loop used by the --eventloop frontend
+
+All dns sockets, fastlist sockets and the monitor port are multiplexed with epoll (poll where epoll is not
+available). Blocking work like dataset reloads and fastlist persistence is handed to a ThreadExecutor so it
+never delays answering queries.
+"""
+import time
+import heapq
+import select
+import logging
+import traceback
+import thread
+import Queue
+from threading import Lock
+
+
+class Timer(object):
+    __slots__=('when','interval','callback','args','cancelled')
+
+    def __init__(self,when,interval,callback,args):
+        self.when=when
+        self.interval=interval
+        self.callback=callback
+        self.args=args
+        self.cancelled=False
+
+    def cancel(self):
+        self.cancelled=True
+
+
+class EventLoop(object):
+    """readiness based loop for non-blocking sockets plus timers
+
+    budget: maximum number of datagrams a reader should consume per wakeup, so one busy socket can not starve the others
+    """
+
+    def __init__(self,budget=64):
+        self.budget=budget
+        if hasattr(select,'epoll'):
+            self._poller=select.epoll()
+            self._readmask=select.EPOLLIN|select.EPOLLERR|select.EPOLLHUP
+            self._timeoutfactor=1
+        else:
+            self._poller=select.poll()
+            self._readmask=select.POLLIN|select.POLLERR|select.POLLHUP
+            #poll() wants milliseconds
+            self._timeoutfactor=1000
+        self._readers={}
+        self._timers=[]
+        self._timerseq=0
+        self.running=False
+
+    def add_reader(self,sock,callback,*args):
+        """call callback(*args) whenever sock is readable"""
+        sock.setblocking(0)
+        fd=sock.fileno()
+        self._readers[fd]=(callback,args)
+        self._poller.register(fd,self._readmask)
+
+    def remove_reader(self,sock):
+        try:
+            fd=sock.fileno()
+        except:
+            return
+        if fd in self._readers:
+            del self._readers[fd]
+            try:
+                self._poller.unregister(fd)
+            except:
+                pass
+
+    def call_later(self,delay,callback,*args):
+        return self._add_timer(delay,None,callback,args)
+
+    def call_every(self,interval,callback,*args):
+        """call callback(*args) every interval seconds, the first call happens after interval seconds"""
+        return self._add_timer(interval,interval,callback,args)
+
+    def _add_timer(self,delay,interval,callback,args):
+        timer=Timer(time.time()+delay,interval,callback,args)
+        self._timerseq+=1
+        heapq.heappush(self._timers,(timer.when,self._timerseq,timer))
+        return timer
+
+    def _run_timers(self):
+        now=time.time()
+        while self._timers and self._timers[0][0]<=now:
+            when,seq,timer=heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            self._call(timer.callback,timer.args)
+            if timer.interval!=None and not timer.cancelled:
+                timer.when=now+timer.interval
+                self._timerseq+=1
+                heapq.heappush(self._timers,(timer.when,self._timerseq,timer))
+
+    def _call(self,callback,args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.getLogger().error("event loop callback %s failed: %s"%(callback,traceback.format_exc()))
+
+    def _next_timeout(self):
+        timeout=1.0
+        if self._timers:
+            timeout=min(timeout,max(0,self._timers[0][0]-time.time()))
+        return timeout
+
+    def run(self):
+        self.running=True
+        while self.running:
+            try:
+                events=self._poller.poll(self._next_timeout()*self._timeoutfactor)
+            except (IOError,select.error),e:
+                #EINTR, e.g. signal delivered
+                events=[]
+            for fd,event in events:
+                handler=self._readers.get(fd)
+                if handler==None:
+                    continue
+                callback,args=handler
+                self._call(callback,args)
+            self._run_timers()
+
+    def stop(self):
+        self.running=False
+
+
+QUEUED='queued'
+RUNNING='running'
+#submitted again while running, the job runs once more when it is done
+RERUN='rerun'
+
+
+class ThreadExecutor(object):
+    """runs blocking jobs in a small pool of worker threads.
+    a job is not queued again while one with the same key is waiting to run. a job submitted while one with
+    the same key is running is run once more afterwards, so it sees whatever changed in the meantime"""
+
+    def __init__(self,workers=1):
+        self._queue=Queue.Queue()
+        #key -> QUEUED, RUNNING or RERUN
+        self._pending={}
+        self._lock=Lock()
+        self.workers=workers
+        for i in range(workers):
+            thread.start_new_thread(self._work,())
+
+    def submit(self,key,func,*args):
+        """queue func(*args), returns False if a job with the same key is already waiting to run"""
+        self._lock.acquire()
+        try:
+            state=self._pending.get(key)
+            if state==RUNNING:
+                self._pending[key]=RERUN
+                return True
+            if state!=None:
+                return False
+            self._pending[key]=QUEUED
+        finally:
+            self._lock.release()
+        self._queue.put((key,func,args))
+        return True
+
+    def _work(self):
+        while True:
+            job=self._queue.get()
+            if job==None:
+                return
+            key,func,args=job
+            self._lock.acquire()
+            try:
+                self._pending[key]=RUNNING
+            finally:
+                self._lock.release()
+            try:
+                func(*args)
+            except Exception:
+                logging.getLogger().error("background job %s failed: %s"%(func,traceback.format_exc()))
+            self._lock.acquire()
+            try:
+                rerun=self._pending.pop(key)==RERUN
+                if rerun:
+                    self._pending[key]=QUEUED
+            finally:
+                self._lock.release()
+            if rerun:
+                self._queue.put(job)
+
+    def shutdown(self):
+        for i in range(self.workers):
+            self._queue.put(None)
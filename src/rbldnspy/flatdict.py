@@ -0,0 +1,96 @@
+"""read-only string keyed hash table stored in four flat arrays
+
+keys: all keys concatenated
+offsets: start of each key in keys, plus the end of the last key
+values: value number of each key
+slots: open addressing table (linear probing) of key numbers, -1 marks an empty slot
+
+The arrays can be ctypes arrays on top of a mapped snapshot file, so a table with millions of keys can be
+loaded without creating a python object per key. A lookup only allocates the slice of the compared key.
+"""
+from zlib import crc32
+from array import array
+
+
+def build_flat_table(items):
+    """items: list of (key,value number) with unique keys
+    returns the arrays (keys,offsets,values,slots)"""
+    size=8
+    while size<len(items)*2:
+        size*=2
+    mask=size-1
+
+    offsets=array('I')
+    values=array('i')
+    slots=array('i',[-1])*size
+    pos=0
+    for keynum,(key,valuenum) in enumerate(items):
+        offsets.append(pos)
+        pos+=len(key)
+        values.append(valuenum)
+        slot=crc32(key)&mask
+        while slots[slot]>=0:
+            slot=(slot+1)&mask
+        slots[slot]=keynum
+    offsets.append(pos)
+    keys=array('c',''.join([key for key,valuenum in items]))
+    return keys,offsets,values,slots
+
+
+class FlatDict(object):
+    """dict like read access to a flat table, records maps value numbers to the returned values"""
+
+    def __init__(self,keys,offsets,values,slots,records):
+        if isinstance(keys,array):
+            #slices of array('c') are arrays, we compare against strings
+            keys=keys.tostring()
+        self.keys=keys
+        self.offsets=offsets
+        self.values=values
+        self.slots=slots
+        self.records=records
+        self.mask=len(slots)-1
+
+    def _find(self,key):
+        keys=self.keys
+        offsets=self.offsets
+        slots=self.slots
+        mask=self.mask
+        slot=crc32(key)&mask
+        while True:
+            keynum=slots[slot]
+            if keynum<0:
+                return -1
+            if keys[offsets[keynum]:offsets[keynum+1]]==key:
+                return keynum
+            slot=(slot+1)&mask
+
+    def __getitem__(self,key):
+        keynum=self._find(key)
+        if keynum<0:
+            raise KeyError(key)
+        return self.records[self.values[keynum]]
+
+    def get(self,key,default=None):
+        keynum=self._find(key)
+        if keynum<0:
+            return default
+        return self.records[self.values[keynum]]
+
+    def __contains__(self,key):
+        return self._find(key)>=0
+
+    def __len__(self):
+        return len(self.values)
+
+    def iterkeys(self):
+        keys=self.keys
+        offsets=self.offsets
+        for keynum in xrange(len(self.values)):
+            yield keys[offsets[keynum]:offsets[keynum+1]]
+
+    def iteritems(self):
+        records=self.records
+        values=self.values
+        for keynum,key in enumerate(self.iterkeys()):
+            yield key,records[values[keynum]]
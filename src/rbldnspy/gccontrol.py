@@ -0,0 +1,143 @@
+"""cyclic garbage collector control
+
+Building a dataset creates a lot of container objects, and the cyclic collector keeps scanning them while the
+build is running and again after the dataset is installed. Python 2 has neither gc.freeze nor gc.callbacks, so:
+
+ - automatic collection is switched off while any dataset is being built
+ - when the last build has finished, one collection of the young generations moves everything that survived
+   into the oldest generation, which is only scanned by full collections
+ - with take_over() automatic collection stays off for good and tick() runs the collection that is due from
+   the event loop or a background thread. every pause is timed, so the monitor can show them
+
+full collections are additionally limited to one per fullinterval seconds, instead of the 25% long lived growth
+rule the interpreter uses internally
+"""
+import gc
+import time
+import thread
+import logging
+import traceback
+from threading import Lock
+
+
+class GCControl(object):
+
+    def __init__(self):
+        self._lock=Lock()
+        #number of datasets being built right now
+        self.building=0
+        #automatic collection state to restore after the last build
+        self._wasenabled=True
+        #True if tick() runs all collections
+        self.manual=False
+        self.fullinterval=300
+        self.lastfull=time.time()
+        self.stay_alive=True
+
+        #stats
+        self.collections=[0,0,0]
+        self.pausetime=[0.0,0.0,0.0]
+        self.maxpause=0.0
+
+    def take_over(self):
+        """disable automatic collection, tick() must be called regularly from now on"""
+        self._lock.acquire()
+        try:
+            self.manual=True
+            self._wasenabled=False
+            gc.disable()
+        finally:
+            self._lock.release()
+
+    def after_fork(self):
+        """builds running in other threads of the parent do not exist in a forked child"""
+        self._lock=Lock()
+        self.building=0
+        if self.manual or not self._wasenabled:
+            gc.disable()
+        else:
+            gc.enable()
+
+    def collect(self,generation):
+        """run a timed collection, returns the pause in seconds"""
+        start=time.time()
+        gc.collect(generation)
+        pause=time.time()-start
+        self._lock.acquire()
+        try:
+            self.collections[generation]+=1
+            self.pausetime[generation]+=pause
+            if pause>self.maxpause:
+                self.maxpause=pause
+            if generation==2:
+                self.lastfull=time.time()
+        finally:
+            self._lock.release()
+        return pause
+
+    def build_started(self):
+        self._lock.acquire()
+        try:
+            if self.building==0 and not self.manual:
+                self._wasenabled=gc.isenabled()
+            self.building+=1
+            gc.disable()
+        finally:
+            self._lock.release()
+
+    def build_finished(self):
+        """returns the time spent collecting after the last running build"""
+        self._lock.acquire()
+        try:
+            self.building-=1
+            if self.building>0:
+                return 0.0
+        finally:
+            self._lock.release()
+
+        #the new objects survive, promote them to the oldest generation in one go
+        pause=self.collect(1)
+        self._lock.acquire()
+        try:
+            if self.building==0 and self._wasenabled and not self.manual:
+                gc.enable()
+        finally:
+            self._lock.release()
+        return pause
+
+    def tick(self):
+        """run the collection the interpreter would have run by now"""
+        if self.building>0:
+            return
+        threshold0,threshold1,threshold2=gc.get_threshold()
+        count0,count1,count2=gc.get_count()
+        if threshold0==0 or count0<threshold0:
+            return
+        generation=0
+        if count1>=threshold1:
+            generation=1
+            if count2>=threshold2 and time.time()-self.lastfull>=self.fullinterval:
+                generation=2
+        self.collect(generation)
+
+    def run(self,interval=0.1):
+        while self.stay_alive:
+            try:
+                self.tick()
+            except Exception:
+                logging.getLogger().error("gc tick failed: %s"%traceback.format_exc())
+            time.sleep(interval)
+
+    def start(self,interval=0.1):
+        thread.start_new_thread(self.run,(interval,))
+
+    def stats(self):
+        """tuple (collections per generation, pause seconds per generation, longest pause)"""
+        self._lock.acquire()
+        try:
+            return list(self.collections),list(self.pausetime),self.maxpause
+        finally:
+            self._lock.release()
+
+
+collector=GCControl()
@@ -0,0 +1,282 @@
+"""append-only journal persistence for fastlist zones
+
+A fastlist zone is stored as a snapshot, a pickle of the record dict (the format save_zone always wrote), plus a
+journal with every change made since that snapshot. Changes are buffered in memory and written with one
+write and fsync per sync() call. Compaction renames the journal to <journal>.1, starts a new one, writes a
+fresh snapshot and then removes <journal>.1. Replaying <journal>.1 and <journal> on top of either the old or
+the new snapshot gives the same zone, so a crash at any point loses at most the changes since the last sync.
+
+journal layout: the magic string, then records of
+    payload length (2 bytes), crc32 of the payload (4 bytes), payload
+payload of an add: 'a', flags, ttl, expiration time, name, A and TXT value (each with a 2 byte length)
+payload of a delete: 'd' and the name
+a record with a short read or a bad checksum ends the journal, it was torn by a crash
+"""
+import os
+import zlib
+import struct
+import logging
+import threading
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+MAGIC='RBLDJRN1'
+
+_frame=struct.Struct('!HI')
+_add=struct.Struct('!cBId')
+_length=struct.Struct('!H')
+
+FLAG_EXCLUDED=1
+FLAG_TXT=2
+FLAG_TTL=4
+FLAG_EXPIRES=8
+
+
+def journal_filename(snapshotfile):
+    return os.path.splitext(snapshotfile)[0]+'.journal'
+
+
+def _string(value):
+    return _length.pack(len(value))+value
+
+
+def _frame_payload(payload):
+    return _frame.pack(len(payload),zlib.crc32(payload)&0xffffffff)+payload
+
+
+def encode_add(name,rec):
+    flags=0
+    if rec.get('excluded'):
+        flags|=FLAG_EXCLUDED
+    txt=rec.get('TXT')
+    if txt!=None:
+        flags|=FLAG_TXT
+    ttl=rec.get('TTL')
+    if ttl!=None:
+        flags|=FLAG_TTL
+    expires=rec.get('expires')
+    if expires!=None:
+        flags|=FLAG_EXPIRES
+    payload=[_add.pack('a',flags,ttl or 0,expires or 0.0),_string(name),_string(rec.get('A') or '')]
+    if txt!=None:
+        payload.append(_string(txt))
+    return _frame_payload(''.join(payload))
+
+
+def encode_delete(name):
+    return _frame_payload('d'+_string(name))
+
+
+def _read_string(payload,pos):
+    length=_length.unpack_from(payload,pos)[0]
+    pos+=_length.size
+    return payload[pos:pos+length],pos+length
+
+
+def decode(payload):
+    """payload -> (op,name,rec), rec is None for deletes"""
+    if payload[0]=='d':
+        name,pos=_read_string(payload,1)
+        return 'd',name,None
+    op,flags,ttl,expires=_add.unpack_from(payload,0)
+    name,pos=_read_string(payload,_add.size)
+    a,pos=_read_string(payload,pos)
+    rec={
+        'A':a,
+        'excluded':bool(flags&FLAG_EXCLUDED),
+    }
+    if flags&FLAG_TXT:
+        rec['TXT'],pos=_read_string(payload,pos)
+    if flags&FLAG_TTL:
+        rec['TTL']=ttl
+    if flags&FLAG_EXPIRES:
+        rec['expires']=expires
+    return 'a',name,rec
+
+
+def decode_records(data,pos=0):
+    """decode the framed records in data, starting at pos
+    returns (list of (op,name,rec), end of the last complete record)"""
+    records=[]
+    while pos+_frame.size<=len(data):
+        length,crc=_frame.unpack_from(data,pos)
+        payload=data[pos+_frame.size:pos+_frame.size+length]
+        if len(payload)!=length or zlib.crc32(payload)&0xffffffff!=crc:
+            break
+        try:
+            records.append(decode(payload))
+        except Exception:
+            break
+        pos+=_frame.size+length
+    return records,pos
+
+
+def encode(op,name,rec):
+    if op=='a':
+        return encode_add(name,rec)
+    return encode_delete(name)
+
+
+def read_journal(filename):
+    """returns (list of (op,name,rec), length of the valid part of the file)"""
+    if not os.path.exists(filename):
+        return [],0
+    data=open(filename,'rb').read()
+    if not data.startswith(MAGIC):
+        logging.getLogger().warning("ignoring %s: not a fastlist journal"%filename)
+        return [],0
+    records,pos=decode_records(data,len(MAGIC))
+    if pos!=len(data):
+        logging.getLogger().warning("%s: ignoring %s bytes of a torn record"%(filename,len(data)-pos))
+    return records,pos
+
+
+def replay(backend,records):
+    for op,name,rec in records:
+        if op=='a':
+            backend[name]=rec
+        else:
+            backend.pop(name,None)
+
+
+def read_zone(snapshotfile):
+    """the fastlist zone persisted in snapshotfile and its journals"""
+    backend={}
+    if os.path.exists(snapshotfile):
+        handle=open(snapshotfile,'rb')
+        try:
+            backend=pickle.load(handle)
+        finally:
+            handle.close()
+    journal=journal_filename(snapshotfile)
+    for filename in (journal+'.1',journal):
+        records,length=read_journal(filename)
+        replay(backend,records)
+    return backend
+
+
+def write_zone(snapshotfile,backend):
+    """atomically replace the snapshot"""
+    tmpname="%s.tmp.%s"%(snapshotfile,os.getpid())
+    handle=open(tmpname,'wb')
+    try:
+        pickle.dump(backend,handle,pickle.HIGHEST_PROTOCOL)
+        handle.flush()
+        os.fsync(handle.fileno())
+    finally:
+        handle.close()
+    os.rename(tmpname,snapshotfile)
+
+
+def _write_all(fd,data):
+    while data:
+        written=os.write(fd,data)
+        data=data[written:]
+
+
+class Journal(object):
+    """the journal a fastlist zone appends to
+
+    append() only buffers, sync() writes and fsyncs everything buffered since the last call
+    """
+
+    def __init__(self,filename):
+        self.filename=filename
+        self.rotated=filename+'.1'
+        self._lock=threading.Lock()
+        #serializes writers of the file, held during write and fsync
+        self._synclock=threading.Lock()
+        self.pending=[]
+        self.fd=self._open(filename)
+        self.size=os.fstat(self.fd).st_size
+
+    def _open(self,filename):
+        records,length=read_journal(filename)
+        fd=os.open(filename,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0600)
+        if length==0:
+            os.ftruncate(fd,0)
+            _write_all(fd,MAGIC)
+            os.fsync(fd)
+        elif os.fstat(fd).st_size>length:
+            #cut off a torn record, new records must follow the last good one
+            os.ftruncate(fd,length)
+        return fd
+
+    def append(self,record):
+        self._lock.acquire()
+        try:
+            self.pending.append(record)
+        finally:
+            self._lock.release()
+
+    def sync(self):
+        self._synclock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                data=''.join(self.pending)
+                self.pending=[]
+            finally:
+                self._lock.release()
+            if self.fd==None or not data:
+                return
+            _write_all(self.fd,data)
+            os.fsync(self.fd)
+            self.size+=len(data)
+        finally:
+            self._synclock.release()
+
+    def rotate(self):
+        """move the journal to <journal>.1 and start a new one. callers block changes while this runs, so
+        a snapshot taken at the same time matches the end of <journal>.1"""
+        self._synclock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                data=''.join(self.pending)
+                self.pending=[]
+            finally:
+                self._lock.release()
+            _write_all(self.fd,data)
+            os.fsync(self.fd)
+            os.close(self.fd)
+            if os.path.exists(self.rotated):
+                #the last compaction did not finish, keep everything since its snapshot in one file
+                current=open(self.filename,'rb').read()[len(MAGIC):]
+                fd=os.open(self.rotated,os.O_WRONLY|os.O_APPEND)
+                try:
+                    _write_all(fd,current)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.unlink(self.filename)
+            else:
+                os.rename(self.filename,self.rotated)
+            self.fd=self._open(self.filename)
+            self.size=os.fstat(self.fd).st_size
+        finally:
+            self._synclock.release()
+
+    def drop_rotated(self):
+        """the snapshot covering <journal>.1 is safely written"""
+        if os.path.exists(self.rotated):
+            os.unlink(self.rotated)
+
+    def abandon(self):
+        """forget the journal without writing, e.g. in a forked child"""
+        self.pending=[]
+        if self.fd!=None:
+            os.close(self.fd)
+            self.fd=None
+
+    def close(self):
+        self.sync()
+        self._synclock.acquire()
+        try:
+            if self.fd!=None:
+                os.close(self.fd)
+                self.fd=None
+        finally:
+            self._synclock.release()
@@ -0,0 +1,180 @@
+"""batched udp i/o with recvmmsg/sendmmsg through ctypes (linux only)
+
+check `available` before using BatchIO, on other platforms the frontend falls back to recvfrom/sendto
+"""
+import os
+import time
+import errno
+import select
+import struct
+import socket
+import ctypes
+import ctypes.util
+
+MSG_DONTWAIT=0x40
+MSG_WAITFORONE=0x10000
+
+#large enough for sockaddr_in and sockaddr_in6
+SOCKADDR_SIZE=28
+
+available=False
+_libc=None
+try:
+    _libc=ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    available=hasattr(_libc,'recvmmsg') and hasattr(_libc,'sendmmsg')
+except:
+    pass
+
+
+class iovec(ctypes.Structure):
+    _fields_=[
+        ('iov_base',ctypes.c_void_p),
+        ('iov_len',ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_=[
+        ('msg_name',ctypes.c_void_p),
+        ('msg_namelen',ctypes.c_uint32),
+        ('msg_iov',ctypes.POINTER(iovec)),
+        ('msg_iovlen',ctypes.c_size_t),
+        ('msg_control',ctypes.c_void_p),
+        ('msg_controllen',ctypes.c_size_t),
+        ('msg_flags',ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_=[
+        ('msg_hdr',msghdr),
+        ('msg_len',ctypes.c_uint),
+    ]
+
+
+def decode_sockaddr(raw):
+    """sockaddr_in(6) bytes -> (ip,port)"""
+    family=struct.unpack('=H',raw[:2])[0]
+    port=struct.unpack('!H',raw[2:4])[0]
+    if family==socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6,raw[8:24]),port
+    return socket.inet_ntoa(raw[4:8]),port
+
+
+class BatchIO(object):
+    """receive and send up to batchsize datagrams per system call on sock
+
+    all buffers are allocated once. the peer address of a received datagram is kept in its slot, so send() can
+    reply to it without encoding the address again
+    """
+
+    def __init__(self,sock,batchsize=32,timeout=0,bufsize=512):
+        self.sock=sock
+        self.fd=sock.fileno()
+        self.batchsize=batchsize
+        #seconds to wait for more datagrams once the first one of a batch arrived
+        self.timeout=timeout
+        self.bufsize=bufsize
+
+        #stats
+        self.batches=0
+        self.packets=0
+
+        self._bufs=(ctypes.c_char*bufsize*batchsize)()
+        self._names=(ctypes.c_char*SOCKADDR_SIZE*batchsize)()
+        self._iovs=(iovec*batchsize)()
+        self._msgs=(mmsghdr*batchsize)()
+        for i in range(batchsize):
+            self._iovs[i].iov_base=ctypes.addressof(self._bufs[i])
+            self._iovs[i].iov_len=bufsize
+            hdr=self._msgs[i].msg_hdr
+            hdr.msg_name=ctypes.addressof(self._names[i])
+            hdr.msg_iov=ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen=1
+
+        self._sendiovs=(iovec*batchsize)()
+        self._sendmsgs=(mmsghdr*batchsize)()
+
+    def _recvmmsg(self,offset,flags):
+        count=self.batchsize-offset
+        msgs=ctypes.byref(self._msgs,offset*ctypes.sizeof(mmsghdr))
+        for i in range(offset,self.batchsize):
+            self._msgs[i].msg_hdr.msg_namelen=SOCKADDR_SIZE
+        while True:
+            received=_libc.recvmmsg(self.fd,msgs,count,flags,None)
+            if received>=0:
+                return received
+            err=ctypes.get_errno()
+            if err==errno.EINTR:
+                continue
+            if err in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return 0
+            raise socket.error(err,os.strerror(err))
+
+    def recv(self,block=True):
+        """returns a list of tuples (slot, data, addr). blocks until at least one datagram is available unless block is False"""
+        if block:
+            received=self._recvmmsg(0,MSG_WAITFORONE)
+        else:
+            received=self._recvmmsg(0,MSG_DONTWAIT)
+
+        if received>0 and received<self.batchsize and self.timeout>0:
+            deadline=time.time()+self.timeout
+            while received<self.batchsize:
+                remaining=deadline-time.time()
+                if remaining<=0:
+                    break
+                ready=select.select([self.fd],[],[],remaining)[0]
+                if not ready:
+                    break
+                received+=self._recvmmsg(received,MSG_DONTWAIT)
+
+        if received==0:
+            return []
+        self.batches+=1
+        self.packets+=received
+
+        result=[]
+        for i in range(received):
+            hdr=self._msgs[i].msg_hdr
+            data=ctypes.string_at(ctypes.addressof(self._bufs[i]),self._msgs[i].msg_len)
+            addr=decode_sockaddr(ctypes.string_at(ctypes.addressof(self._names[i]),hdr.msg_namelen))
+            result.append((i,data,addr))
+        return result
+
+    def send(self,replies):
+        """replies: list of tuples (slot, data) answering datagrams returned by the last recv(). returns the number of datagrams sent"""
+        count=len(replies)
+        if count==0:
+            return 0
+        #keep the python strings alive until sendmmsg is done
+        keep=[]
+        for i in range(count):
+            slot,data=replies[i]
+            data=str(data)
+            keep.append(data)
+            self._sendiovs[i].iov_base=ctypes.cast(ctypes.c_char_p(data),ctypes.c_void_p)
+            self._sendiovs[i].iov_len=len(data)
+            hdr=self._sendmsgs[i].msg_hdr
+            hdr.msg_name=ctypes.addressof(self._names[slot])
+            hdr.msg_namelen=self._msgs[slot].msg_hdr.msg_namelen
+            hdr.msg_iov=ctypes.pointer(self._sendiovs[i])
+            hdr.msg_iovlen=1
+
+        sent=0
+        while sent<count:
+            result=_libc.sendmmsg(self.fd,ctypes.byref(self._sendmsgs,sent*ctypes.sizeof(mmsghdr)),count-sent,0)
+            if result<0:
+                err=ctypes.get_errno()
+                if err==errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    break
+                raise socket.error(err,os.strerror(err))
+            sent+=result
+        return sent
+
+    def average_fill(self):
+        if self.batches==0:
+            return 0.0
+        return float(self.packets)/self.batches
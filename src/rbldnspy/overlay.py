@@ -0,0 +1,106 @@
+"""immutable dict snapshots for datasets with a single writer
+
+An OverlayView is a base dict plus a few small overlay dicts with the changes made since the base was built,
+newest first. A deleted key is stored as DELETED in an overlay. Neither the base nor the overlays are changed
+after the view is published, the writer creates a new view for every batch of changes instead, so readers can
+use a view without locks and iterate it while changes are applied.
+
+Overlays are merged when there are more than MAXOVERLAYS of them, and folded into a new base dict when they
+hold more than an eighth of the base. Both happen in the writer, readers keep using the view they have.
+"""
+
+DELETED=object()
+_MISSING=object()
+
+MAXOVERLAYS=8
+
+
+class OverlayView(object):
+
+    def __init__(self,base=None,overlays=(),count=None):
+        if base==None:
+            base={}
+        self.base=base
+        #newest first
+        self.overlays=overlays
+        if count==None:
+            count=len(base)
+        self.count=count
+
+    def get(self,key,default=None):
+        for overlay in self.overlays:
+            value=overlay.get(key,_MISSING)
+            if value is not _MISSING:
+                if value is DELETED:
+                    return default
+                return value
+        return self.base.get(key,default)
+
+    def __getitem__(self,key):
+        value=self.get(key,_MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self,key):
+        return self.get(key,_MISSING) is not _MISSING
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self,other):
+        if isinstance(other,OverlayView):
+            other=other.todict()
+        return self.todict()==other
+
+    def __ne__(self,other):
+        return not self==other
+
+    def iteritems(self):
+        seen=set()
+        for overlay in self.overlays:
+            for key,value in overlay.iteritems():
+                if key in seen:
+                    continue
+                seen.add(key)
+                if value is not DELETED:
+                    yield key,value
+        for key,value in self.base.iteritems():
+            if key not in seen:
+                yield key,value
+
+    def iterkeys(self):
+        for key,value in self.iteritems():
+            yield key
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def todict(self):
+        if not self.overlays:
+            return dict(self.base)
+        return dict(self.iteritems())
+
+    def updated(self,changes,count):
+        """a new view with changes (key -> value or DELETED) applied, count is the new number of keys"""
+        overlays=(changes,)+self.overlays
+        if len(overlays)>MAXOVERLAYS:
+            merged={}
+            for overlay in reversed(overlays):
+                merged.update(overlay)
+            overlays=(merged,)
+        if sum([len(overlay) for overlay in overlays])<=len(self.base)/8+1024:
+            return OverlayView(self.base,overlays,count)
+
+        #the base may be a mapped FlatDict
+        base=dict(self.base.iteritems())
+        for overlay in reversed(overlays):
+            for key,value in overlay.iteritems():
+                if value is DELETED:
+                    base.pop(key,None)
+                else:
+                    base[key]=value
+        return OverlayView(base,(),count)
@@ -0,0 +1,136 @@
+"""parallel parsing of large dataset files
+
+The source is split into byte ranges at line boundaries which are parsed in a multiprocessing pool. Special and
+default lines are found by a regex pre-scan in the parent, which also tracks the reload defaults in effect for
+every range, so the workers only see data lines. Each worker returns the compact partial result of
+AbstractDataset.parse_chunk, the parent merges them in file order with merge_chunk.
+"""
+import re
+import mmap
+import copy
+import hashlib
+import logging
+import traceback
+import multiprocessing
+from workers import reset_logging_locks
+
+#a line which read_source classifies as special or default line
+_directive=re.compile(r'^[ \t\r\x0b\x0c]*(?:[$:]|#\$|;#)[^\n]*',re.M)
+
+#smallest byte range handed to a worker
+MINCHUNK=1024*1024
+
+#filename -> mapped source of the running parallel reloads, inherited by the forked pool processes
+_sources={}
+
+
+def copy_defaults(defaults):
+    result=copy.copy(defaults)
+    result.variables=list(defaults.variables)
+    return result
+
+
+def prescan(data):
+    """yields (start,end) byte offsets of all directive lines in data"""
+    for match in _directive.finditer(data):
+        yield match.start(),match.end()
+
+
+def split_range(data,start,end,chunksize):
+    """split data[start:end] into ranges of about chunksize bytes, ending at a newline"""
+    while end-start>chunksize:
+        pos=data.find('\n',start+chunksize,end)
+        if pos<0:
+            break
+        yield start,pos+1
+        start=pos+1
+    if end>start:
+        yield start,end
+
+
+def plan_tasks(data,directives,chunksize):
+    """group the data lines between the directives into tasks of about chunksize bytes
+    directives: list of (start,end) of the directive lines, context i is in effect after directive i-1
+    returns a list of tasks, each a list of (start,end,context index)"""
+    regions=[]
+    pos=0
+    for index,(start,end) in enumerate(directives):
+        regions.append((pos,start,index))
+        #skip the newline of the directive
+        pos=min(end+1,len(data))
+    regions.append((pos,len(data),len(directives)))
+
+    tasks=[]
+    current=[]
+    size=0
+    for start,end,ctx in regions:
+        for rangestart,rangeend in split_range(data,start,end,chunksize):
+            current.append((rangestart,rangeend,ctx))
+            size+=rangeend-rangestart
+            if size>=chunksize:
+                tasks.append(current)
+                current=[]
+                size=0
+    if current:
+        tasks.append(current)
+    return tasks
+
+
+def _parse_task(args):
+    datasetclass,filename,segments,contexts=args
+    dataset=datasetclass(filename)
+    return dataset.parse_chunk(_sources[filename],segments,contexts)
+
+
+def parse_parallel(dataset,defaults,processes):
+    """parse the source of dataset in a pool of processes, after dataset.reload_start
+    defaults is updated like the serial parser does. returns the sha1 digest of the source, or None
+    if parsing failed and the caller must parse the file itself"""
+    handle=open(dataset.filename,'rb')
+    try:
+        data=mmap.mmap(handle.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+        handle.close()
+
+    try:
+        digest=hashlib.sha1(data).digest()
+        ctx=copy_defaults(defaults)
+        contexts=[copy_defaults(ctx)]
+        directives=[]
+        for start,end in prescan(data):
+            for kind,line in dataset.read_source([data[start:end]]):
+                if kind=='special':
+                    dataset.parse_special(line,ctx)
+                else:
+                    dataset.parse_defaultval(line,ctx)
+            directives.append((start,end))
+            contexts.append(copy_defaults(ctx))
+
+        chunksize=max(MINCHUNK,len(data)/(processes*4))
+        tasks=[]
+        for segments in plan_tasks(data,directives,chunksize):
+            used=dict((index,contexts[index]) for start,end,index in segments)
+            tasks.append((dataset.__class__,dataset.filename,segments,used))
+
+        #the workers read the same mapping, even if the file is replaced in the meantime
+        _sources[dataset.filename]=data
+        try:
+            pool=multiprocessing.Pool(processes,initializer=reset_logging_locks)
+        finally:
+            del _sources[dataset.filename]
+        try:
+            try:
+                for result in pool.imap(_parse_task,tasks):
+                    dataset.merge_chunk(result)
+            except Exception:
+                logging.getLogger().error("parallel parsing of %s failed: %s"%(dataset.filename,traceback.format_exc()))
+                return None
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        data.close()
+
+    defaults.__dict__.update(ctx.__dict__)
+    logging.getLogger().debug("parsed %s in %s chunks with %s processes"%(dataset.filename,len(tasks),processes))
+    return digest
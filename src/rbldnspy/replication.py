@@ -0,0 +1,289 @@
+"""fastlist replication between rbldnspy nodes
+
+One node is the primary of a fastlist zone, it numbers every change applied from a fastlist packet, datagram
+batch or bulk load and sends it to the replicas, using the record encoding of the journal. The replicas apply
+the changes in sequence number order. A replica which sees a gap, or a primary which restarted (new epoch), asks
+the primary to catch up: changes still in the primary's ring buffer are sent again, otherwise the primary sends
+its current zone, which the replica applies as a diff. Records are expired by every node itself, from the
+expiration time the primary assigned.
+
+All messages are UDP datagrams starting with (type, epoch, sequence number):
+ C: changes with this sequence number, followed by the framed records
+ H: heartbeat with the current sequence number of the primary, sent every second
+ R: catch-up request of a replica, the sequence number is the first missing one, 0 to ask for the whole zone
+ A: acknowledgement of a replica with the last applied sequence number
+ F: one chunk of the whole zone as of the sequence number, followed by chunk index, chunk count and records
+"""
+import time
+import struct
+import select
+import socket
+import thread
+import logging
+import traceback
+from collections import deque
+from threading import Lock
+from journal import encode_add, decode_records
+
+_header=struct.Struct('!cIQ')
+_chunk=struct.Struct('!HH')
+
+#largest replication datagram
+MAXDATAGRAM=60000
+
+
+def parse_address(address):
+    """'ip:port' -> (ip,port)"""
+    host,port=address.strip().rsplit(':',1)
+    return host,int(port)
+
+
+def pack_frames(frames,limit):
+    """group frames into strings of at most limit bytes (a larger single frame gets its own string)"""
+    packed=[]
+    current=[]
+    size=0
+    for frame in frames:
+        if current and size+len(frame)>limit:
+            packed.append(''.join(current))
+            current=[]
+            size=0
+        current.append(frame)
+        size+=len(frame)
+    if current:
+        packed.append(''.join(current))
+    return packed
+
+
+class Replication(object):
+    """replication endpoint of a fastlist dataset
+
+    role: 'primary' or 'replica'
+    bind: (ip,port) of our replication socket
+    peers: primary: list of (ip,port) of the replicas
+    primary: replica: (ip,port) the primary sends from, messages from other addresses are ignored
+    """
+
+    def __init__(self,dataset,role,bind,peers=None,primary=None):
+        assert role in ('primary','replica'),"unknown replication role %s"%role
+        assert role=='primary' or primary!=None,"a replica needs the address of its primary"
+        self.dataset=dataset
+        self.role=role
+        self.bind=bind
+        self.stay_alive=True
+        self.sock=None
+        self._lock=Lock()
+
+        #primary: epoch of this process, last assigned sequence number, recent changes
+        self.epoch=int(time.time())
+        self.seq=0
+        self.ring=deque(maxlen=10000)
+        #peer address -> [last acknowledged sequence number, time of the acknowledgement]
+        self.peers={}
+        for peer in peers or []:
+            self.peers[peer]=[0,None]
+
+        #replica: address and last announced sequence number of the primary, catch-up state
+        if role=='replica':
+            self.epoch=None
+        self.primary=primary
+        self.primaryseq=0
+        self._lastrequest=(None,0)
+        self._resync=None
+
+    def start(self):
+        sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.bind(self.bind)
+        self.sock=sock
+        thread.start_new_thread(self.run,())
+        logging.getLogger().info("fastlist %s: replication %s on %s:%s"%(self.dataset.filename,self.role,self.bind[0],self.bind[1]))
+
+    def close(self):
+        self.stay_alive=False
+        if self.sock!=None:
+            self.sock.close()
+            self.sock=None
+
+    def _send(self,message,addr):
+        try:
+            self.sock.sendto(message,addr)
+        except socket.error,e:
+            logging.getLogger().warn("fastlist %s: could not send replication message to %s:%s: %s"%(self.dataset.filename,addr[0],addr[1],str(e)))
+
+    def run(self):
+        lastheartbeat=0
+        while self.stay_alive:
+            sock=self.sock
+            if sock==None:
+                return
+            try:
+                ready=select.select([sock],[],[],1.0)[0]
+                if ready:
+                    message,addr=sock.recvfrom(65535)
+                    self.handle(message,addr)
+                if self.role=='primary' and time.time()-lastheartbeat>=1.0:
+                    lastheartbeat=time.time()
+                    self.heartbeat()
+            except Exception:
+                if not self.stay_alive:
+                    return
+                logging.getLogger().error("fastlist %s: replication failed: %s"%(self.dataset.filename,traceback.format_exc()))
+                time.sleep(1)
+
+    def handle(self,message,addr):
+        if len(message)<_header.size:
+            return
+        kind,epoch,seq=_header.unpack_from(message,0)
+        if self.role=='primary':
+            if kind=='A':
+                self.acknowledged(addr,seq)
+            elif kind=='R':
+                self.catch_up(addr,seq)
+        else:
+            if addr!=self.primary:
+                logging.getLogger().warn("fastlist %s: ignoring replication message from %s:%s, not our primary"%(self.dataset.filename,addr[0],addr[1]))
+                return
+            if kind=='C':
+                self.received_change(addr,epoch,seq,message[_header.size:])
+            elif kind=='H':
+                self.received_heartbeat(addr,epoch,seq)
+            elif kind=='F':
+                self.received_chunk(addr,epoch,seq,message[_header.size:])
+
+    #primary
+
+    def publish(self,frames):
+        """number and send journal frames of applied changes. called by the fastlist writer thread, the only
+        thread applying changes, right after each batch, so the sequence numbers follow the order the changes
+        were applied in"""
+        for data in pack_frames(frames,MAXDATAGRAM-_header.size):
+            self._lock.acquire()
+            try:
+                self.seq+=1
+                message=_header.pack('C',self.epoch,self.seq)+data
+                self.ring.append((self.seq,message))
+            finally:
+                self._lock.release()
+            if self.sock==None:
+                continue
+            for peer in self.peers:
+                self._send(message,peer)
+
+    def heartbeat(self):
+        message=_header.pack('H',self.epoch,self.seq)
+        for peer in self.peers:
+            self._send(message,peer)
+
+    def acknowledged(self,addr,seq):
+        if addr not in self.peers:
+            return
+        self.peers[addr]=[seq,time.time()]
+
+    def catch_up(self,addr,first):
+        if addr not in self.peers:
+            logging.getLogger().warn("fastlist %s: ignoring catch-up request from unknown peer %s:%s"%(self.dataset.filename,addr[0],addr[1]))
+            return
+        self._lock.acquire()
+        try:
+            oldest=self.ring and self.ring[0][0] or None
+            missing=[message for seq,message in self.ring if seq>=first]
+        finally:
+            self._lock.release()
+        if first>0 and oldest!=None and first>=oldest:
+            logging.getLogger().info("fastlist %s: sending %s changes from %s to %s:%s"%(self.dataset.filename,len(missing),first,addr[0],addr[1]))
+            for message in missing:
+                self._send(message,addr)
+        else:
+            self.send_zone(addr)
+
+    def send_zone(self,addr):
+        dataset=self.dataset
+        #the sequence number of the snapshot, read between two writes
+        view,seq=dataset.write(lambda: (dataset.snapshot(),self.seq))
+        items=view.items()
+        chunks=pack_frames([encode_add(name,rec) for name,rec in items],MAXDATAGRAM-_header.size-_chunk.size) or ['']
+        logging.getLogger().info("fastlist %s: sending the whole zone (%s records as of %s) to %s:%s"%(dataset.filename,len(items),seq,addr[0],addr[1]))
+        for index,data in enumerate(chunks):
+            self._send(_header.pack('F',self.epoch,seq)+_chunk.pack(index,len(chunks))+data,addr)
+
+    #replica
+
+    def request(self,first):
+        """ask the primary for changes from first on, at most once a second for the same sequence number"""
+        now=time.time()
+        lastfirst,lasttime=self._lastrequest
+        if lastfirst==first and now-lasttime<1.0:
+            return
+        self._lastrequest=(first,now)
+        self._send(_header.pack('R',self.epoch or 0,first),self.primary)
+
+    def acknowledge(self):
+        self._send(_header.pack('A',self.epoch or 0,self.seq),self.primary)
+
+    def received_heartbeat(self,addr,epoch,seq):
+        self.primaryseq=seq
+        if epoch!=self.epoch:
+            #first contact or the primary restarted
+            self.request(0)
+        elif seq>self.seq:
+            self.request(self.seq+1)
+        else:
+            self.acknowledge()
+
+    def received_change(self,addr,epoch,seq,data):
+        self.primaryseq=max(self.primaryseq,seq)
+        if epoch!=self.epoch:
+            self.request(0)
+            return
+        if seq<=self.seq:
+            return
+        if seq>self.seq+1:
+            self.request(self.seq+1)
+            return
+        records,pos=decode_records(data)
+        self.dataset.apply_records(records)
+        self.seq=seq
+        self.acknowledge()
+
+    def received_chunk(self,addr,epoch,seq,data):
+        index,count=_chunk.unpack_from(data,0)
+        resync=self._resync
+        if resync==None or resync[0]!=(epoch,seq) or resync[1]!=count:
+            resync=((epoch,seq),count,{})
+            self._resync=resync
+        records,pos=decode_records(data,_chunk.size)
+        resync[2][index]=records
+        if len(resync[2])<count:
+            return
+        self._resync=None
+
+        zone={}
+        for index in range(count):
+            for op,name,rec in resync[2][index]:
+                zone[name]=rec
+        current=self.dataset.backend
+        changes=[('d',name,None) for name in current.keys() if name not in zone]
+        changes.extend([('a',name,rec) for name,rec in zone.iteritems() if current.get(name)!=rec])
+        self.dataset.apply_records(changes)
+        self.epoch=epoch
+        self.seq=seq
+        logging.getLogger().info("fastlist %s: caught up to %s, %s changes"%(self.dataset.filename,seq,len(changes)))
+        #changes published while the zone was sent
+        if self.primaryseq>seq:
+            self.request(seq+1)
+        else:
+            self.acknowledge()
+
+    def stats(self):
+        """primary: list of (peer,lag in changes,seconds since the last acknowledgement or None)
+        replica: list with one (primary,lag,None)"""
+        if self.role=='replica':
+            return [(self.primary,max(0,self.primaryseq-self.seq),None)]
+        now=time.time()
+        result=[]
+        for peer,(seq,acktime) in sorted(self.peers.items()):
+            age=None
+            if acktime!=None:
+                age=now-acktime
+            result.append((peer,self.seq-seq,age))
+        return result
@@ -143,6 +143,11 @@ class RuleyConsole(object):
         output=templateobj.safe_substitute(realvars)
         return output
     
+    def render(self):
+        """returns one complete screen of the predefined template, including the clear code"""
+        t=string.Template(self.template)
+        return ConsoleConstants.CODE_CLEAR+self._apply_template(t, self.templatevars)
+    
     def stop_looping(self):
         self.stoplooping=1
         
@@ -0,0 +1,203 @@
+"""precompiled binary dataset snapshots
+
+A snapshot stores the index built from a dataset source file, so the text parser only has to run when the
+source has changed. It is written next to the source file (<source>.snapshot) and mapped back in with mmap.
+
+layout:
+    header: magic, version, source size, source mtime, sha1 of the source, offset and length of the metadata
+    arrays: the raw integer and character arrays of the index, each aligned to 8 bytes
+    metadata: json of (dataset type, byte order, array descriptors, dataset state, reload defaults)
+
+arrays are not copied when a snapshot is loaded, they are ctypes arrays on top of a private mapping
+
+The metadata is not a pickle: whoever can write next to a zone file must not be able to run code by placing a
+snapshot there. Strings are stored as latin-1, tuples, dicts and the objects of classes registered with
+register_state_class are tagged json objects.
+"""
+import os
+import sys
+import mmap
+import json
+import struct
+import ctypes
+import hashlib
+import logging
+
+MAGIC='RBLDSNAP'
+VERSION=4
+
+_header=struct.Struct('!8sIQd20sQQ')
+
+CTYPES={
+    'c':ctypes.c_char,
+    'I':ctypes.c_uint32,
+    'i':ctypes.c_int32,
+}
+
+
+def snapshot_filename(filename):
+    return filename+'.snapshot'
+
+
+#class name -> (class, object -> state, state -> object)
+_stateclasses={}
+
+def register_state_class(cls,getstate,fromstate):
+    """allow objects of cls in the dataset state and reload defaults of a snapshot"""
+    _stateclasses[cls.__name__]=(cls,getstate,fromstate)
+
+
+def _encode(value):
+    if isinstance(value,tuple):
+        return {'t':[_encode(item) for item in value]}
+    if isinstance(value,list):
+        return [_encode(item) for item in value]
+    if isinstance(value,dict):
+        return {'d':[[_encode(key),_encode(item)] for key,item in value.iteritems()]}
+    if value==None or isinstance(value,(str,bool,int,long,float)):
+        return value
+    name=value.__class__.__name__
+    if name not in _stateclasses or _stateclasses[name][0] is not value.__class__:
+        raise ValueError("can not store %s in a snapshot"%name)
+    return {'o':name,'v':_encode(_stateclasses[name][1](value))}
+
+
+def _decode(value):
+    if isinstance(value,unicode):
+        return value.encode('latin-1')
+    if isinstance(value,list):
+        return [_decode(item) for item in value]
+    if isinstance(value,dict):
+        if 't' in value:
+            return tuple([_decode(item) for item in value['t']])
+        if 'd' in value:
+            return dict([(_decode(key),_decode(item)) for key,item in value['d']])
+        cls,getstate,fromstate=_stateclasses[value['o']]
+        return fromstate(_decode(value['v']))
+    return value
+
+
+def encode_meta(meta):
+    return json.dumps(_encode(meta),encoding='latin-1',separators=(',',':'))
+
+
+def decode_meta(data):
+    return _decode(json.loads(data,encoding='latin-1'))
+
+
+def _align(offset):
+    return (offset+7) & ~7
+
+
+class SourceInfo(object):
+    """size, mtime and sha1 of a dataset source file"""
+
+    def __init__(self,size,mtime,digest):
+        self.size=size
+        self.mtime=mtime
+        self.digest=digest
+
+
+def stat_source(filename):
+    """SourceInfo without digest"""
+    statinfo=os.stat(filename)
+    return SourceInfo(statinfo.st_size,statinfo.st_mtime,None)
+
+
+def hash_source(filename):
+    sha=hashlib.sha1()
+    handle=open(filename,'rb')
+    try:
+        while True:
+            chunk=handle.read(1024*1024)
+            if not chunk:
+                break
+            sha.update(chunk)
+    finally:
+        handle.close()
+    return sha.digest()
+
+
+def write_snapshot(filename,source,datasettype,arrays,state,defaults):
+    """write a snapshot for the dataset source filename
+
+    source: SourceInfo of the data the index was built from
+    arrays: list of array.array with typecode c, I or i
+    state: dataset specific data, made of None, numbers, str, tuples, lists, dicts and registered classes
+    """
+    descriptors=[]
+    offset=_align(_header.size)
+    for arr in arrays:
+        if arr.typecode not in CTYPES or arr.itemsize!=ctypes.sizeof(CTYPES[arr.typecode]):
+            raise ValueError("unsupported array type %s"%arr.typecode)
+        descriptors.append((arr.typecode,offset,len(arr)))
+        offset=_align(offset+len(arr)*arr.itemsize)
+    meta=encode_meta((datasettype,sys.byteorder,descriptors,state,defaults))
+    metaoffset=offset
+
+    path=snapshot_filename(filename)
+    tmppath="%s.tmp.%s"%(path,os.getpid())
+    handle=open(tmppath,'wb')
+    try:
+        handle.write(_header.pack(MAGIC,VERSION,source.size,source.mtime,source.digest,metaoffset,len(meta)))
+        for arr,(typecode,arroffset,count) in zip(arrays,descriptors):
+            handle.write('\0'*(arroffset-handle.tell()))
+            handle.write(arr.tostring())
+        handle.write('\0'*(metaoffset-handle.tell()))
+        handle.write(meta)
+        handle.flush()
+        os.fsync(handle.fileno())
+    finally:
+        handle.close()
+    os.rename(tmppath,path)
+    return path
+
+
+def read_snapshot(filename,datasettype):
+    """map the snapshot of filename if it is still valid for the current source
+
+    returns (arrays,state,defaults,digest) or None if there is no usable snapshot, digest is the sha1 of the source
+    """
+    path=snapshot_filename(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        handle=open(path,'rb')
+    except IOError:
+        return None
+    try:
+        header=handle.read(_header.size)
+        if len(header)!=_header.size:
+            return None
+        magic,version,size,mtime,digest,metaoffset,metalength=_header.unpack(header)
+        if magic!=MAGIC or version!=VERSION:
+            logging.getLogger().info("ignoring snapshot %s: unsupported format"%path)
+            return None
+
+        current=stat_source(filename)
+        if current.size!=size or current.mtime!=mtime:
+            return None
+        current.digest=hash_source(filename)
+        if current.digest!=digest:
+            return None
+
+        if os.fstat(handle.fileno()).st_size<metaoffset+metalength:
+            logging.getLogger().warning("ignoring truncated snapshot %s"%path)
+            return None
+        #private mapping: ctypes needs a writable buffer, pages are still shared with the page cache until written
+        mapped=mmap.mmap(handle.fileno(),0,access=mmap.ACCESS_COPY)
+    finally:
+        handle.close()
+
+    try:
+        snaptype,byteorder,descriptors,state,defaults=decode_meta(mapped[metaoffset:metaoffset+metalength])
+    except Exception:
+        logging.getLogger().warning("ignoring corrupt snapshot %s"%path)
+        return None
+    if snaptype!=datasettype or byteorder!=sys.byteorder:
+        return None
+
+    arrays=[]
+    for typecode,offset,count in descriptors:
+        arrays.append((CTYPES[typecode]*count).from_buffer(mapped,offset))
+    return arrays,state,defaults,digest
@@ -15,11 +15,68 @@ def ip2long(ip):
     lng = struct.unpack("!L", packed)[0]
     return lng
 
+#key types of a query, datasets only answer the type they can match
+QUERY_IP4='ip4'
+QUERY_IP6='ip6'
+QUERY_NAME='name'
+QUERY_TYPES=(QUERY_IP4,QUERY_IP6,QUERY_NAME)
+
+_hexdigits=frozenset('0123456789abcdefABCDEF')
+
+#decimal label -> octet value, with and without leading zeros
+_octets={}
+for _value in range(256):
+    for _label in (str(_value),'%02d'%_value,'%03d'%_value):
+        _octets[_label]=_value
+del _value,_label
+
+#reversed dotted quad -> address, shared by all zones. cleared when full
+_ip4cache={}
+IP4CACHESIZE=10000
+
+def parse_ip4_query(query):
+    """address of a reversed dotted quad query ('4.3.2.1' -> 0x01020304) as integer, None if query is not one
+    only decimal labels 0-255 are accepted, unlike inet_aton"""
+    ip=_ip4cache.get(query)
+    if ip!=None:
+        return ip
+    labels=query.split('.')
+    if len(labels)!=4:
+        return None
+    try:
+        ip=_octets[labels[3]]<<24|_octets[labels[2]]<<16|_octets[labels[1]]<<8|_octets[labels[0]]
+    except KeyError:
+        return None
+    if len(_ip4cache)>=IP4CACHESIZE:
+        _ip4cache.clear()
+    _ip4cache[query]=ip
+    return ip
+
+def classify_query(query):
+    """returns (key type, key) of the query labels in front of the zone
+    QUERY_IP4: reversed dotted quad, the key is the address as 32 bit integer
+    QUERY_IP6: reversed nibbles, the key is the query
+    QUERY_NAME: anything else, the key is the query"""
+    ip=parse_ip4_query(query)
+    if ip!=None:
+        return QUERY_IP4,ip
+    labels=query.split('.')
+    if len(labels)==32:
+        for label in labels:
+            if len(label)!=1 or label not in _hexdigits:
+                break
+        else:
+            return QUERY_IP6,query
+    return QUERY_NAME,query
+
 def long2ip(lng):
     packed = struct.pack("!L", lng)
     ip=inet_ntoa(packed)
     return ip
 
+def long2packed(lng):
+    return struct.pack("!L", lng)
+
 
 def cidr2lowerupper(ip_str, mask_cidr):
     """returns tuple ((network_itn, network_str), (broadcast_int, broadcast_str))
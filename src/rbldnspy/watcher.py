@@ -0,0 +1,228 @@
+"""one watcher for all dataset files
+
+Uses inotify (through ctypes) on the directories of the watched files, so rename-into-place, close-after-write
+and deletes are noticed immediately. Events for one file are debounced and reported once. Every file is also
+stat()ed every `interval` seconds, which is the only detection where inotify is not available.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import thread
+import traceback
+from threading import Lock
+
+IN_MODIFY=0x00000002
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_Q_OVERFLOW=0x00004000
+IN_NONBLOCK=0o4000
+IN_CLOEXEC=0o2000000
+
+DIRMASK=IN_MODIFY|IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE|IN_DELETE
+
+_event=struct.Struct('iIII')
+
+available=False
+_libc=None
+try:
+    _libc=ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    available=hasattr(_libc,'inotify_init1') and hasattr(_libc,'inotify_add_watch')
+except:
+    pass
+
+
+def _stat_key(path):
+    try:
+        statinfo=os.stat(path)
+    except OSError:
+        return None
+    return (statinfo.st_ino,statinfo.st_size,statinfo.st_mtime)
+
+
+class FileWatcher(object):
+    """calls callback(path) shortly after a watched file changed
+
+    debounce: seconds without further events before a change is reported
+    interval: seconds between stat() polls of all files
+    """
+
+    def __init__(self,interval=60,debounce=0.5,useinotify=True):
+        self.interval=interval
+        self.debounce=debounce
+        self.stay_alive=True
+        #path -> (callback, last stat key)
+        self._files={}
+        #directory -> set of watched paths in it
+        self._dirs={}
+        #inotify watch descriptor -> directory
+        self._wds={}
+        #path -> time the change should be reported
+        self._pending={}
+        self._lock=Lock()
+        self._lastpoll=time.time()
+
+        self.fd=None
+        if useinotify and available:
+            fd=_libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+            if fd<0:
+                logging.getLogger().warning("inotify not available (%s), polling dataset files every %s seconds"%(os.strerror(ctypes.get_errno()),interval))
+            else:
+                self.fd=fd
+
+    def add(self,path,callback):
+        path=os.path.realpath(path)
+        directory=os.path.dirname(path)
+        self._lock.acquire()
+        try:
+            self._files[path]=(callback,_stat_key(path))
+            if directory in self._dirs:
+                self._dirs[directory].add(path)
+                return
+            self._dirs[directory]=set([path])
+        finally:
+            self._lock.release()
+
+        if self.fd!=None:
+            wd=_libc.inotify_add_watch(self.fd,directory,DIRMASK)
+            if wd<0:
+                logging.getLogger().warning("could not watch %s: %s - relying on polling"%(directory,os.strerror(ctypes.get_errno())))
+            else:
+                self._wds[wd]=directory
+
+    def fileno(self):
+        return self.fd
+
+    def setblocking(self,flag):
+        """the inotify descriptor is always non-blocking, this only exists for EventLoop.add_reader"""
+        pass
+
+    def _mark(self,path,now):
+        self._pending[path]=now+self.debounce
+
+    def read_events(self):
+        """read all queued inotify events and schedule the affected files"""
+        if self.fd==None:
+            return
+        now=time.time()
+        while True:
+            try:
+                data=os.read(self.fd,65536)
+            except OSError,e:
+                if e.errno==errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return
+            pos=0
+            while pos+_event.size<=len(data):
+                wd,mask,cookie,namelen=_event.unpack_from(data,pos)
+                name=data[pos+_event.size:pos+_event.size+namelen].rstrip('\0')
+                pos+=_event.size+namelen
+                self._lock.acquire()
+                try:
+                    if mask & IN_Q_OVERFLOW:
+                        #lost events, check everything
+                        for path in self._files:
+                            self._mark(path,now)
+                        continue
+                    directory=self._wds.get(wd)
+                    if directory==None:
+                        continue
+                    path=os.path.join(directory,name)
+                    if path in self._files:
+                        self._mark(path,now)
+                finally:
+                    self._lock.release()
+
+    def poll(self):
+        """stat all files and schedule the ones that changed"""
+        now=time.time()
+        self._lastpoll=now
+        self._lock.acquire()
+        try:
+            for path,(callback,oldkey) in self._files.items():
+                key=_stat_key(path)
+                if key!=oldkey and key!=None:
+                    self._mark(path,now)
+        finally:
+            self._lock.release()
+
+    def fire_due(self):
+        """report changes whose debounce time has passed"""
+        now=time.time()
+        due=[]
+        self._lock.acquire()
+        try:
+            for path,when in self._pending.items():
+                if when>now:
+                    continue
+                del self._pending[path]
+                key=_stat_key(path)
+                if key==None:
+                    #removed or not renamed into place yet, wait for the next event
+                    continue
+                callback,oldkey=self._files[path]
+                self._files[path]=(callback,key)
+                due.append((path,callback))
+        finally:
+            self._lock.release()
+
+        for path,callback in due:
+            try:
+                callback(path)
+            except Exception:
+                logging.getLogger().error("change callback for %s failed: %s"%(path,traceback.format_exc()))
+
+    def _next_timeout(self):
+        timeout=self._lastpoll+self.interval-time.time()
+        self._lock.acquire()
+        try:
+            if self._pending:
+                timeout=min(timeout,min(self._pending.values())-time.time())
+        finally:
+            self._lock.release()
+        return max(0,timeout)
+
+    def run(self):
+        while self.stay_alive:
+            timeout=min(self._next_timeout(),1.0)
+            if self.fd!=None:
+                try:
+                    ready=select.select([self.fd],[],[],timeout)[0]
+                except select.error:
+                    ready=[]
+                if ready:
+                    self.read_events()
+            else:
+                time.sleep(timeout)
+            if time.time()>=self._lastpoll+self.interval:
+                self.poll()
+            self.fire_due()
+
+    def start(self):
+        thread.start_new_thread(self.run,())
+
+    def attach(self,loop):
+        """let an EventLoop drive this watcher instead of our own thread"""
+        if self.fd!=None:
+            loop.add_reader(self,self.read_events)
+        loop.call_every(min(self.debounce,1.0),self.fire_due)
+        loop.call_every(self.interval,self.poll)
+
+    def close(self):
+        self.stay_alive=False
+        if self.fd!=None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd=None
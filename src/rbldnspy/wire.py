@@ -0,0 +1,116 @@
+"""minimal dns wire format handling for the query hot path
+
+Only plain, single question A/TXT queries of class IN are decoded here. Everything else (other opcodes, multiple
+questions, compression pointers in the question, unsupported qtypes or classes) makes parse_query return None and the caller should
+fall back to dnslib.
+"""
+import struct
+from socket import inet_aton
+
+QTYPE_A=1
+QTYPE_TXT=16
+
+QCLASS_IN=1
+
+#query types handled by the fast path
+QTYPES={
+    QTYPE_A:'A',
+    QTYPE_TXT:'TXT',
+}
+
+FLAG_QR=0x8000
+FLAG_AA=0x0400
+FLAG_RD=0x0100
+FLAG_RA=0x0080
+OPCODE_MASK=0x7800
+RCODE_MASK=0x000F
+
+_header=struct.Struct('!HHHHHH')
+_rrheader=struct.Struct('!HHIH')
+
+#compression pointer to the qname at offset 12
+_QNAME_POINTER='\xc0\x0c'
+
+
+class WireQuery(object):
+    """the parts of a query packet we need to answer it"""
+    __slots__=('id','flags','qname','qtype','qtypecode','qclass','qend')
+
+    def __init__(self,qid,flags,qname,qtypecode,qclass,qend):
+        self.id=qid
+        self.flags=flags
+        self.qname=qname
+        self.qtypecode=qtypecode
+        self.qtype=QTYPES[qtypecode]
+        self.qclass=qclass
+        self.qend=qend
+
+
+def parse_query(packet):
+    """decode a raw query packet. returns a WireQuery or None if the packet needs the full dnslib parser"""
+    plen=len(packet)
+    if plen<17:
+        return None
+    qid,flags,qdcount,ancount,nscount,arcount=_header.unpack_from(packet)
+    if flags & (FLAG_QR|OPCODE_MASK) or qdcount!=1 or ancount or nscount:
+        return None
+
+    labels=[]
+    i=12
+    while True:
+        if i>=plen:
+            return None
+        labellen=ord(packet[i])
+        if labellen==0:
+            break
+        if labellen & 0xC0:
+            #compression pointer or extended label type
+            return None
+        label=packet[i+1:i+1+labellen]
+        if '.' in label:
+            return None
+        labels.append(label)
+        i+=labellen+1
+
+    qend=i+5
+    if qend>plen:
+        return None
+    qtypecode,qclass=struct.unpack_from('!HH',packet,i+1)
+    if qtypecode not in QTYPES or qclass!=QCLASS_IN:
+        return None
+    return WireQuery(qid,flags,'.'.join(labels)+'.',qtypecode,qclass,qend)
+
+
+def error_response(packet,query,rcode):
+    """build an empty reply with the given rcode, echoing the question"""
+    flags=FLAG_QR|FLAG_AA|(query.flags&FLAG_RD)|FLAG_RA|rcode
+    return _header.pack(query.id,flags,1,0,0,0)+packet[12:query.qend]
+
+
+def _txt_rdata(txt):
+    chunks=[]
+    for i in range(0,max(len(txt),1),255):
+        chunk=txt[i:i+255]
+        chunks.append(chr(len(chunk))+chunk)
+    return ''.join(chunks)
+
+
+def answer_response(packet,query,answers):
+    """build a NOERROR reply for query
+    answers: list of tuples (value, ttl) where value is an ip address for A queries or the text for TXT queries
+    """
+    flags=((query.flags|FLAG_QR|FLAG_AA) & ~FLAG_RA) & ~RCODE_MASK
+    parts=[_header.pack(query.id,flags,1,len(answers),0,0),packet[12:query.qend]]
+    for value,ttl in answers:
+        if query.qtypecode==QTYPE_A:
+            rdata=inet_aton(value)
+        else:
+            if isinstance(value,unicode):
+                value=value.encode('utf-8')
+            rdata=_txt_rdata(value)
+        if ttl==None:
+            ttl=0
+        parts.append(_QNAME_POINTER)
+        parts.append(_rrheader.pack(query.qtypecode,QCLASS_IN,ttl,len(rdata)))
+        parts.append(rdata)
+    return ''.join(parts)
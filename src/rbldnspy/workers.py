@@ -0,0 +1,135 @@
+import os
+import socket
+import signal
+import logging
+import threading
+import traceback
+from multiprocessing.sharedctypes import RawArray
+
+#linux value, not exported by all python versions
+SO_REUSEPORT=getattr(socket,'SO_REUSEPORT',15)
+
+
+def reset_logging_locks():
+    """locks held by other threads at fork time stay locked forever in the child"""
+    logging._lock=threading.RLock()
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+
+
+class WorkerPool(object):
+    """Forks worker processes which serve dns queries on their own SO_REUSEPORT sockets
+
+    Datasets are loaded in the parent before forking, so every worker starts with a complete copy.
+    Fastlist datasets only receive updates in the parent, which forwards every accepted fastlist packet
+    to each worker over a unix socketpair.
+
+    target: callable(index, fastlistsockets) which runs the worker, fastlistsockets is a list of tuples (dataset, socket)
+    fastlists: list of fastlist datasets to forward to the workers
+    """
+
+    def __init__(self,count,target,fastlists=None):
+        self.count=count
+        self.target=target
+        if fastlists==None:
+            fastlists=[]
+        self.fastlists=fastlists
+
+        #one query counter per worker slot, shared with the children
+        self.querycounters=RawArray('L',count)
+        self.pids=[None for x in range(count)]
+        #per worker slot: list of (dataset, parent end of the socketpair)
+        self._subscriptions=[[] for x in range(count)]
+        self.stay_alive=True
+
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+
+    def spawn(self,index):
+        pairs=[]
+        for dataset in self.fastlists:
+            parentsock,childsock=socket.socketpair(socket.AF_UNIX,socket.SOCK_DGRAM)
+            pairs.append((dataset,parentsock,childsock))
+
+        pid=os.fork()
+        if pid==0:
+            exitcode=0
+            try:
+                reset_logging_locks()
+                for dataset,parentsock,childsock in pairs:
+                    parentsock.close()
+                for subscriptions in self._subscriptions:
+                    for dataset,parentsock in subscriptions:
+                        parentsock.close()
+                self.target(index,[(dataset,childsock) for dataset,parentsock,childsock in pairs])
+            except:
+                logging.getLogger().error("worker %s crashed: %s"%(index,traceback.format_exc()))
+                exitcode=1
+            #never return into the parent's code (atexit handlers, main loop)
+            os._exit(exitcode)
+
+        subscriptions=[]
+        for dataset,parentsock,childsock in pairs:
+            childsock.close()
+            parentsock.setblocking(0)
+            dataset.add_subscriber(parentsock)
+            subscriptions.append((dataset,parentsock))
+        self._subscriptions[index]=subscriptions
+        self.pids[index]=pid
+        logging.getLogger().info("started worker %s with pid %s"%(index,pid))
+
+    def _unsubscribe(self,index):
+        for dataset,parentsock in self._subscriptions[index]:
+            dataset.remove_subscriber(parentsock)
+            try:
+                parentsock.close()
+            except:
+                pass
+        self._subscriptions[index]=[]
+
+    def check(self):
+        """reap dead workers and start replacements"""
+        for index in range(self.count):
+            pid=self.pids[index]
+            if pid==None:
+                continue
+            try:
+                wpid,status=os.waitpid(pid,os.WNOHANG)
+            except OSError:
+                wpid=pid
+            if wpid==0:
+                continue
+
+            self.pids[index]=None
+            self._unsubscribe(index)
+            if self.stay_alive:
+                logging.getLogger().warning("worker %s (pid %s) died - restarting"%(index,pid))
+                self.spawn(index)
+
+    def shutdown(self):
+        self.stay_alive=False
+        for pid in self.pids:
+            if pid==None:
+                continue
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass
+
+        for index in range(self.count):
+            pid=self.pids[index]
+            if pid==None:
+                continue
+            try:
+                os.waitpid(pid,0)
+            except OSError:
+                pass
+            self.pids[index]=None
+            self._unsubscribe(index)
+
+    def alive_count(self):
+        return len([pid for pid in self.pids if pid!=None])
+
+    def query_counts(self):
+        return list(self.querycounters)
@@ -1,40 +1,123 @@
+from threading import Lock
+from tools import classify_query, QUERY_IP4, QUERY_NAME, QUERY_TYPES
 
 
-class Zone(object):
-    def __init__(self,name):
-        self.datasets=[]
-        self.name=name
-        
-    def add_dataset(self,dataset):
-        self.datasets.append(dataset)
-        
-    def lookup(self,query):
-        """Returns answer of given query after consulting all datasets Returns None for NXDOMAIN"""
+class ZoneGeneration(object):
+    """immutable state of a zone: frozen views of its datasets and the authority data taken from them"""
+    def __init__(self,number,datasets):
+        self.number=number
+        self.datasets=datasets
+        #key type -> datasets which can match queries of that type, in zone order
+        self.bykeytype={}
+        for dataset in datasets:
+            keytypes=(dataset.keytype,)
+            if dataset.keytype==None:
+                keytypes=QUERY_TYPES
+            for keytype in keytypes:
+                self.bykeytype.setdefault(keytype,[]).append(dataset)
+        #a dnset can list names that look like reversed ipv4 addresses, asked when no ip dataset lists the query
+        self.ip4fallback=[dataset for dataset in self.bykeytype.get(QUERY_NAME,()) if dataset.keytype==QUERY_NAME]
+
         soa=None
         ns=None
         nsttl=None
         soattl=None
-        
-        reslist=[]
-        for dataset in self.datasets:                
+        for dataset in datasets:
+            if dataset.defaults==None:
+                continue
             if ns==None and dataset.ns!=None:
                 ns=dataset.ns
                 if dataset.nsttl!=0:
                     nsttl=dataset.nsttl
-                
+
             if soa==None and dataset.soa!=None:
                 soa=dataset.soa[1:]
                 soattl=dataset.soa[0]
-                
-            if query!='':
-                result = dataset.get(query)
+        if ns==None:
+            ns=[]
+        #tuple (soa,soattl,ns,nsttl)
+        self.authority=(soa,soattl,ns,nsttl)
+
+    def get_generation(self):
+        #fastlist datasets are live and change without a new zone generation
+        generation=0
+        for dataset in self.datasets:
+            generation+=dataset.generation
+        return generation
+
+
+class Zone(object):
+    def __init__(self,name):
+        self.datasets=[]
+        self.name=name
+        #publish a new generation only when no dataset of the zone is reloading (-f)
+        self.batchpublish=False
+        #stop at the first dataset listing the query
+        self.firstmatch=False
+        self._publishlock=Lock()
+        self.current=ZoneGeneration(0,())
+
+    def apply_config(self,config):
+        """options from the [zone:<name>] config section"""
+        section='zone:%s'%self.name
+        if config.has_option(section,'firstmatch'):
+            self.firstmatch=config.getboolean(section,'firstmatch')
+
+    def add_dataset(self,dataset):
+        self.datasets.append(dataset)
+        dataset.add_reload_listener(self.dataset_reloaded)
+        self.publish()
+
+    def dataset_reloaded(self,dataset):
+        if self.batchpublish and self.is_reloading():
+            #the last dataset to finish publishes all of them
+            return
+        self.publish()
+
+    def publish(self):
+        """make the currently loaded data of all datasets visible to lookups with one reference swap.
+        lookups running on the old generation finish with it, then it is freed"""
+        self._publishlock.acquire()
+        try:
+            views=tuple([dataset.frozen_view() for dataset in self.datasets])
+            self.current=ZoneGeneration(self.current.number+1,views)
+        finally:
+            self._publishlock.release()
+
+    def get_authority(self):
+        """returns a tuple (soa,soattl,ns,nsttl) from the first datasets defining them"""
+        return self.current.authority
+
+    def lookup(self,query):
+        """Returns answer of given query after consulting all datasets Returns None for NXDOMAIN"""
+        generation=self.current
+        soa,soattl,ns,nsttl=generation.authority
+
+        reslist=[]
+        if query!='':
+            #classified once, only datasets of the matching key type are asked
+            keytype,key=classify_query(query)
+            listed=False
+            for dataset in generation.bykeytype.get(keytype,()):
+                if keytype==QUERY_IP4:
+                    result = dataset.get_ip4(key,query)
+                else:
+                    result = dataset.get(query)
                 if type(result)==list:
                     reslist.extend(result)
                 else:
                     reslist.append(result)
-               
-        if ns==None:
-            ns=[] 
+                if result:
+                    listed=True
+                    if self.firstmatch:
+                        break
+            if keytype==QUERY_IP4 and not listed:
+                for dataset in generation.ip4fallback:
+                    result = dataset.get(query)
+                    reslist.append(result)
+                    if self.firstmatch and result:
+                        break
+
         retpack={
                  'SOA':soa,
                  'NS':ns,
@@ -45,23 +128,27 @@ class Zone(object):
         if soattl!=None:
             retpack['SOATTL']=soattl
         return retpack
-    
+
+    def get_generation(self):
+        """returns a number that changes whenever the data served by this zone changes"""
+        return self.current.get_generation()
+
     def reload_all(self):
         for ds in self.datasets:
             ds.reload()
-            
+
     def __str__(self):
         return self.name
-            
+
     def is_available(self):
-        for dataset in self.datasets:
+        for dataset in self.current.datasets:
             if not dataset.available:
                 return False
-        return True
-        
+        return len(self.current.datasets)==len(self.datasets)
+
     def is_reloading(self):
         for dataset in self.datasets:
-            if dataset.reloading:
+            if dataset.reloading or dataset.reloadqueued:
                 return True
         return False
-        
+
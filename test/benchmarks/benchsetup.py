@@ -0,0 +1,25 @@
+import os
+import sys
+import time
+
+BENCHDIR = os.path.dirname(os.path.realpath(__file__))
+CODEDIR = os.path.abspath(BENCHDIR + '../../../src')
+
+sys.path.insert(0, CODEDIR)
+
+
+def timeit(func, *args):
+    """returns the runtime of func(*args) in seconds"""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def report(label, count, seconds, unit="ops"):
+    print "%-40s %10.0f %s/sec  (%d in %.2fs)" % (label, count / seconds, unit, count, seconds)
+
+
+def rss_bytes():
+    """resident set size of this process (linux only)"""
+    pagesize = os.sysconf('SC_PAGE_SIZE')
+    return int(open('/proc/self/statm').read().split()[1]) * pagesize
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""compares the ip4set backends: load time, memory per record and lookups/sec
+the sorted array set is also loaded a second time from the snapshot written by the first load
+
+usage: ip4set_bench.py [number of records]
+"""
+import benchsetup
+from benchsetup import timeit, report, rss_bytes
+
+import sys
+import os
+import gc
+import random
+import logging
+from tempfile import mkstemp
+
+from rbldnspy.dataset import IntervalTreeSet, SortedArraySet
+from rbldnspy.snapshot import snapshot_filename
+from rbldnspy.tools import long2ip, ipreverse
+
+
+def make_datafile(count):
+    rnd = random.Random(1)
+    (fd, name) = mkstemp(".rbldns", text=True)
+    handle = os.fdopen(fd, 'w')
+    handle.write(":127.0.0.2:$ is listed\n")
+    for i in xrange(count):
+        ip = long2ip(rnd.randint(0x01000000, 0xDF000000))
+        kind = rnd.random()
+        if kind < 0.7:
+            handle.write("%s\n" % ip)
+        elif kind < 0.9:
+            handle.write("%s/24 :3:listed network\n" % ip)
+        elif kind < 0.98:
+            handle.write("%s-255\n" % ip)
+        else:
+            handle.write("!%s\n" % ip)
+    handle.close()
+    return name
+
+
+def make_queries(count):
+    rnd = random.Random(2)
+    return [ipreverse(long2ip(rnd.randint(0x01000000, 0xDF000000))) for i in xrange(count)]
+
+
+def lookups(dataset, queries):
+    for q in queries:
+        dataset.get(q)
+
+
+def bench(label, datasetclass, filename, count, queries, snapshots=False):
+    gc.collect()
+    before = rss_bytes()
+    dataset = datasetclass(filename)
+    dataset.snapshots = snapshots
+    loadtime = timeit(dataset.reload)
+    gc.collect()
+    used = rss_bytes() - before
+    report("%s load" % label, count, loadtime, "records")
+    print "%-40s %10.1f bytes/record" % ("%s memory" % label, float(used) / count)
+    report("%s lookup" % label, len(queries), timeit(lookups, dataset, queries), "lookups")
+    del dataset
+
+
+if __name__ == '__main__':
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    filename = make_datafile(count)
+    queries = make_queries(50000)
+    try:
+        bench("sorted array", SortedArraySet, filename, count, queries, True)
+        bench("sorted array from snapshot", SortedArraySet, filename, count, queries)
+        bench("interval tree", IntervalTreeSet, filename, count, queries)
+    finally:
+        os.unlink(filename)
+        if os.path.exists(snapshot_filename(filename)):
+            os.unlink(snapshot_filename(filename))
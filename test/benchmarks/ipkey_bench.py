@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""ipv4 query key path per dataset type: the old path parsing the query with ipreverse and inet_aton
+against the cached integer key handed to get_ip4, with and without a $ in the TXT template
+
+usage: ipkey_bench.py [number of records]
+"""
+import benchsetup
+from benchsetup import timeit, report
+
+import sys
+import os
+import random
+import logging
+from tempfile import mkstemp
+
+from rbldnspy.dataset import TrivialSet, IntervalTreeSet, SortedArraySet
+from rbldnspy.tools import long2ip, ip2long, ipreverse, classify_query
+
+
+def make_datafile(count, txt):
+    rnd = random.Random(1)
+    (fd, name) = mkstemp(".rbldns", text=True)
+    handle = os.fdopen(fd, 'w')
+    handle.write(":127.0.0.2:%s\n" % txt)
+    for i in xrange(count):
+        handle.write("%s\n" % long2ip(rnd.randint(0x01000000, 0xDF000000)))
+    handle.close()
+    return name
+
+
+def make_queries(count):
+    #queries repeat like they do on a busy server, so the key cache gets hits
+    rnd = random.Random(2)
+    ips = [rnd.randint(0x01000000, 0xDF000000) for i in xrange(count / 10)]
+    return [ipreverse(long2ip(rnd.choice(ips))) for i in xrange(count)]
+
+
+def string_path(dataset, queries):
+    #what get() did before: reverse and inet_aton the query, reverse it again for the TXT template
+    for q in queries:
+        dataset.get_ip4(ip2long(ipreverse(q)), q)
+        ipreverse(q)
+
+
+def integer_path(dataset, queries):
+    for q in queries:
+        keytype, key = classify_query(q)
+        dataset.get_ip4(key, q)
+
+
+def bench(label, datasetclass, filename, queries):
+    dataset = datasetclass(filename)
+    dataset.reload()
+    #warm up the key cache
+    integer_path(dataset, queries)
+    report("%s string key" % label, len(queries), timeit(string_path, dataset, queries), "lookups")
+    report("%s integer key" % label, len(queries), timeit(integer_path, dataset, queries), "lookups")
+
+
+if __name__ == '__main__':
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    queries = make_queries(200000)
+    report("string key only", len(queries), timeit(lambda: [ip2long(ipreverse(q)) for q in queries]), "keys")
+    report("integer key only", len(queries), timeit(lambda: [classify_query(q) for q in queries]), "keys")
+    for txt in ("listed", "$ is listed"):
+        filename = make_datafile(count, txt)
+        try:
+            for label, datasetclass in (("trivial", TrivialSet), ("sorted array", SortedArraySet), ("interval tree", IntervalTreeSet)):
+                bench("%s '%s'" % (label, txt), datasetclass, filename, queries)
+        finally:
+            os.unlink(filename)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""records/sec of a full reload with the parser running in 1..N processes
+
+usage: parallel_bench.py [number of records] [max processes]
+"""
+import benchsetup
+from benchsetup import timeit, report
+
+import sys
+import os
+import random
+import logging
+import multiprocessing
+from tempfile import mkstemp
+
+from rbldnspy.dataset import DNSet, SortedArraySet, TrivialSet
+from rbldnspy.tools import long2ip
+
+
+def make_datafile(count, kind):
+    rnd = random.Random(1)
+    (fd, name) = mkstemp(".rbldns", text=True)
+    handle = os.fdopen(fd, 'w')
+    handle.write(":127.0.0.2:$ is listed\n")
+    for i in xrange(count):
+        if i % 100000 == 0:
+            handle.write("$TTL %s\n" % (i + 300))
+        if kind == 'dnset':
+            handle.write("host%s.example%s.com :%s:spam\n" % (rnd.randint(0, 2 ** 30), rnd.randint(0, 100), rnd.randint(2, 9)))
+        elif kind == 'ip4set':
+            handle.write("%s/%s\n" % (long2ip(rnd.randint(0x01000000, 0xDF000000)), rnd.choice([32, 32, 28, 24])))
+        else:
+            handle.write("%s\n" % long2ip(rnd.randint(0x01000000, 0xDF000000)))
+    handle.close()
+    return name
+
+
+def bench(label, datasetclass, filename, count, processes):
+    dataset = datasetclass(filename)
+    dataset.parseprocesses = processes
+    dataset.parallel_minsize = 0
+    report("%s %s processes" % (label, processes), count, timeit(dataset.reload), "records")
+
+
+if __name__ == '__main__':
+    count = 500000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    maxprocesses = multiprocessing.cpu_count()
+    if len(sys.argv) > 2:
+        maxprocesses = int(sys.argv[2])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print "%s cpus" % multiprocessing.cpu_count()
+    for kind, datasetclass in [('dnset', DNSet), ('ip4set', SortedArraySet), ('ip4tset', TrivialSet)]:
+        filename = make_datafile(count, kind)
+        try:
+            processes = 1
+            while processes <= maxprocesses:
+                bench(kind, datasetclass, filename, count, processes)
+                processes *= 2
+        finally:
+            os.unlink(filename)
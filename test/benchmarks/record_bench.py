@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""memory per record of a dnset zone with interned Record objects compared to one dict per line
+
+usage: record_bench.py [number of records]
+"""
+import benchsetup
+from benchsetup import timeit, report, rss_bytes
+
+import sys
+import os
+import gc
+import random
+import logging
+from tempfile import mkstemp
+
+from rbldnspy.dataset import DNSet
+
+
+def dict_record(self, line, defaults):
+    """the previous create_default_datarecord: a new dict for every line"""
+    value, a, txt = self.split_line(line, defaults.atemplate, defaults.txttemplate)
+    data = {
+        'A': a,
+        'TXT': txt,
+        'excluded': False,
+        'TTL': defaults.ttl,
+    }
+    if value.startswith('!'):
+        value = value[1:]
+        value = value.lower()
+        data['excluded'] = True
+    return value, data
+
+
+class DictDNSet(DNSet):
+    create_default_datarecord = dict_record
+
+
+def make_dnset(count):
+    rnd = random.Random(1)
+    (fd, name) = mkstemp(".rbldns", text=True)
+    handle = os.fdopen(fd, 'w')
+    handle.write(":127.0.0.2:Listed, see http://www.example.com/lookup?$\n")
+    for i in xrange(count):
+        if rnd.random() < 0.9:
+            handle.write("host%d.example%d.com\n" % (i, rnd.randint(0, 1000)))
+        else:
+            handle.write("host%d.example.net :3:spam source\n" % i)
+    handle.close()
+    return name
+
+
+def bench(label, datasetclass, filename, count):
+    gc.collect()
+    before = rss_bytes()
+    dataset = datasetclass(filename)
+    loadtime = timeit(dataset.reload)
+    gc.collect()
+    used = rss_bytes() - before
+    report("%s load" % label, count, loadtime, "records")
+    print "%-40s %10.1f bytes/record" % ("%s memory" % label, float(used) / count)
+    del dataset
+
+
+if __name__ == '__main__':
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    filename = make_dnset(count)
+    try:
+        bench("dnset dict records", DictDNSet, filename, count)
+        bench("dnset interned records", DNSet, filename, count)
+    finally:
+        os.unlink(filename)
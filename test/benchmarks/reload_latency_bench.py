@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""lookup latency while a dnset is reloaded in process and in a subprocess (--reload-subprocess)
+
+a thread keeps querying the dataset during the reload, the latency percentiles and the memory the serving
+process allocates for the reload are reported
+
+usage: reload_latency_bench.py [number of records]
+"""
+import benchsetup
+from benchsetup import timeit, rss_bytes
+
+import sys
+import os
+import time
+import random
+import thread
+import logging
+from tempfile import mkstemp
+
+from rbldnspy.dataset import DNSet
+from rbldnspy.snapshot import snapshot_filename
+
+
+def make_datafile(count):
+    rnd = random.Random(1)
+    (fd, name) = mkstemp(".rbldns", text=True)
+    handle = os.fdopen(fd, 'w')
+    handle.write(":127.0.0.2:$ is listed\n")
+    for i in xrange(count):
+        handle.write("host%s.example%s.com\n" % (rnd.randint(0, 2 ** 30), rnd.randint(0, 100)))
+    handle.close()
+    return name
+
+
+def query_loop(dataset, latencies, state):
+    rnd = random.Random(2)
+    queries = ["host%s.example%s.com" % (rnd.randint(0, 2 ** 30), rnd.randint(0, 100)) for i in xrange(1000)]
+    while state['running']:
+        for q in queries:
+            start = time.time()
+            dataset.get(q)
+            latencies.append(time.time() - start)
+        time.sleep(0.001)
+    state['done'] = True
+
+
+def bench(label, filename, subprocess):
+    dataset = DNSet(filename)
+    dataset.reload_subprocess = subprocess
+    dataset.reload()
+    #touch the source so the next reload can not use the snapshot
+    os.utime(filename, None)
+    if os.path.exists(snapshot_filename(filename)):
+        os.unlink(snapshot_filename(filename))
+
+    latencies = []
+    state = {'running': True, 'done': False}
+    thread.start_new_thread(query_loop, (dataset, latencies, state))
+    time.sleep(0.2)
+    before = rss_bytes()
+    reloadtime = timeit(dataset.reload)
+    used = rss_bytes() - before
+    time.sleep(0.2)
+    state['running'] = False
+    while not state['done']:
+        time.sleep(0.01)
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print "%-24s reload %.2fs  lookup p99 %.1fus max %.1fms  rss +%.1fMB" % (
+        label, reloadtime, p99 * 1e6, latencies[-1] * 1e3, used / 1048576.0)
+
+
+if __name__ == '__main__':
+    count = 500000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    filename = make_datafile(count)
+    try:
+        bench("in process", filename, False)
+        bench("subprocess", filename, True)
+    finally:
+        os.unlink(filename)
+        if os.path.exists(snapshot_filename(filename)):
+            os.unlink(snapshot_filename(filename))
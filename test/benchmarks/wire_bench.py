@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""compares packets/sec of the rbldnspy.wire fast path against the dnslib based query handling
+
+usage: wire_bench.py [number of packets]
+"""
+import benchsetup
+from benchsetup import timeit, report
+
+import sys
+import os
+import random
+import logging
+from tempfile import mkstemp
+
+from dnslib import DNSRecord
+from rbldnsd import RBLDNSD_options, RBLDNSD, DNSFrontend
+from rbldnspy import wire
+
+
+def make_frontend():
+    (fd, name) = mkstemp(".rbldns", text=True)
+    handle = os.fdopen(fd, 'w')
+    handle.write(":127.0.0.2:$ is listed\n10.0.0.0/8\n")
+    handle.close()
+    opts = RBLDNSD_options()
+    opts.zones = {'bench.example': [('ip4set', name)]}
+    #no response cache, we want to measure the full query path
+    opts.cachesize = 0
+    rbldnsd = RBLDNSD(opts)
+    rbldnsd.load_zones(autoreloader=False)
+    os.unlink(name)
+    return DNSFrontend(rbldnsd)
+
+
+def make_packets(count):
+    packets = []
+    for i in xrange(count):
+        name = "%s.%s.%s.%s.bench.example" % (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.choice([10, 11]))
+        d = DNSRecord.question(name, random.choice(['A', 'TXT']))
+        packets.append(str(d.pack()))
+    return packets
+
+
+def run(handler, packets):
+    addr = ('127.0.0.1', 53)
+    for packet in packets:
+        handler(packet, addr)
+
+
+def parse_dnslib(packets):
+    for packet in packets:
+        d = DNSRecord.parse(packet)
+        q = d.get_q()
+        str(q.qname)
+
+
+def parse_wire(packets):
+    for packet in packets:
+        wire.parse_query(packet)
+
+
+if __name__ == '__main__':
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    logging.getLogger().setLevel(logging.ERROR)
+
+    packets = make_packets(count)
+    frontend = make_frontend()
+
+    report("parse: dnslib", count, timeit(parse_dnslib, packets), "packets")
+    report("parse: rbldnspy.wire", count, timeit(parse_wire, packets), "packets")
+    report("handle_query: dnslib", count, timeit(run, frontend.handle_dnslib_query, packets), "packets")
+    report("handle_query: rbldnspy.wire", count, timeit(run, frontend.handle_query, packets), "packets")
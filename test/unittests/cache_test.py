@@ -0,0 +1,57 @@
+import unittest
+import unittestsetup
+
+from rbldnspy.cache import ResponseCache, question_end
+from dnslib import DNSRecord
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache=ResponseCache(2)
+        cache.put('a',1,'A')
+        cache.put('b',1,'B')
+        self.assertEqual(cache.get('a',1),'A')
+        cache.put('c',1,'C')
+        #b was least recently used
+        self.assertEqual(cache.get('b',1),None)
+        self.assertEqual(cache.get('a',1),'A')
+        self.assertEqual(cache.get('c',1),'C')
+        self.assertEqual(len(cache),2)
+        self.assertEqual(cache.hits,3)
+        self.assertEqual(cache.misses,1)
+
+    def test_generation(self):
+        cache=ResponseCache(10)
+        cache.put('a',1,'A')
+        self.assertEqual(cache.get('a',2),None)
+        #stale entry is dropped
+        self.assertEqual(cache.get('a',1),None)
+
+    def test_disabled(self):
+        cache=ResponseCache(0)
+        cache.put('a',1,'A')
+        self.assertEqual(cache.get('a',1),None)
+
+    def test_patch(self):
+        first=DNSRecord.question('2.0.0.127.example.org','A')
+        first.header.id=1
+        second=DNSRecord.question('2.0.0.127.EXAMPLE.org','A')
+        second.header.id=4711
+        response=first.reply()
+        cachedpacket=response.pack()
+        querypacket=str(second.pack())
+        qend=question_end(querypacket)
+        self.assertEqual(qend,len(querypacket))
+
+        patched=DNSRecord.parse(ResponseCache().patch(cachedpacket,querypacket,qend))
+        self.assertEqual(patched.header.id,4711)
+        self.assertEqual(str(patched.q.qname),'2.0.0.127.EXAMPLE.org.')
+        self.assertEqual(patched.header.rd,1)
+
+        #the RD flag of the query is echoed, not the one of the query which filled the cache
+        second.header.rd=0
+        querypacket=str(second.pack())
+        patched=DNSRecord.parse(ResponseCache().patch(cachedpacket,querypacket,qend))
+        self.assertEqual(patched.header.rd,0)
+        self.assertEqual((patched.header.qr,patched.header.aa),(response.header.qr,response.header.aa))
@@ -0,0 +1,569 @@
+import unittest
+import unittestsetup
+
+import random
+import time
+import os
+import socket
+from tempfile import mkstemp
+from rbldnspy.dataset import build_segments, compile_txt_template, TxtTemplates, ReloadDefaults, Record, DNSet, SortedArraySet, TrivialSet, UDPSocketSet, BATCHHEADER, RECORDSHEADER
+from rbldnspy.journal import encode_add
+from rbldnspy.snapshot import snapshot_filename, encode_meta, decode_meta
+from rbldnspy import parallel
+from rbldnspy.tools import ipreverse, ip2long
+from bisect import bisect_right
+
+
+class SegmentTest(unittest.TestCase):
+
+    def _lookup(self,starts,values,q):
+        pos=bisect_right(starts,q)-1
+        if pos<0:
+            return -1
+        return values[pos]
+
+    def _bruteforce(self,ranges,q):
+        result=-1
+        for lower,upper,recordnum in ranges:
+            if lower<=q<=upper:
+                if recordnum<0:
+                    return -1
+                if result<0:
+                    result=recordnum
+        return result
+
+    def test_overlapping(self):
+        ranges=[
+            (10,20,0),
+            (15,30,1),
+            (18,18,-1),
+            (0,0xFFFFFFFF,2),
+        ]
+        starts,values=build_segments(ranges)
+        for q in [0,9,10,15,17,18,19,21,30,31,0xFFFFFFFF]:
+            self.assertEqual(self._lookup(starts,values,q),self._bruteforce(ranges,q),q)
+
+    def test_random(self):
+        rnd=random.Random(42)
+        ranges=[]
+        for i in range(300):
+            lower=rnd.randint(0,2000)
+            upper=lower+rnd.randint(0,100)
+            recordnum=rnd.choice([-1,0,1,2,3,4])
+            ranges.append((lower,upper,recordnum))
+        starts,values=build_segments(ranges)
+        for q in range(0,2200):
+            self.assertEqual(self._lookup(starts,values,q),self._bruteforce(ranges,q),q)
+        #adjacent segments with the same value are merged
+        for i in range(1,len(values)):
+            self.assertNotEqual(values[i],values[i-1])
+
+    def test_empty(self):
+        starts,values=build_segments([])
+        self.assertEqual(self._lookup(starts,values,1),-1)
+
+
+class TxtTemplateTest(unittest.TestCase):
+
+    def _defaults(self,base=None):
+        defaults=ReloadDefaults()
+        defaults.variables[1]='See http://www.example.com/bl'
+        defaults.basetxttemplate=base
+        return defaults
+
+    def test_compile(self):
+        defaults=self._defaults()
+        self.assertEqual(compile_txt_template(None,defaults),None)
+        self.assertEqual(compile_txt_template('static',defaults),('static',))
+        self.assertEqual(compile_txt_template('$1/spammer/$ now',defaults),('See http://www.example.com/bl/spammer/',' now'))
+        self.assertEqual(compile_txt_template('pay $$$$ $',defaults),('pay $$ ',''))
+        #undefined variables are dropped
+        self.assertEqual(compile_txt_template('$5x',defaults),('x',))
+
+    def test_base_template(self):
+        defaults=self._defaults('base: $= ($)')
+        self.assertEqual(compile_txt_template('listed',defaults),('base: listed (',')'))
+        self.assertEqual(compile_txt_template('=own $',defaults),('own ',''))
+        self.assertEqual(compile_txt_template(None,defaults),('base: ',' (',')'))
+
+    def test_render_interned(self):
+        templates=TxtTemplates(self._defaults())
+        self.assertEqual(templates.render('Listed: $','10.0.0.1'),'Listed: 10.0.0.1')
+        self.assertEqual(templates.render(None,'10.0.0.1'),None)
+        self.assertTrue(templates.compile('Listed: $') is templates.compile('Listed: $'))
+
+    def test_render_ip4(self):
+        templates=TxtTemplates(self._defaults())
+        self.assertEqual(templates.render_ip4('Listed: $',0x0a000001),'Listed: 10.0.0.1')
+        self.assertEqual(templates.render_ip4('Listed',0x0a000001),'Listed')
+        self.assertEqual(templates.render_ip4(None,0x0a000001),None)
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_record(self):
+        record=Record('127.0.0.2','listed $',300)
+        self.assertEqual(record['A'],'127.0.0.2')
+        self.assertTrue('TXT' in record)
+        self.assertFalse('expires' in record)
+        self.assertEqual(record.get('expires'),None)
+        self.assertRaises(KeyError,lambda:record['expires'])
+        self.assertRaises(AttributeError,setattr,record,'TXT','changed')
+
+        rendered=record.with_txt('listed 10.0.0.1')
+        self.assertEqual(rendered['TXT'],'listed 10.0.0.1')
+        self.assertEqual(record['TXT'],'listed $')
+        self.assertTrue(record.with_txt('listed $') is record)
+
+    def test_flyweight(self):
+        dataset=DNSet('unused')
+        dataset.recordtable={}
+        defaults=ReloadDefaults()
+        defaults.txttemplate='listed'
+        first=dataset.create_default_datarecord('example.com',defaults)[1]
+        second=dataset.create_default_datarecord('example.net',defaults)[1]
+        other=dataset.create_default_datarecord('example.org :3:other',defaults)[1]
+        self.assertTrue(first is second)
+        self.assertFalse(first is other)
+        self.assertEqual(other['A'],'127.0.0.3')
+
+
+class DNSetWildcardTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd,self.filename)=mkstemp(".rbldns", text=True)
+        handle=os.fdopen(fd,'w')
+        handle.write(""":127.0.0.2:listed
+*.example.com
+.example.net
+!*.good.example.com
+ok.example.net :3:
+!.clean.example.net
+very.clean.example.net
+exact.example.org
+""")
+        handle.close()
+        self.dataset=DNSet(self.filename)
+        self.dataset.reload()
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def _lookup(self,query):
+        result=self.dataset.get(query)
+        if result==None:
+            return None
+        return result['A']
+
+    def test_wildcards(self):
+        self.assertEqual(self.dataset.wildcards,(3,2))
+        #*.domain lists the subdomains only, .domain the domain too
+        self.assertEqual(self._lookup('example.com'),None)
+        self.assertEqual(self._lookup('www.Example.com'),'127.0.0.2')
+        self.assertEqual(self._lookup('a.b.c.example.com'),'127.0.0.2')
+        self.assertEqual(self._lookup('example.net'),'127.0.0.2')
+        self.assertEqual(self._lookup('www.example.net'),'127.0.0.2')
+        self.assertEqual(self._lookup('exact.example.org'),'127.0.0.2')
+        self.assertEqual(self._lookup('www.exact.example.org'),None)
+        self.assertEqual(self._lookup('example.org'),None)
+
+    def test_most_specific(self):
+        self.assertEqual(self._lookup('good.example.com'),'127.0.0.2')
+        self.assertEqual(self._lookup('www.good.example.com'),None)
+        self.assertEqual(self._lookup('ok.example.net'),'127.0.0.3')
+        self.assertEqual(self._lookup('www.ok.example.net'),'127.0.0.2')
+        self.assertEqual(self._lookup('clean.example.net'),None)
+        self.assertEqual(self._lookup('www.clean.example.net'),None)
+        self.assertEqual(self._lookup('very.clean.example.net'),'127.0.0.2')
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd,self.filename)=mkstemp(".rbldns", text=True)
+        handle=os.fdopen(fd,'w')
+        handle.write("""$SOA 7m localhost. hostmaster.localhost. 1 1h 10m 5d 30s
+:127.0.0.2:Listed $
+10.0.0.0/24
+10.0.0.5 :3:other
+!10.0.0.7
+192.168.0.1
+""")
+        handle.close()
+
+    def tearDown(self):
+        for filename in (self.filename,snapshot_filename(self.filename)):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def _load(self):
+        dataset=SortedArraySet(self.filename)
+        dataset.snapshots=True
+        dataset.reload()
+        return dataset
+
+    def test_roundtrip(self):
+        parsed=self._load()
+        self.assertFalse(parsed.loadedsnapshot)
+        self.assertTrue(os.path.exists(snapshot_filename(self.filename)))
+
+        mapped=self._load()
+        self.assertTrue(mapped.loadedsnapshot)
+        self.assertEqual(mapped.get_record_count(),parsed.get_record_count())
+        self.assertEqual(mapped.soa,parsed.soa)
+        for ip in ['10.0.0.1','10.0.0.5','10.0.0.7','10.0.1.1','192.168.0.1','1.2.3.4']:
+            query=ipreverse(ip)
+            self.assertEqual(repr(mapped.get(query)),repr(parsed.get(query)),ip)
+
+    def test_disabled(self):
+        self._load()
+        dataset=SortedArraySet(self.filename)
+        dataset.reload()
+        self.assertFalse(dataset.loadedsnapshot)
+
+    def test_metadata(self):
+        state=(Record('127.0.0.2','caf\xe9 $',300,True),{'a':[1,2.5,None]},2**40,'')
+        self.assertEqual(repr(decode_meta(encode_meta(state))),repr(state))
+        defaults=decode_meta(encode_meta(self._load().defaults))
+        self.assertEqual(defaults.soa,self._load().defaults.soa)
+        #only registered classes
+        self.assertRaises(ValueError,encode_meta,(object(),))
+        self.assertRaises(ValueError,decode_meta,"cos\nsystem\n(S'true'\ntR.")
+
+    def test_source_changed(self):
+        self._load()
+        handle=open(self.filename,'a')
+        handle.write("172.16.0.1\n")
+        handle.close()
+        dataset=self._load()
+        self.assertFalse(dataset.loadedsnapshot)
+        self.assertNotEqual(dataset.get(ipreverse('172.16.0.1')),None)
+
+    def test_subprocess_reload(self):
+        dataset=SortedArraySet(self.filename)
+        dataset.reload_subprocess=True
+        dataset.reload()
+        self.assertTrue(dataset.loadedsnapshot)
+        self.assertEqual(dataset.get_record_count(),4)
+        self.assertEqual(dataset.get(ipreverse('192.168.0.1'))['TXT'],'Listed 192.168.0.1')
+        self.assertEqual(dataset.get(ipreverse('10.0.0.7')),None)
+
+    def test_dnset(self):
+        handle=open(self.filename,'w')
+        handle.write(":127.0.0.2:listed\nexample.com\n!bad.example.com\nspam.example.org :3:spam\n*.example.net\n")
+        handle.close()
+        parsed=DNSet(self.filename)
+        parsed.snapshots=True
+        parsed.reload()
+        mapped=DNSet(self.filename)
+        mapped.snapshots=True
+        mapped.reload()
+        self.assertTrue(mapped.loadedsnapshot)
+        self.assertEqual(len(mapped.backend),4)
+        for query in ['example.com','bad.example.com','spam.example.org','Example.Com','example.net','www.example.net']:
+            self.assertEqual(repr(mapped.get(query)),repr(parsed.get(query)),query)
+
+    def test_failed_reload(self):
+        dataset=SortedArraySet(self.filename)
+        os.unlink(self.filename)
+        self.assertRaises(Exception,dataset.reload)
+        #the next reload is not skipped
+        self.assertFalse(dataset.reloading)
+        handle=open(self.filename,'w')
+        handle.write("10.0.0.1\n10.0.0.2\n")
+        handle.close()
+        dataset.reload()
+        self.assertEqual(dataset.get_record_count(),2)
+
+
+
+class IncrementalReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd,self.filename)=mkstemp(".rbldns", text=True)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def _write(self,content):
+        handle=open(self.filename,'w')
+        handle.write(content)
+        handle.close()
+
+    def _load(self,datasetclass):
+        dataset=datasetclass(self.filename)
+        dataset.incremental=True
+        dataset.reload()
+        return dataset
+
+    def _lookup(self,dataset,query):
+        result=dataset.get(query)
+        if result==None:
+            return None
+        return result['A']
+
+    def test_dnset(self):
+        self._write(""":127.0.0.2:listed
+example.com
+spam.example.org :3:spam
+:127.0.0.4:
+other.example.net
+""")
+        dataset=self._load(DNSet)
+        loaded=dataset.backend
+        self._write(""":127.0.0.2:listed
+example.com
+spam.example.org :5:spam
+new.example.com
+:127.0.0.4:
+other.example.net
+new.example.net
+""")
+        dataset.reload()
+        self.assertEqual(dataset.lastreloadinfo[3],4)
+        #only the changes are stored, on top of the loaded dict
+        self.assertTrue(dataset.backend.base is loaded)
+        self.assertEqual(loaded.get('new.example.com'),None)
+        self.assertEqual(self._lookup(dataset,'example.com'),'127.0.0.2')
+        self.assertEqual(self._lookup(dataset,'spam.example.org'),'127.0.0.5')
+        self.assertEqual(self._lookup(dataset,'new.example.com'),'127.0.0.2')
+        self.assertEqual(self._lookup(dataset,'new.example.net'),'127.0.0.4')
+        self.assertEqual(dataset.get_record_count(),5)
+
+        #removing a line which is listed twice keeps the remaining one
+        self._write(""":127.0.0.2:listed
+example.com
+spam.example.org :5:spam
+new.example.com
+:127.0.0.4:
+other.example.net
+example.com :6:
+""")
+        dataset.reload()
+        self.assertEqual(self._lookup(dataset,'example.com'),'127.0.0.6')
+        self.assertEqual(self._lookup(dataset,'new.example.net'),None)
+        self._write(""":127.0.0.2:listed
+spam.example.org :5:spam
+new.example.com
+:127.0.0.4:
+other.example.net
+example.com :6:
+""")
+        dataset.reload()
+        self.assertEqual(self._lookup(dataset,'example.com'),'127.0.0.6')
+
+    def test_snapshot_then_incremental(self):
+        base=":127.0.0.2:listed\nexample.com\n"
+        self._write(base)
+        dataset=DNSet(self.filename)
+        dataset.incremental=True
+        dataset.snapshots=True
+        try:
+            dataset.reload()
+            #compiled elsewhere, too many changes for an incremental reload: the snapshot is mapped
+            self._write(base+''.join(['x%s.example.com\n'%i for i in range(200)]))
+            offline=DNSet(self.filename)
+            offline.snapshots=True
+            offline.reload()
+            dataset.reload()
+            self.assertTrue(dataset.loadedsnapshot)
+            self.assertEqual(self._lookup(dataset,'x1.example.com'),'127.0.0.2')
+
+            self._write(base+"new.example.com\n")
+            dataset.reload()
+            self.assertEqual(self._lookup(dataset,'x1.example.com'),None)
+            self.assertEqual(self._lookup(dataset,'new.example.com'),'127.0.0.2')
+            self.assertEqual(dataset.get_record_count(),2)
+        finally:
+            os.unlink(snapshot_filename(self.filename))
+
+    def test_subprocess_incremental(self):
+        self._write(":127.0.0.2:listed\nexample.com\n")
+        dataset=DNSet(self.filename)
+        dataset.incremental=True
+        dataset.reload_subprocess=True
+        dataset.reload()
+        #parsed here, the child would take the fingerprints with it
+        self.assertFalse(dataset.loadedsnapshot)
+        self._write(":127.0.0.2:listed\nexample.com\nnew.example.com\n")
+        dataset.reload()
+        self.assertEqual(dataset.lastreloadinfo[3],1)
+        self.assertEqual(self._lookup(dataset,'new.example.com'),'127.0.0.2')
+
+    def test_defaults_changed(self):
+        self._write(""":127.0.0.2:listed
+example.com
+""")
+        dataset=self._load(DNSet)
+        self._write(""":127.0.0.3:listed
+example.com
+""")
+        dataset.reload()
+        self.assertEqual(dataset.lastreloadinfo[3],0)
+        self.assertEqual(self._lookup(dataset,'example.com'),'127.0.0.3')
+
+    def test_ip4tset(self):
+        self._write(""":127.0.0.2:listed $
+10.0.0.1
+10.0.0.2
+""")
+        dataset=self._load(TrivialSet)
+        self._write(""":127.0.0.2:listed $
+10.0.0.2
+10.0.0.3
+""")
+        dataset.reload()
+        self.assertEqual(dataset.lastreloadinfo[3],2)
+        self.assertEqual(dataset.get(ipreverse('10.0.0.1')),None)
+        self.assertEqual(dataset.get(ipreverse('10.0.0.3'))['TXT'],'listed 10.0.0.3')
+        self.assertEqual(list(dataset.backend),[ip2long('10.0.0.2'),ip2long('10.0.0.3')])
+
+
+class ParallelParseTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd,self.filename)=mkstemp(".rbldns", text=True)
+        handle=os.fdopen(fd,'w')
+        rnd=random.Random(5)
+        handle.write(":127.0.0.2:listed $\n")
+        for i in range(2000):
+            if i%300==0:
+                handle.write("$TTL %s\n:%s:context %s\n"%(i+1,i%7+2,i))
+            handle.write("%s%s.example.com\n"%(rnd.choice(['','','!']),rnd.randint(0,1000)))
+        handle.close()
+        self.minchunk=parallel.MINCHUNK
+        parallel.MINCHUNK=500
+
+    def tearDown(self):
+        parallel.MINCHUNK=self.minchunk
+        os.unlink(self.filename)
+
+    def test_tasks(self):
+        data=open(self.filename).read()
+        directives=list(parallel.prescan(data))
+        self.assertEqual(len(directives),15)
+        tasks=parallel.plan_tasks(data,directives,1000)
+        self.assertTrue(len(tasks)>10)
+        covered=''.join(data[start:end] for task in tasks for start,end,ctx in task)
+        datalines=[line for line in data.split('\n') if line and line[0] not in ':$']
+        self.assertEqual([line for line in covered.split('\n') if line],datalines)
+        for task in tasks:
+            for start,end,ctx in task:
+                self.assertTrue(start==0 or data[start-1]=='\n')
+
+    def test_same_as_serial(self):
+        serial=DNSet(self.filename)
+        serial.reload()
+        dataset=DNSet(self.filename)
+        dataset.parseprocesses=2
+        dataset.parallel_minsize=0
+        dataset.reload()
+        self.assertEqual(dataset.get_record_count(),serial.get_record_count())
+        self.assertEqual(dataset.sourcedigest,serial.sourcedigest)
+        self.assertEqual(dataset.defaults.ttl,serial.defaults.ttl)
+        for i in range(1000):
+            query='%s.example.com'%i
+            self.assertEqual(repr(dataset.get(query)),repr(serial.get(query)),query)
+
+
+class FastlistExpiryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset=UDPSocketSet('127.0.0.1/0')
+        self.dataset.persistent=False
+
+    def _list(self,name,expires):
+        rec={'A':'127.0.0.2','excluded':False,'TTL':60}
+        if expires!=None:
+            rec['expires']=expires
+        return self.dataset.fastlist(name,rec)
+
+    def test_expire(self):
+        now=time.time()
+        self._list('old.example.com',now-10)
+        self._list('new.example.com',now+3600)
+        self._list('forever.example.com',None)
+        #relisted: the first entry is stale
+        self._list('relisted.example.com',now-5)
+        self._list('relisted.example.com',now+3600)
+        #delisted before it expired
+        self._list('delisted.example.com',now-5)
+        self.dataset.delist('delisted.example.com')
+
+        self.assertEqual(self.dataset.expire_once(),1)
+        self.assertEqual(sorted(self.dataset.backend.keys()),['forever.example.com','new.example.com','relisted.example.com'])
+        self.assertEqual(self.dataset.next_expiry(),now+3600)
+        #nothing due
+        self.assertEqual(self.dataset.expire_once(),0)
+
+    def test_batches(self):
+        now=time.time()
+        self.dataset.expirybatch=7
+        for i in range(100):
+            self._list('%s.example.com'%i,now-i)
+        self.assertEqual(self.dataset.expire_once(),100)
+        self.assertEqual(self.dataset.backend,{})
+        self.assertEqual(self.dataset.next_expiry(),None)
+
+    def test_compaction(self):
+        now=time.time()
+        for i in range(3000):
+            self._list('relisted.example.com',now+i)
+        self.assertTrue(len(self.dataset.expiryheap)<=1001)
+        self.assertTrue(now+2999 in [entry[0] for entry in self.dataset.expiryheap])
+
+
+class FastlistBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset=UDPSocketSet('127.0.0.1/0')
+        self.dataset.persistent=False
+        self.forwarded=[]
+        self.dataset.forward=self.forwarded.append
+
+    def test_single_command(self):
+        self.dataset.handlepacket('bla.com\t127.0.0.3\n','127.0.0.1')
+        self.assertEqual(self.dataset.backend['bla.com']['A'],'127.0.0.3')
+        self.dataset.handlepacket('bla.com\t\t\td','127.0.0.1')
+        self.assertEqual(self.dataset.backend,{})
+
+    def test_batch_datagram(self):
+        self.dataset.handlepacket('\n'.join([BATCHHEADER,'one.com','two.com\t127.0.0.3\thello\t\t\t0','bad.com\t\t\tx','one.com\t\t\td','']),'127.0.0.1')
+        self.assertEqual(self.dataset.backend.keys(),['two.com'])
+        self.assertEqual(self.dataset.backend['two.com']['TXT'],'hello')
+        self.assertFalse('expires' in self.dataset.backend['two.com'])
+        self.assertEqual(self.dataset.lastreloadinfo[2],1)
+
+    def test_forwarded_records(self):
+        packet=RECORDSHEADER+encode_add('forwarded.com',{'A':'127.0.0.2','excluded':False})
+        #only accepted from the parent process
+        self.assertRaises(Exception,self.dataset.handlepacket,packet,'192.0.2.1')
+        self.assertEqual(self.dataset.backend,{})
+        self.dataset.handlepacket(packet,'parent')
+        self.assertEqual(self.dataset.backend.keys(),['forwarded.com'])
+
+    def test_invalid_values(self):
+        self.dataset.handlepacket('\n'.join([BATCHHEADER,'neg.com\t\t\t\t-1','big.com\t\t\t\t4294967296','past.com\t\t\t\t\t-5','ok.com','']),'127.0.0.1')
+        self.assertEqual(self.dataset.backend.keys(),['ok.com'])
+        #a record the journal can not encode changes nothing, the rest of the batch is applied
+        rec={'A':'127.0.0.2','excluded':False,'TTL':60}
+        self.dataset.apply_records([('a','long.com',dict(rec,TXT='x'*70000)),('a','next.com',rec)])
+        self.assertEqual(sorted(self.dataset.backend.keys()),['next.com','ok.com'])
+
+    def test_bulkload(self):
+        self.dataset.subscribers=[None]
+        self.dataset.bulkbatch=7
+        client,server=socket.socketpair(socket.AF_UNIX,socket.SOCK_STREAM)
+        client.sendall(''.join(['%s.example.com\n'%i for i in range(100)])+'bad.com\t\t\tx\n')
+        client.shutdown(socket.SHUT_WR)
+        self.dataset.bulkload(server,'local')
+        self.assertEqual(client.recv(100),'OK 100 1\n')
+        client.close()
+        self.assertEqual(len(self.dataset.backend),100)
+        #forwarded to the workers as batch datagrams
+        lines=[]
+        for packet in self.forwarded:
+            self.assertTrue(packet.startswith(BATCHHEADER+'\n'))
+            lines.extend(packet.split('\n')[1:])
+        self.assertEqual(len(lines),101)
@@ -426,8 +426,23 @@ A set of IP addresses or CIDR address ranges, together with A and TXT resulting
         """
         "trivial" ip4set: a set of single IP addresses (one per line), with the same A+TXT template. This dataset type is more efficient than ip4set (in both memory usage and access times), but have obvious limitation. It is intended for DNSBLs like DSBL.org, ORDB.org and similar, where each entry uses the same default A+TXT template. This dataset uses only half a memory for the same list of IP addresses compared to ip4set. 
         """
-        if FAILNOTIMPLEMENTED:
-            self.fail("test not implemented")
+        self._set_zone(""":127.0.0.3:Listed: $
+10.0.0.1
+10.0.0.3
+10.0.0.1
+192.168.0.255
+""",dntype='ip4tset')
+        self.assertEqual(self.lookup_ip('10.0.0.1'), '127.0.0.3')
+        self.assertEqual(self.lookup_ip('10.0.0.2'), None)
+        self.assertEqual(self.lookup_ip('192.168.0.255'), '127.0.0.3')
+        self.assertEqual(self.lookup_ip('192.168.1.0'), None)
+        self.assertEqual(self.lookup_ip('10.0.0.3',t='TXT'), 'Listed: 10.0.0.3')
+        
+        self._set_zone(""":127.0.0.4:static text
+10.0.0.1
+""",dntype='ip4tset')
+        self.assertEqual(self.lookup_ip('10.0.0.1',t='TXT'), 'static text')
+        self.assertEqual(self.lookup_ip('10.0.0.1'), '127.0.0.4')
     
     
     def test_dnset_dataset(self):
@@ -588,3 +603,15 @@ class SpecialTests(ManPageTest):
 !192.168.10.
         """)
         self.assertEqual(self.lookup_ip('192.168.10.10'), None)
+
+    def test_zone_index(self):
+        from rbldnspy.zone import Zone
+        outer=Zone('example.org')
+        inner=Zone('bl.Example.org')
+        self.rbldnsd.zones={'example.org':outer,'bl.Example.org':inner}
+        self.rbldnsd.build_zone_index()
+        self.assertEqual(self.rbldnsd.find_zone('2.0.0.127.bl.example.org.'),(inner,'2.0.0.127'))
+        self.assertEqual(self.rbldnsd.find_zone('BL.example.org'),(inner,''))
+        self.assertEqual(self.rbldnsd.find_zone('www.example.org'),(outer,'www'))
+        self.assertEqual(self.rbldnsd.find_zone('example.com'),(None,None))
+        self.assertEqual(self.rbldnsd.find_zone('xexample.org'),(None,None))
@@ -0,0 +1,110 @@
+import unittest
+import unittestsetup
+
+import time
+import socket
+from threading import Event
+from rbldnspy.eventloop import EventLoop, ThreadExecutor
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop=EventLoop()
+        self.calls=[]
+
+    def test_timers(self):
+        self.loop.call_later(0.01,self.calls.append,'later')
+        cancelled=self.loop.call_later(0.01,self.calls.append,'cancelled')
+        cancelled.cancel()
+        every=self.loop.call_every(0.02,self.calls.append,'every')
+        #a failing callback is logged, the loop keeps running
+        self.loop.call_later(0.03,lambda: 1/0)
+        self.loop.call_later(0.15,self.loop.stop)
+        self.loop.run()
+        every.cancel()
+        self.assertEqual(self.calls[0],'later')
+        self.assertFalse('cancelled' in self.calls)
+        self.assertTrue(self.calls.count('every')>=3)
+
+    def test_reader(self):
+        reader,writer=socket.socketpair(socket.AF_UNIX,socket.SOCK_DGRAM)
+        def readable():
+            self.calls.append(reader.recv(100))
+            if len(self.calls)==2:
+                self.loop.stop()
+        self.loop.add_reader(reader,readable)
+        writer.send('one')
+        writer.send('two')
+        self.loop.call_later(5,self.loop.stop)
+        self.loop.run()
+        self.assertEqual(self.calls,['one','two'])
+        self.loop.remove_reader(reader)
+        writer.send('three')
+        self.loop.call_later(0.05,self.loop.stop)
+        self.loop.run()
+        self.assertEqual(self.calls,['one','two'])
+        reader.close()
+        writer.close()
+
+
+class ThreadExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor=ThreadExecutor()
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def _wait(self,condition):
+        timeout=time.time()+5
+        while time.time()<timeout and not condition():
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_dedupe(self):
+        release=Event()
+        done=[]
+        self.assertTrue(self.executor.submit('block',release.wait))
+        #waiting behind the running job: merged with the queued one
+        self.assertTrue(self.executor.submit('job',done.append,1))
+        self.assertFalse(self.executor.submit('job',done.append,2))
+        release.set()
+        self._wait(lambda: not self.executor._pending)
+        self.assertEqual(done,[1])
+        #the key can be submitted again once the job is done
+        self.assertTrue(self.executor.submit('job',done.append,3))
+        self._wait(lambda: done==[1,3])
+
+    def test_failed_job(self):
+        done=[]
+        self.assertTrue(self.executor.submit('job',lambda: 1/0))
+        self._wait(lambda: not self.executor._pending)
+        self.assertTrue(self.executor.submit('job',done.append,1))
+        self._wait(lambda: done==[1])
+
+    def test_change_during_reload(self):
+        #a reload reads the source when it starts, a change arriving while it runs needs another reload
+        source=['old']
+        loaded=[]
+        started=Event()
+        release=Event()
+        def reload():
+            content=source[0]
+            started.set()
+            release.wait()
+            loaded.append(content)
+        self.assertTrue(self.executor.submit('reload',reload))
+        started.wait(5)
+        source[0]='new'
+        self.assertTrue(self.executor.submit('reload',reload))
+        #already scheduled to run again
+        self.assertFalse(self.executor.submit('reload',reload))
+        release.set()
+        self._wait(lambda: len(loaded)==2)
+        self.assertEqual(loaded,['old','new'])
+        self._wait(lambda: not self.executor._pending)
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import unittestsetup
+
+import gc
+from rbldnspy.gccontrol import GCControl
+
+
+class GCControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wasenabled=gc.isenabled()
+        gc.enable()
+
+    def tearDown(self):
+        if self.wasenabled:
+            gc.enable()
+        else:
+            gc.disable()
+
+    def test_build(self):
+        control=GCControl()
+        control.build_started()
+        control.build_started()
+        self.assertFalse(gc.isenabled())
+        self.assertEqual(control.build_finished(),0.0)
+        self.assertFalse(gc.isenabled(),"enabled while a build is still running")
+        control.build_finished()
+        self.assertTrue(gc.isenabled())
+        self.assertEqual(control.stats()[0],[0,1,0])
+
+    def test_manual(self):
+        control=GCControl()
+        control.take_over()
+        self.assertFalse(gc.isenabled())
+        control.build_started()
+        control.build_finished()
+        self.assertFalse(gc.isenabled())
+
+        garbage=[[] for x in range(gc.get_threshold()[0]+100)]
+        control.tick()
+        collections,pausetime,maxpause=control.stats()
+        self.assertEqual(sum(collections),2)
+        self.assertTrue(maxpause>=0)
+        del garbage
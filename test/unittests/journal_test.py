@@ -0,0 +1,97 @@
+import unittest
+import unittestsetup
+
+import os
+import shutil
+import tempfile
+from rbldnspy.journal import Journal, journal_filename, encode_add, encode_delete, read_journal, read_zone, write_zone
+from rbldnspy.dataset import UDPSocketSet
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filename=os.path.join(self.directory,'fastlist-5353.p')
+        self.journalfile=journal_filename(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        records=[
+            ('a','one.example.com',{'A':'127.0.0.2','excluded':False,'TTL':60,'expires':1234.5,'TXT':'listed'}),
+            ('a','two.example.com',{'A':'127.0.0.3','excluded':True}),
+            ('d','one.example.com',None),
+        ]
+        journal=Journal(self.journalfile)
+        for op,name,rec in records:
+            if op=='a':
+                journal.append(encode_add(name,rec))
+            else:
+                journal.append(encode_delete(name))
+        #nothing is written before sync
+        self.assertEqual(read_journal(self.journalfile)[0],[])
+        journal.sync()
+        self.assertEqual(read_journal(self.journalfile)[0],records)
+        journal.close()
+        self.assertEqual(read_zone(self.filename),{'two.example.com':records[1][2]})
+
+    def test_torn_record(self):
+        journal=Journal(self.journalfile)
+        journal.append(encode_add('one.example.com',{'A':'127.0.0.2','excluded':False}))
+        journal.close()
+        handle=open(self.journalfile,'ab')
+        handle.write(encode_add('two.example.com',{'A':'127.0.0.2','excluded':False})[:-3])
+        handle.close()
+        self.assertEqual(read_zone(self.filename).keys(),['one.example.com'])
+
+        #reopening cuts off the torn record, so new records can be read again
+        journal=Journal(self.journalfile)
+        journal.append(encode_delete('one.example.com'))
+        journal.close()
+        self.assertEqual(read_zone(self.filename),{})
+
+    def test_interrupted_compaction(self):
+        write_zone(self.filename,{'old.example.com':{'A':'127.0.0.2','excluded':False}})
+        journal=Journal(self.journalfile)
+        journal.append(encode_delete('old.example.com'))
+        journal.append(encode_add('new.example.com',{'A':'127.0.0.2','excluded':False}))
+        journal.rotate()
+        journal.append(encode_add('newer.example.com',{'A':'127.0.0.2','excluded':False}))
+        journal.sync()
+        expected=['new.example.com','newer.example.com']
+        #crashed before the snapshot was written
+        self.assertEqual(sorted(read_zone(self.filename).keys()),expected)
+        #crashed after writing the snapshot, before removing the rotated journal
+        write_zone(self.filename,{'new.example.com':{'A':'127.0.0.2','excluded':False}})
+        self.assertEqual(sorted(read_zone(self.filename).keys()),expected)
+        journal.close()
+
+    def test_fastlist_zone(self):
+        dataset=UDPSocketSet('127.0.0.1/0')
+        dataset.zone_filename=lambda: self.filename
+        dataset.load_zone()
+        dataset.fastlist('one.example.com',{'A':'127.0.0.2','excluded':False,'TTL':60})
+        dataset.fastlist('two.example.com',{'A':'127.0.0.2','excluded':False,'TTL':60,'expires':1.0})
+        dataset.fastlist('three.example.com',{'A':'127.0.0.2','excluded':False,'TTL':60})
+        dataset.delist('three.example.com')
+        self.assertEqual(dataset.expire_once(),1)
+        dataset.sync_journal()
+        self.assertEqual(read_zone(self.filename).keys(),['one.example.com'])
+
+        dataset.save_zone()
+        self.assertFalse(os.path.exists(self.journalfile+'.1'))
+        self.assertEqual(read_journal(self.journalfile)[0],[])
+        dataset.delist('one.example.com')
+        dataset.shutdown()
+
+        restarted=UDPSocketSet('127.0.0.1/0')
+        restarted.zone_filename=lambda: self.filename
+        restarted.load_zone()
+        self.assertEqual(restarted.backend,{})
+        restarted.shutdown()
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import unittestsetup
+
+import socket
+from rbldnspy import mmsg
+
+
+class BatchIOTest(unittest.TestCase):
+
+    def setUp(self):
+        if not mmsg.available:
+            self.skipTest("recvmmsg/sendmmsg not available")
+        self.server=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1',0))
+        self.client=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1',0))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_roundtrip(self):
+        for i in range(5):
+            self.client.sendto('packet%s'%i,self.server.getsockname())
+        batchio=mmsg.BatchIO(self.server,4,timeout=0.05)
+
+        batch=batchio.recv()
+        self.assertEqual([data for slot,data,addr in batch],['packet0','packet1','packet2','packet3'])
+        self.assertEqual(batch[0][2],self.client.getsockname())
+        self.assertEqual(batchio.send([(slot,data.upper()) for slot,data,addr in batch]),4)
+        for i in range(4):
+            data,addr=self.client.recvfrom(512)
+            self.assertEqual(data,'PACKET%s'%i)
+
+        self.assertEqual(len(batchio.recv()),1)
+        self.assertEqual(batchio.recv(block=False),[])
+        self.assertEqual(batchio.average_fill(),2.5)
@@ -0,0 +1,71 @@
+import unittest
+import unittestsetup
+
+import thread
+import time
+from rbldnspy import overlay
+from rbldnspy.overlay import OverlayView, DELETED
+from rbldnspy.dataset import UDPSocketSet
+
+
+class OverlayViewTest(unittest.TestCase):
+
+    def test_updates(self):
+        base={'a':1,'b':2}
+        view=OverlayView(base)
+        newview=view.updated({'a':DELETED,'c':3},2)
+        #the old view and its base are unchanged
+        self.assertEqual(view,{'a':1,'b':2})
+        self.assertEqual(base,{'a':1,'b':2})
+        self.assertEqual(newview,{'b':2,'c':3})
+        self.assertEqual(len(newview),2)
+        self.assertFalse('a' in newview)
+        self.assertRaises(KeyError,newview.__getitem__,'a')
+        self.assertEqual(newview.get('a','x'),'x')
+        self.assertEqual(sorted(newview.keys()),['b','c'])
+
+    def test_merge(self):
+        view=OverlayView()
+        expected={}
+        for i in range(3000):
+            changes={'%s'%i:i}
+            expected['%s'%i]=i
+            if i%3==0 and i>0:
+                changes['%s'%(i-1)]=DELETED
+                del expected['%s'%(i-1)]
+            view=view.updated(changes,len(expected))
+            self.assertTrue(len(view.overlays)<=overlay.MAXOVERLAYS)
+        self.assertEqual(view,expected)
+
+
+class FastlistWriterTest(unittest.TestCase):
+
+    def test_read_while_writing(self):
+        dataset=UDPSocketSet('127.0.0.1/0')
+        dataset.persistent=False
+        errors=[]
+        done=[]
+
+        def read():
+            try:
+                while not done:
+                    for name,rec in dataset.backend.iteritems():
+                        dataset.get(name)
+            except Exception,e:
+                errors.append(e)
+            done.append(True)
+
+        for i in range(200):
+            dataset.fastlist('%s.example.com'%i,{'A':'127.0.0.2','excluded':False,'expires':time.time()-1})
+        thread.start_new_thread(read,())
+        for i in range(200,1000):
+            dataset.fastlist('%s.example.com'%i,{'A':'127.0.0.2','excluded':False})
+            if i%100==0:
+                dataset.expire_once()
+        done.append(True)
+        while len(done)<2:
+            time.sleep(0.01)
+        dataset.stop_writer()
+        self.assertEqual(errors,[])
+        self.assertEqual(len(dataset.backend),800)
+        self.assertEqual(len(dataset.backend.todict()),800)
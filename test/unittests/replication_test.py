@@ -0,0 +1,86 @@
+import unittest
+import unittestsetup
+
+import time
+import socket
+from rbldnspy.dataset import UDPSocketSet
+from rbldnspy.journal import encode_add
+from rbldnspy.replication import Replication, pack_frames, _header, _chunk
+
+
+class ReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.primary=self._dataset('primary')
+        self.primaryaddr=self.primary.replication.sock.getsockname()
+        self.replica=self._dataset('replica',self.primaryaddr)
+        self.replicaaddr=self.replica.replication.sock.getsockname()
+        self.primary.replication.peers[self.replicaaddr]=[0,None]
+
+    def tearDown(self):
+        self.primary.shutdown()
+        self.replica.shutdown()
+
+    def _dataset(self,role,primary=None):
+        dataset=UDPSocketSet('127.0.0.1/0')
+        dataset.persistent=False
+        dataset.replication=Replication(dataset,role,('127.0.0.1',0),primary=primary)
+        dataset.replication.start()
+        return dataset
+
+    def _list(self,name):
+        self.primary.fastlist(name,{'A':'127.0.0.2','excluded':False,'TTL':60})
+
+    def _wait_for(self,names):
+        timeout=time.time()+5
+        while time.time()<timeout:
+            if sorted(self.replica.backend.keys())==names and self.replica.replication.seq==self.primary.replication.seq:
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(self.replica.backend.keys()),names)
+        self.assertEqual(self.replica.replication.seq,self.primary.replication.seq)
+
+    def test_replication(self):
+        #before the replica knows the primary: sent with the whole zone
+        self.replica.fastlist('stale.example.com',{'A':'127.0.0.2','excluded':False})
+        self._list('one.example.com')
+        self._wait_for(['one.example.com'])
+
+        self._list('two.example.com')
+        self.primary.delist('one.example.com')
+        self._wait_for(['two.example.com'])
+
+        #missed changes are sent again from the ring buffer
+        del self.primary.replication.peers[self.replicaaddr]
+        self._list('three.example.com')
+        self._list('four.example.com')
+        self.primary.replication.peers[self.replicaaddr]=[0,None]
+        self._wait_for(['four.example.com','three.example.com','two.example.com'])
+
+        timeout=time.time()+5
+        while time.time()<timeout and self.primary.replication.stats()[0][1]>0:
+            time.sleep(0.05)
+        peer,lag,age=self.primary.replication.stats()[0]
+        self.assertEqual((peer,lag),(self.replicaaddr,0))
+
+    def test_stranger_ignored(self):
+        self._list('one.example.com')
+        self._wait_for(['one.example.com'])
+        replication=self.primary.replication
+        frame=encode_add('evil.example.com',{'A':'127.0.0.2','excluded':False})
+        stranger=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        stranger.bind(('127.0.0.1',0))
+        try:
+            #a change with the next sequence number and a whole zone of one chunk
+            stranger.sendto(_header.pack('C',replication.epoch,replication.seq+1)+frame,self.replicaaddr)
+            stranger.sendto(_header.pack('F',replication.epoch,replication.seq+5)+_chunk.pack(0,1)+frame,self.replicaaddr)
+        finally:
+            stranger.close()
+        #processed after the stranger's messages
+        self._list('two.example.com')
+        self._wait_for(['one.example.com','two.example.com'])
+        self.assertEqual(self.replica.replication.primary,self.primaryaddr)
+
+    def test_pack_frames(self):
+        self.assertEqual(pack_frames(['aa','bb','cc','dddd'],4),['aabb','cc','dddd'])
+        self.assertEqual(pack_frames([],4),[])
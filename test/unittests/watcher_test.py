@@ -0,0 +1,78 @@
+import unittest
+import unittestsetup
+
+import os
+import time
+import shutil
+import tempfile
+from rbldnspy import watcher
+from rbldnspy.watcher import FileWatcher
+from rbldnspy.dataset import DNSet
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filename=os.path.join(self.directory,'list.rbldns')
+        self._write("example.com\n")
+        self.changed=[]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self,content):
+        #write and rename into place like rsync does
+        tmpname=self.filename+'.tmp'
+        handle=open(tmpname,'w')
+        handle.write(content)
+        handle.close()
+        os.rename(tmpname,self.filename)
+
+    def _callback(self,path):
+        self.changed.append(path)
+
+    def test_poll_debounce(self):
+        w=FileWatcher(interval=60,debounce=0.05,useinotify=False)
+        w.add(self.filename,self._callback)
+        w.poll()
+        w.fire_due()
+        self.assertEqual(self.changed,[])
+
+        self._write("example.com\nexample.org\n")
+        w.poll()
+        self._write("example.com\nexample.org\nexample.net\n")
+        w.poll()
+        w.fire_due()
+        self.assertEqual(self.changed,[],"reported before the debounce time")
+        time.sleep(0.1)
+        w.fire_due()
+        self.assertEqual(self.changed,[os.path.realpath(self.filename)])
+        w.close()
+
+    def test_inotify(self):
+        w=FileWatcher(interval=60,debounce=0.05)
+        if w.fileno()==None:
+            return
+        w.add(self.filename,self._callback)
+        #unrelated files in the same directory are ignored
+        open(os.path.join(self.directory,'other'),'w').close()
+        self._write("example.com\nexample.org\n")
+        w.read_events()
+        time.sleep(0.1)
+        w.fire_due()
+        self.assertEqual(self.changed,[os.path.realpath(self.filename)])
+        w.close()
+
+    def test_unchanged_content(self):
+        dataset=DNSet(self.filename)
+        dataset.reload()
+        generation=dataset.generation
+        os.utime(self.filename,(time.time()+10,time.time()+10))
+        self.assertFalse(dataset.check_reload())
+        self.assertEqual(dataset.generation,generation)
+
+        self._write("example.org\n")
+        self.assertTrue(dataset.check_reload())
+        self.assertEqual(dataset.get('example.com'),None)
+        self.assertNotEqual(dataset.get('example.org'),None)
@@ -0,0 +1,74 @@
+import unittest
+import unittestsetup
+
+from rbldnspy import wire
+from dnslib import DNSRecord, DNSQuestion, QTYPE
+
+
+class WireTest(unittest.TestCase):
+
+    def _query(self,name,qtype='A',qid=4711):
+        d=DNSRecord.question(name,qtype)
+        d.header.id=qid
+        return str(d.pack())
+
+    def test_parse(self):
+        packet=self._query('2.0.0.127.Example.org','TXT')
+        query=wire.parse_query(packet)
+        self.assertNotEqual(query,None)
+        self.assertEqual(query.id,4711)
+        self.assertEqual(query.qname,'2.0.0.127.Example.org.')
+        self.assertEqual(query.qtype,'TXT')
+        self.assertEqual(query.qend,len(packet))
+
+    def test_fallback(self):
+        #unsupported qtype
+        self.assertEqual(wire.parse_query(self._query('example.org','SOA')),None)
+
+        #class other than IN: CH, ANY
+        for qclass in ('CH','*'):
+            self.assertEqual(wire.parse_query(str(DNSRecord.question('example.org','A',qclass).pack())),None)
+
+        #multiple questions
+        d=DNSRecord.question('example.org')
+        d.add_question(DNSQuestion('example.com'))
+        self.assertEqual(wire.parse_query(str(d.pack())),None)
+
+        #not a query
+        self.assertEqual(wire.parse_query(str(DNSRecord.question('example.org').reply().pack())),None)
+
+        #truncated
+        self.assertEqual(wire.parse_query(self._query('example.org')[:-2]),None)
+
+    def test_error_response(self):
+        packet=self._query('2.0.0.127.example.org')
+        query=wire.parse_query(packet)
+        response=DNSRecord.parse(wire.error_response(packet,query,3))
+        self.assertEqual(response.header.id,4711)
+        self.assertEqual(response.header.rcode,3)
+        self.assertEqual(response.header.qr,1)
+        self.assertEqual(response.header.rd,1)
+        self.assertEqual(str(response.q.qname),'2.0.0.127.example.org.')
+        self.assertEqual(len(response.rr),0)
+        #RD is echoed from the query
+        packet=packet[:2]+chr(ord(packet[2])&0xfe)+packet[3:]
+        response=DNSRecord.parse(wire.error_response(packet,wire.parse_query(packet),3))
+        self.assertEqual(response.header.rd,0)
+
+    def test_answer_response(self):
+        packet=self._query('2.0.0.127.example.org','A')
+        query=wire.parse_query(packet)
+        response=DNSRecord.parse(wire.answer_response(packet,query,[('127.0.0.2',300),('127.0.0.3',None)]))
+        self.assertEqual(response.header.rcode,0)
+        self.assertEqual(response.header.aa,1)
+        self.assertEqual([str(rr.rdata) for rr in response.rr],['127.0.0.2','127.0.0.3'])
+        self.assertEqual([rr.ttl for rr in response.rr],[300,0])
+        self.assertEqual(str(response.rr[0].rname),'2.0.0.127.example.org.')
+
+        packet=self._query('2.0.0.127.example.org','TXT')
+        query=wire.parse_query(packet)
+        longtext='x'*300
+        response=DNSRecord.parse(wire.answer_response(packet,query,[('listed',60),(longtext,60)]))
+        self.assertEqual(QTYPE[response.rr[0].rtype],'TXT')
+        self.assertEqual(response.rr[0].rdata.data,['listed'])
+        self.assertEqual(''.join(response.rr[1].rdata.data),longtext)
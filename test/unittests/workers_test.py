@@ -0,0 +1,91 @@
+import unittest
+import unittestsetup
+
+import os
+import select
+import socket
+from threading import Lock
+from rbldnspy.dataset import UDPSocketSet, DNSet
+from rbldnspy.workers import WorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset=UDPSocketSet('127.0.0.1/0')
+        self.dataset.persistent=False
+        self.dataset.threaded=False
+        self.dataset.udpsocket=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.dataset.udpsocket.bind(('127.0.0.1',0))
+        self.readfd,self.writefd=os.pipe()
+        self.pool=None
+
+    def tearDown(self):
+        if self.pool!=None:
+            self.pool.shutdown()
+        os.close(self.readfd)
+        os.close(self.writefd)
+        self.dataset.shutdown()
+
+    def _worker(self,index,fastlistsockets):
+        #runs in the forked child: apply one packet forwarded by the parent and report the record
+        dataset,sock=fastlistsockets[0]
+        dataset.follow(sock)
+        dataset.receive_packet()
+        rec=dataset.backend.get('2.0.0.127')
+        os.write(self.writefd,rec and rec['A'] or 'missing')
+
+    def test_forwarding(self):
+        #the parent's writer thread is running at fork time
+        self.dataset.fastlist('before.example.com',{'A':'127.0.0.2','excluded':False,'TTL':60})
+        self.pool=WorkerPool(1,self._worker,[self.dataset])
+        self.pool.start()
+        self.assertEqual(len(self.dataset.subscribers),1)
+
+        client=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        client.sendto('2.0.0.127\t127.0.0.5',self.dataset.udpsocket.getsockname())
+        client.close()
+        self.dataset.receive_packet()
+        self.assertEqual(self.dataset.backend['2.0.0.127']['A'],'127.0.0.5')
+
+        ready=select.select([self.readfd],[],[],5)[0]
+        self.assertTrue(ready)
+        self.assertEqual(os.read(self.readfd,100),'127.0.0.5')
+        self.pool.shutdown()
+        self.assertEqual(self.dataset.subscribers,[])
+        self.pool=None
+
+
+class AfterForkTest(unittest.TestCase):
+
+    def test_follow_resets_writer(self):
+        dataset=UDPSocketSet('127.0.0.1/0')
+        dataset.persistent=False
+        dataset.threaded=False
+        dataset.fastlist('one.example.com',{'A':'127.0.0.2','excluded':False,'TTL':60})
+        #state of a parent writer interrupted by the fork
+        dataset._writerlock.acquire()
+        dataset._staged={'half.example.com':{'A':'127.0.0.2','excluded':False}}
+        dataset._count=2
+        parent,child=socket.socketpair(socket.AF_UNIX,socket.SOCK_DGRAM)
+        dataset.follow(child)
+        self.assertEqual((dataset._writer,dataset._staged,dataset._count),(None,{},1))
+        parent.send('two.example.com')
+        dataset.receive_packet()
+        self.assertEqual(sorted(dataset.backend.keys()),['one.example.com','two.example.com'])
+        self.assertEqual(len(dataset.backend),2)
+        dataset.shutdown()
+        parent.close()
+
+    def test_after_fork(self):
+        dataset=DNSet('unused')
+        dataset._reload_lock.acquire()
+        dataset.reloading=True
+        dataset.after_fork()
+        self.assertFalse(dataset.reloading)
+        self.assertEqual(dataset.last_reload,0)
+        self.assertTrue(dataset._reload_lock.acquire(False))
+
+
+if __name__=='__main__':
+    unittest.main()
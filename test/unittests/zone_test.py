@@ -0,0 +1,116 @@
+import unittest
+import unittestsetup
+
+import os
+from tempfile import mkstemp
+from rbldnspy.zone import Zone
+from rbldnspy.dataset import DNSet, SortedArraySet, UDPSocketSet
+from rbldnspy.tools import classify_query, parse_ip4_query, QUERY_IP4, QUERY_IP6, QUERY_NAME
+
+
+class ZoneGenerationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files=[]
+        self.zone=Zone('bl.example.com')
+        self.first=self._dataset("$SOA 7m localhost. hostmaster.localhost. 1 1h 10m 5d 30s\n:127.0.0.2:first\nspam.com\n")
+        self.second=self._dataset(":127.0.0.3:second\nspam.com\n")
+
+    def tearDown(self):
+        for filename in self.files:
+            os.unlink(filename)
+
+    def _write(self,filename,content):
+        handle=open(filename,'w')
+        handle.write(content)
+        handle.close()
+
+    def _dataset(self,content,datasetclass=DNSet):
+        fd,filename=mkstemp(".rbldns")
+        os.close(fd)
+        self.files.append(filename)
+        self._write(filename,content)
+        dataset=datasetclass(filename)
+        dataset.reload()
+        self.zone.add_dataset(dataset)
+        return dataset
+
+    def _answers(self,query):
+        return [result and result['A'] for result in self.zone.lookup(query)['results']]
+
+    def test_generation(self):
+        self.assertTrue(self.zone.is_available())
+        self.assertEqual(self._answers('spam.com'),['127.0.0.2','127.0.0.3'])
+        generation=self.zone.current
+        cachegeneration=self.zone.get_generation()
+        self._write(self.first.filename,":127.0.0.4:first\nspam.com\n")
+        self.first.reload()
+        self.assertEqual(self._answers('spam.com'),['127.0.0.4','127.0.0.3'])
+        self.assertNotEqual(self.zone.get_generation(),cachegeneration)
+        #readers holding the old generation are not affected
+        self.assertEqual([dataset.get('spam.com')['A'] for dataset in generation.datasets],['127.0.0.2','127.0.0.3'])
+        self.assertEqual(self.zone.get_authority()[0],None)
+
+    def test_batch_publish(self):
+        self.zone.batchpublish=True
+        self._write(self.first.filename,":127.0.0.4:first\nspam.com\n")
+        self._write(self.second.filename,":127.0.0.5:second\nspam.com\n")
+        self.first.queue_reload()
+        self.second.queue_reload()
+        self.first.reload()
+        #the second dataset is still queued, the zone serves the old data of both
+        self.assertEqual(self._answers('spam.com'),['127.0.0.2','127.0.0.3'])
+        self.second.check_reload()
+        self.assertEqual(self._answers('spam.com'),['127.0.0.4','127.0.0.5'])
+
+    def test_dispatch(self):
+        calls=[]
+        self.second.get=lambda query: calls.append(query)
+        self._dataset(":127.0.0.6:ip\n10.0.0.0/8\n",SortedArraySet)
+        self.zone.publish()
+        self.assertEqual(self._answers('1.0.0.10'),['127.0.0.6'])
+        #ip datasets never see names, name datasets never see addresses
+        self.assertEqual(self._answers('999.0.0.10'),[None,None])
+        self.assertEqual(calls,['999.0.0.10'])
+        self.assertEqual(self._answers('.'.join('0'*32)),[])
+
+    def test_ip_shaped_name(self):
+        self._write(self.second.filename,":127.0.0.3:second\nspam.com\n2.0.0.127\n")
+        self.second.reload()
+        self._dataset(":127.0.0.6:ip\n10.0.0.0/8\n",SortedArraySet)
+        self.zone.publish()
+        #not listed by the ip dataset: the name datasets are asked too
+        self.assertEqual(self._answers('2.0.0.127'),[None,None,'127.0.0.3'])
+        #listed by the ip dataset: they are not
+        self.assertEqual(self._answers('1.0.0.10'),['127.0.0.6'])
+
+    def test_fastlist_ip(self):
+        fastlist=UDPSocketSet('127.0.0.1/0')
+        fastlist.persistent=False
+        self.zone.add_dataset(fastlist)
+        try:
+            fastlist.fastlist('2.0.0.127',{'A':'127.0.0.9','excluded':False,'TTL':60})
+            fastlist.fastlist('fast.example.com',{'A':'127.0.0.9','excluded':False,'TTL':60})
+            self.assertEqual(self._answers('2.0.0.127'),['127.0.0.9'])
+            self.assertEqual(self._answers('fast.example.com'),[None,None,'127.0.0.9'])
+        finally:
+            fastlist.shutdown()
+
+    def test_firstmatch(self):
+        self.zone.firstmatch=True
+        self.assertEqual(self._answers('spam.com'),['127.0.0.2'])
+        self.assertEqual(self._answers('ham.com'),[None,None])
+
+    def test_classify(self):
+        self.assertEqual(classify_query('4.3.2.1'),(QUERY_IP4,0x01020304))
+        self.assertEqual(classify_query('4.3.2.256'),(QUERY_NAME,'4.3.2.256'))
+        self.assertEqual(classify_query('example.com'),(QUERY_NAME,'example.com'))
+        self.assertEqual(classify_query('.'.join('f'*32))[0],QUERY_IP6)
+
+    def test_parse_ip4_query(self):
+        self.assertEqual(parse_ip4_query('4.3.2.1'),0x01020304)
+        self.assertEqual(parse_ip4_query('4.3.2.1'),0x01020304)
+        self.assertEqual(parse_ip4_query('255.0.0.10'),0x0a0000ff)
+        self.assertEqual(parse_ip4_query('4.3.02.001'),0x01020304)
+        for query in ('4.3.2','5.4.3.2.1','4.3.2.256','4.3.2.0001','4.3.2.0x1','4.3.2. 1','4.3.2.+1','4.3..1','4.3.2.-1','a.b.c.d'):
+            self.assertEqual(parse_ip4_query(query),None,query)
@@ -1,7 +1,15 @@
 #!/usr/bin/python
-
-import cPickle as pickle
+"""print the names of a saved fastlist zone, including the changes in its journal"""
 import sys
+import os
+
+try:
+    import rbldnspy
+except ImportError:
+    #running from a source checkout
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rbldnspy.journal import read_zone
 
 if len(sys.argv)<2:
     print "arg: /path/to/dumpfile"
@@ -9,6 +17,6 @@ if len(sys.argv)<2:
     
 filename=sys.argv[1]
 
-dic=pickle.load(open(filename,'rb'))
+dic=read_zone(filename)
 for k in sorted(dic.keys()):
-   print k
\ No newline at end of file
+   print k
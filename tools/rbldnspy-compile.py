@@ -0,0 +1,44 @@
+#!/usr/bin/python
+"""build snapshot files for rbldnspy datasets, so the daemon can map the index instead of parsing the source
+
+usage: rbldnspy-compile.py type file [file...]
+"""
+import sys
+import os
+import logging
+
+try:
+    import rbldnspy
+except ImportError:
+    #running from a source checkout
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rbldnspy.dataset import DATASETMAP
+from rbldnspy.snapshot import snapshot_filename, read_snapshot
+
+SUPPORTED = ['ip4set', 'ip4tset', 'dnset']
+
+if len(sys.argv) < 3 or sys.argv[1] not in SUPPORTED:
+    print "usage: rbldnspy-compile.py type file [file...]"
+    print "supported types: %s" % ", ".join(SUPPORTED)
+    sys.exit(1)
+
+logging.basicConfig(level=logging.WARNING)
+dsettype = sys.argv[1]
+exitcode = 0
+for filename in sys.argv[2:]:
+    if not os.path.isfile(filename):
+        print "%s: file does not exist" % filename
+        exitcode = 1
+        continue
+    dataset = DATASETMAP[dsettype](filename)
+    dataset.snapshots = True
+    dataset.reload()
+    if dataset.loadedsnapshot:
+        print "%s: snapshot is up to date" % filename
+    elif read_snapshot(filename, dataset.__class__.__name__) != None:
+        print "%s: %s records -> %s" % (filename, dataset.get_record_count(), snapshot_filename(filename))
+    else:
+        print "%s: could not write snapshot" % filename
+        exitcode = 1
+sys.exit(exitcode)